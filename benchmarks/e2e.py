@@ -0,0 +1,321 @@
+"""
+End-to-end benchmark of the web app and the Telegram bot against local stand-ins of the OpenAI and Telegram APIs (benchmarks/mock_servers.py).
+It sends a synthetic corpus of voice notes of varying lengths through
+* flask: the `/transcribe_and_process` route of main.py, through the Flask test client;
+* telegram: the handlers of telegram_bot.py, with voice message updates fed to a PTB Application pointed at the Telegram stand-in,
+and reports, per target, the p50/p95/p99 of the end-to-end latency and of the time to the first paraphrased token visible to the user,
+the throughput, and the CPU time and memory per request, as JSON. Save it with --output, and compare two commits with --baseline.
+
+The stand-ins run in a subprocess, so the CPU and memory numbers only cover this project's code.
+The voice notes are real Opus audio when ffmpeg is available. Otherwise they are fake OGG payloads, which only exercise the passthrough path,
+so the notes long enough for the chunked transcription are skipped, and the silence trimming is turned off.
+The response cache is disabled unless --cache is given, so every request reaches the stand-ins.
+
+Usage:
+    python benchmarks/e2e.py [--targets flask,telegram] [--requests 40] [--concurrency 8] [--durations 5,15,30,60,120] [--output results.json] [--baseline old.json]
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import contextlib
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+# The persistent cache would turn the later runs into cache hits, so it's never used here.
+os.environ['CACHE_DB_FILE'] = ''
+# The fake payloads used without ffmpeg can't be decoded for the silence trimming.
+if not shutil.which('ffmpeg'):
+    os.environ['VAD_ENABLED'] = '0'
+
+import numpy as np
+import aiohttp
+import openai
+import core
+import mock_servers
+
+BENCH_TOKEN = '123456:BENCH'
+
+def make_voice_note(seconds: float, seed: int) -> bytes:
+    """A voice note of the given length. With ffmpeg, a tone with a pause every few seconds, like speech, encoded like Telegram voice notes.
+    Otherwise a fake OGG payload of the same size."""
+    if shutil.which('ffmpeg'):
+        # The seed changes the pitch and the metadata, so the notes of the same length are not identical.
+        expression = f'0.3*sin(2*PI*{150 + seed % 100}*t)*gt(mod(t\\,{5 + seed % 4})\\,0.8)'
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', f'aevalsrc={expression}:s=16000:d={seconds}',
+                   '-c:a', 'libopus', '-b:a', '24k', '-metadata', f'comment=bench-{seed}', '-f', 'ogg', 'pipe:1']
+        return subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+    rng = random.Random(seed)
+    return b'OggS' + rng.randbytes(int(seconds * 3000))
+
+def build_corpus(durations: List[float], requests: int) -> List[Tuple[float, bytes]]:
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    corpus = []
+    for i in range(requests):
+        seconds = durations[i % len(durations)]
+        note = make_voice_note(seconds, i)
+        if not has_ffmpeg and core.needs_chunked_transcription(note):
+            print(f'Skipped a {seconds}s note: the chunked transcription needs ffmpeg.', file=sys.stderr)
+            continue
+        corpus.append((seconds, note))
+    return corpus
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4), 'mean': round(float(np.mean(values)), 4)}
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class ResourceMeter:
+    """Measures the wall time, CPU time and memory of this process over a block."""
+    def __enter__(self) -> 'ResourceMeter':
+        self.rss_start = current_rss_mb()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+        self.rss_end = current_rss_mb()
+
+    def summary(self, requests: int) -> Dict[str, float]:
+        return {
+            'wall_seconds': round(self.wall, 3),
+            'throughput_rps': round(requests / self.wall, 3) if self.wall else None,
+            'cpu_ms_per_request': round(self.cpu / max(1, requests) * 1000, 3),
+            'cpu_utilization': round(self.cpu / self.wall, 3) if self.wall else None,
+            'rss_mb_start': round(self.rss_start, 1),
+            'rss_mb_end': round(self.rss_end, 1),
+            'rss_kb_per_request': round((self.rss_end - self.rss_start) * 1024 / max(1, requests), 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+def summarize(samples: List[dict], meter: ResourceMeter) -> dict:
+    succeeded = [sample for sample in samples if sample['ok']]
+    by_duration = {}
+    for seconds in sorted({sample['seconds'] for sample in samples}):
+        latencies = [sample['latency'] for sample in succeeded if sample['seconds'] == seconds]
+        by_duration[str(seconds)] = percentiles(latencies)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(succeeded),
+        'latency_seconds': percentiles([sample['latency'] for sample in succeeded]),
+        'ttft_seconds': percentiles([sample['ttft'] for sample in succeeded if sample['ttft'] is not None]),
+        'latency_seconds_by_note_length': by_duration,
+        **meter.summary(len(samples)),
+    }
+
+def run_flask(corpus: List[Tuple[float, bytes]], concurrency: int) -> dict:
+    import main
+    client = main.app.test_client()
+
+    def request(seconds: float, note: bytes) -> dict:
+        start = time.perf_counter()
+        ttft = None
+        body = []
+        response = client.post('/transcribe_and_process', data={'audio': (io.BytesIO(note), 'note.ogg')}, buffered=False)
+        try:
+            for chunk in response.response:
+                chunk = chunk.decode('UTF-8') if isinstance(chunk, bytes) else chunk
+                if ttft is None and 'event: delta' in chunk:
+                    ttft = time.perf_counter() - start
+                body.append(chunk)
+        finally:
+            response.close()
+        body = ''.join(body)
+        return {'seconds': seconds, 'latency': time.perf_counter() - start, 'ttft': ttft, 'ok': response.status_code == 200 and 'event: done' in body}
+
+    with ResourceMeter() as meter, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(lambda item: request(*item), corpus))
+    return summarize(samples, meter)
+
+async def run_telegram(corpus: List[Tuple[float, bytes]], concurrency: int, telegram_url: str) -> dict:
+    from telegram import Update
+    from telegram.ext import Application
+    import telegram_bot
+
+    application = Application.builder().token(BENCH_TOKEN) \
+        .base_url(f'{telegram_url}/bot').base_file_url(f'{telegram_url}/file/bot') \
+        .build()
+    telegram_bot.add_handlers(application)
+    await application.initialize()
+    run_id = int(time.time())
+
+    async with aiohttp.ClientSession() as session:
+        for i, (_, note) in enumerate(corpus):
+            async with session.put(f'{telegram_url}/_bench/files/voice{i}', data=note) as response:
+                response.raise_for_status()
+        # Drop the calls made so far, e.g. getMe.
+        async with session.get(f'{telegram_url}/_bench/calls') as response:
+            await response.json()
+
+        semaphore = asyncio.Semaphore(concurrency)
+        starts: Dict[int, float] = {}
+
+        async def request(i: int, seconds: float, note: bytes) -> dict:
+            # Every note comes from a different user, like the production traffic, so the per-chat rate limits don't add up.
+            chat_id = 1000 + i
+            update = Update.de_json({
+                'update_id': i + 1,
+                'message': {
+                    'message_id': i + 1, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                    'voice': {'file_id': f'voice{i}', 'file_unique_id': f'bench-{run_id}-{i}', 'duration': int(seconds),
+                              'mime_type': 'audio/ogg', 'file_size': len(note)},
+                },
+            }, application.bot)
+            async with semaphore:
+                starts[chat_id] = time.time()
+                start = time.perf_counter()
+                ok = True
+                try:
+                    await application.process_update(update)
+                except Exception as e:
+                    print(f'Update {i} failed: {e}', file=sys.stderr)
+                    ok = False
+                return {'chat_id': chat_id, 'seconds': seconds, 'latency': time.perf_counter() - start, 'ttft': None, 'ok': ok}
+
+        with ResourceMeter() as meter:
+            samples = await asyncio.gather(*(request(i, seconds, note) for i, (seconds, note) in enumerate(corpus)))
+
+        async with session.get(f'{telegram_url}/_bench/calls') as response:
+            calls = await response.json()
+
+    # The first token is visible when the placeholder is first edited. The handlers report their errors in a message starting with "Error:",
+    # which the stand-in doesn't see the text of, so a note is only counted as a success once its paraphrase was edited in.
+    first_edits: Dict[int, float] = {}
+    for call in calls:
+        if call['method'] == 'editMessageText' and 'error' not in call:
+            first_edits.setdefault(call['chat_id'], call['time'])
+    for sample in samples:
+        chat_id = sample.pop('chat_id')
+        if chat_id in first_edits:
+            sample['ttft'] = first_edits[chat_id] - starts[chat_id]
+        else:
+            sample['ok'] = False
+    await application.shutdown()
+    await core.close_http_clients()
+
+    result = summarize(samples, meter)
+    result['telegram_calls'] = {method: sum(call['method'] == method for call in calls) for method in sorted({call['method'] for call in calls})}
+    result['telegram_flood_errors'] = sum('error' in call for call in calls)
+    return result
+
+def start_stand_ins(args: argparse.Namespace) -> Tuple[subprocess.Popen, dict]:
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, 'mock_servers.py')]
+    for action in mock_servers_parser()._actions:
+        if action.dest != 'help':
+            command += [action.option_strings[0], str(getattr(args, action.dest))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    ports = json.loads(process.stdout.readline())
+    return process, ports
+
+def mock_servers_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    mock_servers.add_arguments(parser)
+    return parser
+
+def compare(result: dict, baseline: dict) -> dict:
+    """The relative change of the main metrics against a previous result. Negative is better, except for the throughput."""
+    comparison = {}
+    for target, stats in result['targets'].items():
+        old = baseline.get('targets', {}).get(target)
+        if old is None:
+            continue
+        changes = {}
+        for group in ('latency_seconds', 'ttft_seconds'):
+            for key in ('p50', 'p95', 'p99'):
+                new_value, old_value = stats[group][key], old[group][key]
+                if new_value is not None and old_value:
+                    changes[f'{group}.{key}'] = round(new_value / old_value - 1, 4)
+        for key in ('throughput_rps', 'cpu_ms_per_request', 'rss_kb_per_request'):
+            if stats.get(key) is not None and old.get(key):
+                changes[key] = round(stats[key] / old[key] - 1, 4)
+        comparison[target] = changes
+    return {'baseline_commit': baseline.get('commit'), 'relative_change': comparison}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter, parents=[mock_servers_parser()])
+    parser.add_argument('--targets', default='flask,telegram', help='Comma separated: flask, telegram.')
+    parser.add_argument('--requests', type=int, default=40, help='Number of voice notes sent to each target.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--durations', default='5,15,30,60,120', help='Comma separated lengths of the voice notes, in seconds.')
+    parser.add_argument('--cache', action='store_true', help='Keep the in-memory response cache enabled.')
+    parser.add_argument('--output', help='Write the results to this JSON file, besides stdout.')
+    parser.add_argument('--baseline', help='A previous output to compare with.')
+    parser.add_argument('--verbose', action='store_true', help="Keep the handlers' logs.")
+    args = parser.parse_args()
+
+    if not args.cache:
+        core.RESPONSE_CACHE.memory_entries = 0
+    corpus = build_corpus([float(d) for d in args.durations.split(',')], args.requests)
+    process, ports = start_stand_ins(args)
+    openai.api_base = f'http://127.0.0.1:{ports["openai"]}/v1'
+    openai.api_key = 'bench'
+    telegram_url = f'http://127.0.0.1:{ports["telegram"]}'
+
+    result = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'ffmpeg': shutil.which('ffmpeg') is not None,
+        'config': vars(args),
+        'corpus': {'notes': len(corpus), 'bytes': sum(len(note) for _, note in corpus)},
+        'targets': {},
+    }
+    try:
+        # The handlers print every transcript and paraphrase, which would drown the results.
+        logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with logs:
+            for target in args.targets.split(','):
+                if target == 'flask':
+                    result['targets']['flask'] = run_flask(corpus, args.concurrency)
+                elif target == 'telegram':
+                    result['targets']['telegram'] = asyncio.run(run_telegram(corpus, args.concurrency, telegram_url))
+                else:
+                    raise ValueError(f'Unknown target: {target}')
+        with urllib.request.urlopen(f'http://127.0.0.1:{ports["openai"]}/_bench/stats') as response:
+            result['openai_calls'] = json.load(response)
+    finally:
+        process.terminate()
+        process.wait()
+
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as f:
+            result['comparison'] = compare(result, json.load(f))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Local stand-ins of the OpenAI and Telegram Bot APIs for the end-to-end benchmark (benchmarks/e2e.py), so it runs offline and without spending anything.
+* OpenAI: `POST /v1/audio/transcriptions` and `POST /v1/chat/completions` (streamed or not), with configurable latency, jitter,
+  time to first token, token rate and error rate. The outputs are random Chinese text, seeded by the input so the same input gives the same output.
+* Telegram: the Bot API methods used by telegram_bot.py, plus file downloads. Every call is recorded with its time, so the benchmark can tell
+  e.g. when the first token of a paraphrase became visible to the user. Files are uploaded by the benchmark with `PUT /_bench/files/<file_id>`.
+It prints a JSON line with the ports once it's ready. It usually runs as a subprocess of e2e.py, which passes the same arguments.
+
+Usage:
+    python benchmarks/mock_servers.py [--openai-latency-ms 300] [--token-rate 30] [--error-rate 0.01] ...
+"""
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import hashlib
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Optional
+from aiohttp import web
+
+# Common characters the fake transcripts and completions are made of.
+FAKE_CHARACTERS = '的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感'
+# Bytes of compressed voice per transcribed character, roughly 3 KB/s of Opus for 3-4 spoken characters per second.
+AUDIO_BYTES_PER_CHARACTER = 800
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """The configs of the stand-ins, shared with e2e.py."""
+    group = parser.add_argument_group('stand-in servers')
+    group.add_argument('--latency-distribution', choices=['normal', 'lognormal', 'uniform', 'constant'], default='lognormal',
+                       help='Distribution of the latencies. The jitter is the standard deviation (normal, lognormal) or the half width (uniform).')
+    group.add_argument('--openai-latency-ms', type=float, default=300, help='Latency of a chat completion, or of the first token when streamed.')
+    group.add_argument('--openai-jitter-ms', type=float, default=100)
+    group.add_argument('--asr-ms-per-mb', type=float, default=3000, help='Transcription time per MB of audio, on top of the latency.')
+    group.add_argument('--token-rate', type=float, default=30, help='Output tokens per second of the chat completions.')
+    group.add_argument('--max-output-tokens', type=int, default=1000)
+    group.add_argument('--error-rate', type=float, default=0.0, help='Share of the OpenAI requests answered with a 500.')
+    group.add_argument('--telegram-latency-ms', type=float, default=50)
+    group.add_argument('--telegram-jitter-ms', type=float, default=20)
+    group.add_argument('--telegram-error-rate', type=float, default=0.0, help='Share of the message edits answered with a flood-control 429.')
+    group.add_argument('--seed', type=int, default=0)
+
+class LatencyModel:
+    """Samples latencies in seconds from the configured distribution.
+
+    Args:
+        mean_ms (float): the mean (the median for lognormal) in milliseconds.
+        jitter_ms (float): the spread in milliseconds.
+        distribution (str): normal, lognormal, uniform or constant.
+        rng (random.Random): the random generator.
+    """
+    def __init__(self, mean_ms: float, jitter_ms: float, distribution: str, rng: random.Random):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.rng = rng
+
+    def sample(self) -> float:
+        if self.distribution == 'constant' or self.jitter_ms <= 0 or self.mean_ms <= 0:
+            value = self.mean_ms
+        elif self.distribution == 'normal':
+            value = self.rng.gauss(self.mean_ms, self.jitter_ms)
+        elif self.distribution == 'uniform':
+            value = self.rng.uniform(self.mean_ms - self.jitter_ms, self.mean_ms + self.jitter_ms)
+        else:
+            # The sigma is chosen so that the standard deviation is roughly jitter_ms for small spreads. The tail is long, like the real APIs.
+            value = self.mean_ms * self.rng.lognormvariate(0, self.jitter_ms / self.mean_ms)
+        return max(0.0, value) / 1000
+
+def fake_text(seed: bytes, length: int) -> str:
+    """Random Chinese text with punctuation, the same for the same seed."""
+    rng = random.Random(hashlib.sha256(seed).digest())
+    pieces = []
+    while len(pieces) < length:
+        pieces.extend(rng.choices(FAKE_CHARACTERS, k=rng.randint(6, 20)))
+        pieces.append(rng.choice('，，，。'))
+    return ''.join(pieces[:length])
+
+def split_tokens(text: str, rng: random.Random) -> List[str]:
+    # Chinese text is roughly one or two characters per token.
+    tokens, i = [], 0
+    while i < len(text):
+        n = rng.choice((1, 1, 2))
+        tokens.append(text[i:i + n])
+        i += n
+    return tokens
+
+class OpenAIStandIn:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latency = LatencyModel(args.openai_latency_ms, args.openai_jitter_ms, args.latency_distribution, self.rng)
+        self.token_interval = LatencyModel(1000 / args.token_rate, 250 / args.token_rate, args.latency_distribution, self.rng)
+        self.stats: Dict[str, int] = defaultdict(int)
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/v1/audio/transcriptions', self.transcribe),
+            web.post('/v1/chat/completions', self.complete),
+        ]
+
+    def _inject_error(self, endpoint: str) -> Optional[web.Response]:
+        if self.rng.random() < self.args.error_rate:
+            self.stats[endpoint + '_errors'] += 1
+            return web.json_response({'error': {'message': 'Injected error', 'type': 'server_error', 'param': None, 'code': None}}, status=500)
+        return None
+
+    async def transcribe(self, request: web.Request) -> web.Response:
+        self.stats['transcriptions'] += 1
+        form = await request.post()
+        audio = form['file'].file.read()
+        self.stats['audio_bytes'] += len(audio)
+        await asyncio.sleep(self.latency.sample() + len(audio) / 1e6 * self.args.asr_ms_per_mb / 1000)
+        error = self._inject_error('transcriptions')
+        if error is not None:
+            return error
+        return web.json_response({'text': fake_text(audio, max(1, len(audio) // AUDIO_BYTES_PER_CHARACTER))})
+
+    async def complete(self, request: web.Request) -> web.StreamResponse:
+        self.stats['completions'] += 1
+        body = await request.json()
+        prompt = ''.join(message['content'] for message in body['messages'])
+        user_text = body['messages'][-1]['content']
+        # A paraphrase is about as long as its input.
+        text = fake_text(prompt.encode('UTF-8'), len(user_text))
+        tokens = split_tokens(text, random.Random(len(text)))[:self.args.max_output_tokens]
+        text = ''.join(tokens)
+        created = int(time.time())
+        await asyncio.sleep(self.latency.sample())
+        error = self._inject_error('completions')
+        if error is not None:
+            return error
+
+        if not body.get('stream'):
+            await asyncio.sleep(sum(self.token_interval.sample() for _ in tokens))
+            self.stats['completion_tokens'] += len(tokens)
+            return web.json_response({
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': created, 'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(tokens), 'total_tokens': len(prompt) + len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: Optional[str] = None):
+            chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created, 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            await response.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('UTF-8'))
+
+        await send({'role': 'assistant'})
+        for token in tokens:
+            await send({'content': token})
+            self.stats['completion_tokens'] += 1
+            await asyncio.sleep(self.token_interval.sample())
+        await send({}, 'stop')
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+class TelegramStandIn:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed + 1)
+        self.latency = LatencyModel(args.telegram_latency_ms, args.telegram_jitter_ms, args.latency_distribution, self.rng)
+        self.files: Dict[str, bytes] = {}
+        self.calls: List[dict] = []
+        self.next_message_id = 1
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.put('/_bench/files/{file_id}', self.put_file),
+            web.get('/_bench/calls', self.get_calls),
+            web.get('/file/{token}/{path:.*}', self.download),
+            web.post('/{token}/{method}', self.call),
+        ]
+
+    async def put_file(self, request: web.Request) -> web.Response:
+        self.files[request.match_info['file_id']] = await request.read()
+        return web.json_response(True)
+
+    async def get_calls(self, request: web.Request) -> web.Response:
+        # The recorded calls are handed over once, so each benchmark run starts from scratch.
+        calls, self.calls = self.calls, []
+        return web.json_response(calls)
+
+    async def download(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency.sample())
+        file_id = request.match_info['path'].rsplit('/', 1)[-1].split('.')[0]
+        if file_id not in self.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.files[file_id])
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        if message_id is None:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+    async def call(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = {}
+        for key, value in (await request.post()).items():
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        chat_id = int(params.get('chat_id', 0))
+        await asyncio.sleep(self.latency.sample())
+        self.calls.append({'method': method, 'chat_id': chat_id, 'time': time.time(), 'text_length': len(str(params.get('text', '')))})
+
+        if method == 'editMessageText' and self.rng.random() < self.args.telegram_error_rate:
+            self.calls[-1]['error'] = 429
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}}, status=429)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot', 'can_join_groups': True,
+                      'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'Bench', 'last_name': str(params['user_id'])}}
+        elif method == 'getFile':
+            file_id = params['file_id']
+            if file_id not in self.files:
+                return web.json_response({'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'}, status=400)
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]), 'file_path': f'voice/{file_id}.oga'}
+        elif method == 'sendMessage':
+            result = self._message(chat_id, params.get('text', ''))
+        elif method == 'editMessageText':
+            result = self._message(chat_id, params.get('text', ''), int(params['message_id']))
+        else:
+            # deleteMessage, sendChatAction, setMyCommands...
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def serve(args: argparse.Namespace):
+    openai_app, telegram_app = web.Application(client_max_size=1 << 30), web.Application(client_max_size=1 << 30)
+    openai_stand_in, telegram_stand_in = OpenAIStandIn(args), TelegramStandIn(args)
+    openai_app.add_routes(openai_stand_in.routes() + [web.get('/_bench/stats', lambda request: web.json_response(openai_stand_in.stats))])
+    telegram_app.add_routes(telegram_stand_in.routes())
+    ports = {}
+    for name, app, port in (('openai', openai_app, args.openai_port), ('telegram', telegram_app, args.telegram_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        ports[name] = port or free_port()
+        await web.TCPSite(runner, '127.0.0.1', ports[name]).start()
+    print(json.dumps({'ready': True, **ports}), flush=True)
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--openai-port', type=int, default=0)
+    parser.add_argument('--telegram-port', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmarks the local outline intent classifier (core.OutlineIntentClassifier) against a labelled corpus.
+It reports the share of utterances classified locally (i.e. the GPT-3.5 calls removed), the accuracy of those local decisions and the classification time.
+The accuracy is only measured on held-out utterances: the ones normalizing to a phrase of core.OUTLINE_INTENT_PHRASES
+would be matched exactly, so they are left out and listed under seen_phrases.
+With --with-llm, the ambiguous utterances are sent to GPT-3.5 as in production, to measure the end-to-end accuracy.
+
+Usage:
+    python benchmarks/outline_intent.py [--corpus benchmarks/outline_intent_corpus.tsv] [--with-llm]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import core
+
+def load_corpus(filename: str):
+    with open(filename, encoding='UTF-8') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip() and not line.startswith('#')]
+    # The first line is the header.
+    return [(text, label == '1') for text, label in (line.rsplit('\t', 1) for line in lines[1:])]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outline_intent_corpus.tsv'))
+    parser.add_argument('--with-llm', action='store_true', help='Send the ambiguous utterances to GPT-3.5.')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    known = {core.normalize_utterance(phrase) for phrases in core.OUTLINE_INTENT_PHRASES.values() for phrase in phrases}
+    seen = [text for text, _ in corpus if core.normalize_utterance(text) in known]
+    corpus = [(text, label) for text, label in corpus if core.normalize_utterance(text) not in known]
+    classifier = core.OUTLINE_INTENT_CLASSIFIER
+    local_decisions, local_correct, errors = 0, 0, []
+    llm_calls, llm_correct = 0, 0
+    start = time.perf_counter()
+    for text, label in corpus:
+        prediction, confidence = classifier.classify(text)
+        if prediction is None:
+            if args.with_llm:
+                llm_calls += 1
+                llm_correct += core.classify_outline_intent_mode(text) == label
+            continue
+        local_decisions += 1
+        local_correct += prediction == label
+        if prediction != label:
+            errors.append({'text': text, 'label': label, 'confidence': round(confidence, 3)})
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'utterances': len(corpus),
+        'seen_phrases': seen,
+        'local_decisions': local_decisions,
+        'llm_calls_removed': local_decisions / len(corpus),
+        'local_accuracy': local_correct / local_decisions if local_decisions else None,
+        'local_errors': errors,
+        'ambiguous': [text for text, _ in corpus if classifier.classify(text)[0] is None],
+    }
+    if args.with_llm:
+        result['end_to_end_accuracy'] = (local_correct + llm_correct) / len(corpus)
+    else:
+        result['local_us_per_utterance'] = elapsed / len(corpus) * 1e6
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,794 @@
 """
 This file holds the core functions of WhisperNote. It contains the following functions:
 * transcribe_voice_message: This function is used to transcribe the voice message to text.
+* ASRRouter: The transcriptions go to the backends listed in ASR_BACKENDS, i.e. the Whisper API (OpenAIASRBackend) and/or a local faster-whisper model (LocalWhisperBackend), falling back from one to the next.
 * paraphrase_text: This function is used to paraphrase the text using GPT and return the processed text.
+* process_long_text / process_long_text_stream: Texts longer than LONG_INPUT_MIN_TOKENS are split at sentence boundaries and the chunks are processed concurrently, with a reduce pass for the GLOBAL_VIEW_PROMPTS.
 * convert_audio_file_to_format: This function is used to convert the audio file to a specific format.
+* transcode_audio / transcode_audio_async: These functions convert in-memory audio through ffmpeg pipes on a bounded worker pool.
+* prepare_audio_for_asr / prepare_audio_for_asr_async: These functions sniff the incoming audio and either pass it through or encode it compactly for the ASR upload.
+* prepare_speech_for_asr / prepare_speech_for_asr_async: The same, after trimming the silence with a NumPy voice activity detector (trim_silence). Silent notes raise NoSpeechDetected.
+* transcribe_long_voice_data / transcribe_voice_data_chunked_async: These functions split long audio on silence and transcribe the chunks concurrently.
+Every function calling the OpenAI API has an awaitable counterpart with the `_async` suffix. All the calls share pooled keep-alive HTTP connections,
+and the number of requests in flight is bounded by OPENAI_MAX_CONCURRENCY.
+Each request is made through request_policy.REQUESTS, which gives it a deadline, retries and a hedged backup attempt when it's slower than usual.
+Transcripts and GPT outputs are cached in RESPONSE_CACHE, because every call uses temperature=0 and thus the same input gives the same output.
+For the same reason, identical requests made at the same time share one API call through IN_FLIGHT.
+The time spent in each stage (transcode, whisper, gpt_completion, gpt_first_token...) is recorded with metrics.span.
 """
 import openai
 import io
+import os
+import re
 import json
-from pydub import AudioSegment
-from typing import Dict, Tuple
-from prompts import PROMPTS, CHOICE_TO_PROMPT
+import time
+import hashlib
+import queue
+import sqlite3
+from collections import OrderedDict
+import asyncio
+import contextlib
+import functools
+import subprocess
+import tempfile
+import threading
+import weakref
+import abc
+import unicodedata
+import aiohttp
+import requests
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from prompts import PROMPTS, CHOICE_TO_PROMPT, GLOBAL_VIEW_PROMPTS
+from request_policy import REQUESTS, CHAT, CHAT_FIRST_TOKEN, WHISPER
+import metrics
+
+# Maximum number of ffmpeg processes running at the same time. Each transcoding job runs in its own ffmpeg process,
+# so a burst of voice notes is spread across the cores instead of being handled one at a time.
+TRANSCODE_MAX_WORKERS = int(os.environ.get('TRANSCODE_MAX_WORKERS', os.cpu_count() or 1))
+# Each worker thread only feeds an ffmpeg child process through pipes and waits on it, so the threads themselves are cheap.
+_transcode_pool = ThreadPoolExecutor(max_workers=TRANSCODE_MAX_WORKERS, thread_name_prefix='transcode')
+
+AudioInput = Union[bytes, bytearray, memoryview, BinaryIO]
+
+# Containers the Whisper ASR API accepts as they are, see https://platform.openai.com/docs/guides/speech-to-text
+WHISPER_ACCEPTED_FORMATS = frozenset(['flac', 'm4a', 'mp3', 'mp4', 'mpeg', 'mpga', 'oga', 'ogg', 'wav', 'webm'])
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# Whisper works on 16 kHz mono internally, so anything above that is wasted upload bandwidth.
+# Opus at 24 kbps keeps speech intelligible for ASR and is several times smaller than the default mp3.
+COMPACT_AUDIO_FORMAT = 'ogg'
+COMPACT_AUDIO_ARGS = ('-vn', '-ac', '1', '-ar', '16000', '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip')
+
+# Decoded audio is handled as 16 kHz mono signed 16-bit PCM.
+PCM_SAMPLE_RATE = 16000
+PCM_ARGS = ('-f', 's16le', '-ac', '1', '-ar', str(PCM_SAMPLE_RATE))
+# Audio larger than this is split on silence and transcribed in chunks. 1 MB is about 4 minutes of a Telegram voice note.
+CHUNKED_TRANSCRIPTION_MIN_BYTES = int(os.environ.get('CHUNKED_TRANSCRIPTION_MIN_BYTES', 1024 * 1024))
+CHUNK_MIN_SECONDS = 20
+CHUNK_MAX_SECONDS = 60
+# Maximum number of chunks of one note being transcribed at the same time.
+TRANSCRIBE_MAX_CONCURRENCY = int(os.environ.get('TRANSCRIBE_MAX_CONCURRENCY', 4))
+
+# Voice activity detection before the transcription. Leading and trailing silence is cut, and pauses are shortened,
+# so less audio is uploaded and transcribed. Notes without any speech are dropped before any API call.
+VAD_ENABLED = os.environ.get('VAD_ENABLED', '1') not in ('', '0', 'false')
+VAD_FRAME_SECONDS = 0.02
+# Pauses longer than this are shortened to this length. Whisper still sees a pause, so the punctuation is kept.
+VAD_MAX_PAUSE_SECONDS = float(os.environ.get('VAD_MAX_PAUSE_SECONDS', 0.6))
+# Audio kept around the speech, so the first and last syllables are not cut.
+VAD_PADDING_SECONDS = 0.2
+# RMS energy of int16 samples below which a frame never counts as speech, i.e. about -50 dBFS.
+VAD_MIN_ENERGY = float(os.environ.get('VAD_MIN_ENERGY', 100))
+# Zero-crossing rate above which a quiet frame counts as an unvoiced consonant (s, sh, f...) rather than silence.
+VAD_UNVOICED_ZCR = 0.25
+# When less speech than this is detected in a note that isn't silent, the detector is not trusted and the note is kept untrimmed.
+VAD_MIN_SPEECH_SECONDS = 0.3
+# When less than this would be trimmed, the original audio is uploaded as it is, because re-encoding costs more than it saves.
+VAD_MIN_TRIMMED_SECONDS = float(os.environ.get('VAD_MIN_TRIMMED_SECONDS', 2))
+
+# Maximum number of OpenAI requests in flight per process (sync) or per event loop (async). Requests above it wait for a free slot.
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 32))
+# Number of keep-alive connections kept open to the OpenAI API.
+OPENAI_POOL_SIZE = int(os.environ.get('OPENAI_POOL_SIZE', OPENAI_MAX_CONCURRENCY))
+OPENAI_KEEPALIVE_SECONDS = 60
+
+# Inputs longer than this many tokens are split into chunks, which are processed concurrently and merged (see split_text_for_model),
+# so the latency follows the longest chunk instead of the whole text, and long notes don't hit the context limit.
+LONG_INPUT_MIN_TOKENS = int(os.environ.get('LONG_INPUT_MIN_TOKENS', 2000))
+LONG_INPUT_CHUNK_TOKENS = int(os.environ.get('LONG_INPUT_CHUNK_TOKENS', 1200))
+# The end of the previous chunk is passed along with each chunk as context, so the sentences at the boundaries keep their meaning.
+LONG_INPUT_OVERLAP_TOKENS = 100
+
+def _make_requests_session() -> requests.Session:
+    """Creates the pooled requests session shared by every blocking OpenAI call, instead of one session per thread."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=OPENAI_POOL_SIZE, max_retries=2)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+openai.requestssession = _make_requests_session()
+_sync_openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+# aiohttp sessions and semaphores are bound to an event loop, so there is one pair per loop.
+_async_http_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[aiohttp.ClientSession, asyncio.Semaphore]]' = weakref.WeakKeyDictionary()
+
+def _async_http_client() -> Tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+    """Gets the pooled aiohttp session and the concurrency semaphore of the running event loop, creating them on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None or client[0].closed:
+        connector = aiohttp.TCPConnector(limit=OPENAI_POOL_SIZE, keepalive_timeout=OPENAI_KEEPALIVE_SECONDS)
+        client = (aiohttp.ClientSession(connector=connector), asyncio.Semaphore(OPENAI_MAX_CONCURRENCY))
+        _async_http_clients[loop] = client
+    return client
+
+@contextlib.contextmanager
+def _use_async_http_session(session: aiohttp.ClientSession) -> Iterator[None]:
+    """Makes the openai library send the requests started inside the block through the pooled session.
+    Without it, openai opens and closes a new session, and thus a new TLS connection, for every async request."""
+    token = openai.aiosession.set(session)
+    try:
+        yield
+    finally:
+        openai.aiosession.reset(token)
+
+@contextlib.asynccontextmanager
+async def _async_openai_slot() -> AsyncIterator[None]:
+    """Waits for a free request slot of the running event loop, and routes the requests through the pooled session."""
+    session, semaphore = _async_http_client()
+    async with semaphore:
+        with _use_async_http_session(session):
+            yield
+
+async def close_http_clients():
+    """Closes the pooled HTTP session of the running event loop. Call it before the loop is shut down."""
+    client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client[0].close()
+
+def run_on_private_loop(make_coroutine: Callable[[], Awaitable[Any]]) -> Any:
+    """Runs a coroutine to completion from synchronous code, on a private event loop closed together with its HTTP session.
+    When the calling thread already runs an event loop, e.g. a blocking helper called from a handler, asyncio.run can't be nested there,
+    so the private loop runs in a thread of its own while the caller waits.
+
+    Args:
+        make_coroutine (Callable[[], Awaitable[Any]]): called to get the coroutine, e.g. lambda: process_long_text(...).
+
+    Returns:
+        Any: the result of the coroutine.
+    """
+    async def run() -> Any:
+        try:
+            return await make_coroutine()
+        finally:
+            await close_http_clients()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run())
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='private-loop') as executor:
+        return executor.submit(asyncio.run, run()).result()
+
+# Cache configs. Set CACHE_DB_FILE to an empty string to keep the cache in memory only.
+CACHE_DB_FILE = os.environ.get('CACHE_DB_FILE', 'response_cache.sqlite3')
+CACHE_MEMORY_ENTRIES = int(os.environ.get('CACHE_MEMORY_ENTRIES', 1024))
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 30 * 24 * 3600))
+CACHE_MAX_DB_BYTES = int(os.environ.get('CACHE_MAX_DB_BYTES', 256 * 1024 * 1024))
+
+class TwoTierCache:
+    """A string cache with an in-memory LRU tier in front of an SQLite tier.
+    The SQLite tier expires entries after the TTL, and evicts the least recently used ones when the stored values exceed max_db_bytes.
+    Hits and misses are counted per namespace, which is the part of the key before the first colon.
+    The event loop uses get_async and set_async, which only touch the memory tier inline, and leave the SQLite tier to a dedicated thread.
+
+    Args:
+        db_file (Optional[str]): the SQLite file. When empty, only the memory tier is used.
+        memory_entries (int): the capacity of the memory tier.
+        ttl_seconds (float): how long an entry stays valid.
+        max_db_bytes (int): the total size of the values allowed in the SQLite tier.
+    """
+    def __init__(self, db_file: Optional[str], memory_entries: int = CACHE_MEMORY_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 max_db_bytes: int = CACHE_MAX_DB_BYTES):
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_db_bytes = max_db_bytes
+        self._memory: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        # Guards the memory tier and the counters, and is never held during disk I/O, so the event loop can take it.
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self.db_file = db_file
+        self._db = None
+        # Guards the SQLite tier.
+        self._db_lock = threading.Lock()
+        self._db_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache') if db_file else None
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Opens the SQLite tier on first use, so importing core has no side effect on the disk. Called with self._db_lock held."""
+        if self._db is None and self.db_file:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL, size INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            self._db_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        return self._db
+
+    def _count(self, key: str, outcome: str):
+        namespace = key.split(':', 1)[0]
+        counters = self._stats.setdefault(namespace, {'memory_hits': 0, 'disk_hits': 0, 'misses': 0})
+        counters[outcome] += 1
+
+    def _get_memory(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self._count(key, 'memory_hits')
+                return entry[0]
+            if not self.db_file:
+                self._count(key, 'misses')
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[str]:
+        with self._db_lock:
+            self._connect()
+            row = self._db.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] < self.ttl_seconds:
+                self._db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        with self._lock:
+            if row is not None and now - row[1] < self.ttl_seconds:
+                self._remember(key, row[0], row[1])
+                self._count(key, 'disk_hits')
+                return row[0]
+            self._count(key, 'misses')
+            return None
+
+    def _set_disk(self, key: str, value: str, now: float):
+        with self._db_lock:
+            self._connect()
+            size = len(key) + len(value.encode('UTF-8'))
+            previous = self._db.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO cache (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)', (key, value, now, now, size))
+            self._db_bytes += size - (previous[0] if previous else 0)
+            if self._db_bytes > self.max_db_bytes:
+                self._evict(now)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self.db_file:
+            value = self._get_disk(key, now)
+        return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+        if self.db_file:
+            self._set_disk(key, value, now)
+
+    async def get_async(self, key: str) -> Optional[str]:
+        """The awaitable version of get. The SQLite tier is read on the cache thread."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self.db_file:
+            value = await asyncio.wrap_future(self._executor.submit(self._get_disk, key, now))
+        return value
+
+    async def set_async(self, key: str, value: str):
+        """The awaitable version of set. The value is in the memory tier right away, and written to SQLite on the cache thread."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+        if self.db_file:
+            await asyncio.wrap_future(self._executor.submit(self._set_disk, key, value, now))
+
+    def _remember(self, key: str, value: str, created: float):
+        """Puts the value in the memory tier. Called with self._lock held."""
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        """Drops the expired entries, then the least recently used ones until the SQLite tier is back to 90% of its budget.
+        Called with self._db_lock held."""
+        self._db.execute('DELETE FROM cache WHERE created < ?', (now - self.ttl_seconds,))
+        self._db_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        target = self.max_db_bytes * 0.9
+        while self._db_bytes > target:
+            rows = self._db.execute('SELECT key, size FROM cache ORDER BY accessed LIMIT 256').fetchall()
+            if not rows:
+                break
+            self._db.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key, _ in rows])
+            self._db_bytes -= sum(size for _, size in rows)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns the hit/miss counters per namespace."""
+        with self._lock:
+            return {namespace: dict(counters) for namespace, counters in self._stats.items()}
+
+RESPONSE_CACHE = TwoTierCache(CACHE_DB_FILE)
+
+def _sha256(text: Union[str, bytes]) -> str:
+    return hashlib.sha256(text.encode('UTF-8') if isinstance(text, str) else text).hexdigest()
+
+def chat_cache_key(model: str, system_prompt: str, text: str, temperature: float = 0) -> str:
+    """The cache key of a chat completion."""
+    return f'chat:{model}:{_sha256(system_prompt)}:{_sha256(text)}:{temperature}'
+
+def transcript_cache_key(file_unique_id: Optional[str] = None, data: Optional[bytes] = None, prompt: str = '') -> str:
+    """The cache key of a transcript: the Telegram file_unique_id when available, otherwise the hash of the audio content.
+
+    Args:
+        file_unique_id (Optional[str]): the Telegram file_unique_id, which is the same when a voice note is re-sent or forwarded.
+        data (Optional[bytes]): the audio content.
+        prompt (str, optional): the Whisper prompt, since it affects the transcript.
+    """
+    if file_unique_id is not None:
+        return f'asr:telegram:{file_unique_id}:{_sha256(prompt)}'
+    return f'asr:sha256:{_sha256(bytes(data))}:{_sha256(prompt)}'
+
+class _FlightAbandoned(Exception):
+    """Set on a flight whose leader was cancelled, so that the waiting callers start a new one instead of failing."""
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class _StreamFlight:
+    """A streaming flight: the events received so far, replayed to the subscribers joining late.
+    Its task runs on the event loop of the leader, while the subscribers may be on other loops, e.g. the web app runs each request
+    on a private loop, so each waiting subscriber is woken up through its own loop.
+    """
+    __slots__ = ('loop', 'events', 'done', 'subscribers', 'task', '_waiters', '_lock')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.events: List[Tuple[str, Any]] = []
+        self.done = False
+        # The number of subscribers on each event loop.
+        self.subscribers: Dict[asyncio.AbstractEventLoop, int] = {}
+        self.task: Optional[asyncio.Task] = None
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._lock = threading.Lock()
+
+    def publish(self, event: Optional[Tuple[str, Any]] = None):
+        """Adds an event, or marks the flight as done when None, and wakes up the waiting subscribers."""
+        with self._lock:
+            if event is None:
+                self.done = True
+            else:
+                self.events.append(event)
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The loop of the subscriber was closed without leaving the stream.
+                pass
+
+    async def wait(self, seen: int):
+        """Waits until there are more than `seen` events, or the flight is done."""
+        with self._lock:
+            if len(self.events) > seen or self.done:
+                return
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        await waiter
+
+    def cancel(self):
+        """Cancels the task from any thread."""
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                self.task.cancel()
+            else:
+                self.loop.call_soon_threadsafe(self.task.cancel)
+        except RuntimeError:
+            # The loop of the leader is closed, and the task with it.
+            pass
+
+class SingleFlight:
+    """Deduplicates identical requests in flight. The first caller with a key (the leader) makes the request,
+    and the callers arriving with the same key before it lands wait for its result instead of making their own.
+    The keys are the cache keys, which already cover the operation, the model, the prompt and the input.
+    Once a flight lands, its result is in RESPONSE_CACHE, so the callers arriving later don't need the flight anymore.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Sync and async callers share these futures, so e.g. a web request can wait for the same request made by the bot.
+        self._flights: Dict[str, Future] = {}
+        # Streams are driven by a task on the loop of their leader, and shared with the subscribers of any loop.
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.deduplicated = 0
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """Returns the future of the flight with the key, and whether the caller is its leader."""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def _land(self, key: str, future: Future, result: Any = None, error: Optional[BaseException] = None):
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """Returns func(), or the result of the flight in progress with the same key. Errors are shared with the waiting callers too."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = func()
+                except Exception as e:
+                    self._land(key, future, error=e)
+                    raise
+                except BaseException:
+                    self._land(key, future, error=_FlightAbandoned())
+                    raise
+                self._land(key, future, result)
+                return result
+            try:
+                return future.result()
+            except _FlightAbandoned:
+                continue
+
+    async def do_async(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """The awaitable version of do. func is called to get the awaitable, only when the caller becomes the leader."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                try:
+                    result = await func()
+                except Exception as e:
+                    self._land(key, future, error=e)
+                    raise
+                except BaseException:
+                    # E.g. the leader was cancelled. The waiting callers were not, so one of them takes over.
+                    self._land(key, future, error=_FlightAbandoned())
+                    raise
+                self._land(key, future, result)
+                return result
+            try:
+                # Shielded, so cancelling this caller doesn't cancel the shared future.
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _FlightAbandoned:
+                continue
+
+    async def stream(self, key: str, func: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Yields the items of func(), an async generator, or of the stream in progress with the same key,
+        starting from its first item. The stream is driven by its own task, and is cancelled once all its subscribers are gone.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None:
+                flight = self._streams[key] = _StreamFlight(loop)
+                flight.task = loop.create_task(self._pump(key, flight, func()))
+            else:
+                self.deduplicated += 1
+            flight.subscribers[loop] = flight.subscribers.get(loop, 0) + 1
+        sent = 0
+        try:
+            while True:
+                if sent < len(flight.events):
+                    sent += 1
+                    yield flight.events[sent - 1]
+                elif flight.done:
+                    return
+                else:
+                    await flight.wait(sent)
+        finally:
+            with self._lock:
+                flight.subscribers[loop] -= 1
+                if not flight.subscribers[loop]:
+                    del flight.subscribers[loop]
+                abandoned = not flight.subscribers and not flight.done
+                if abandoned and self._streams.get(key) is flight:
+                    del self._streams[key]
+                # Only the subscribers of other loops are left, and they can't drive the task.
+                drive = loop is flight.loop and bool(flight.subscribers) and loop not in flight.subscribers and not flight.done
+            if abandoned:
+                flight.cancel()
+            elif drive:
+                # This loop may be closed right after, e.g. at the end of a web request, so it drives the stream to its end first.
+                await asyncio.wait([flight.task])
+
+    async def _pump(self, key: str, flight: _StreamFlight, items: AsyncIterator[Any]):
+        try:
+            async for item in items:
+                flight.publish(item)
+        finally:
+            await items.aclose()
+            with self._lock:
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+            flight.publish(None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'in_flight': len(self._flights) + len(self._streams), 'deduplicated': self.deduplicated}
+
+IN_FLIGHT = SingleFlight()
+
+# ASR configs. ASR_BACKENDS lists the backends in the order they are tried, e.g. `local,openai` to transcribe locally and fall back to the API.
+ASR_BACKENDS = os.environ.get('ASR_BACKENDS', 'openai')
+# The local engine is a faster-whisper model kept in memory. Only the notes up to LOCAL_ASR_MAX_SECONDS are taken, longer ones go to the next backend.
+LOCAL_ASR_MODEL = os.environ.get('LOCAL_ASR_MODEL', 'small')
+LOCAL_ASR_COMPUTE_TYPE = os.environ.get('LOCAL_ASR_COMPUTE_TYPE', 'int8')
+LOCAL_ASR_LANGUAGE = os.environ.get('LOCAL_ASR_LANGUAGE', 'zh') or None
+LOCAL_ASR_MAX_SECONDS = float(os.environ.get('LOCAL_ASR_MAX_SECONDS', 120))
+# Clips of the queued notes are decoded together in batches of up to LOCAL_ASR_BATCH_SIZE, waiting up to LOCAL_ASR_BATCH_WAIT_SECONDS for a batch to fill.
+LOCAL_ASR_BATCH_SIZE = int(os.environ.get('LOCAL_ASR_BATCH_SIZE', 8))
+LOCAL_ASR_BATCH_WAIT_SECONDS = float(os.environ.get('LOCAL_ASR_BATCH_WAIT_SECONDS', 0.05))
+# Whisper works on 30 seconds windows, so the notes are cut on pauses into clips a bit shorter than that.
+LOCAL_ASR_CLIP_SECONDS = 28
+
+class ASRBackendDeclined(Exception):
+    """Raised by an ASR backend which can't take the audio, e.g. because it's too long or the engine is not installed.
+    The router moves on to the next backend without logging an error."""
+
+class ASRBackend(abc.ABC):
+    """The interface of the speech recognition backends. Implement transcribe, and transcribe_async when the backend has a native async API."""
+    name = 'base'
+
+    @abc.abstractmethod
+    def transcribe(self, data: bytes, audio_format: str, prompt: str) -> str:
+        """Transcribes encoded audio.
+
+        Args:
+            data (bytes): encoded audio, in a format Whisper accepts.
+            audio_format (str): the container format of the data, e.g. ogg.
+            prompt (str): the Whisper prompt.
+
+        Returns:
+            str: the transcript.
+
+        Raises:
+            ASRBackendDeclined: when the backend can't take this audio.
+        """
+
+    async def transcribe_async(self, data: bytes, audio_format: str, prompt: str) -> str:
+        """The awaitable version of transcribe. By default, transcribe runs in a thread."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.transcribe, data, audio_format, prompt)
+
+class OpenAIASRBackend(ASRBackend):
+    """The Whisper API, through the pooled HTTP connections."""
+    name = 'openai'
+
+    def transcribe(self, data: bytes, audio_format: str, prompt: str) -> str:
+        def attempt(timeout: float):
+            # The audio endpoints of the openai library don't take a request_timeout, so the deadline is only enforced by REQUESTS.
+            with _sync_openai_slots, metrics.span('whisper'):
+                return openai.Audio.transcribe_raw('whisper-1', bytes(data), f'audio.{audio_format}', prompt=prompt)
+        return REQUESTS.run(WHISPER, 'whisper-1', attempt)['text']
+
+    async def transcribe_async(self, data: bytes, audio_format: str, prompt: str) -> str:
+        async def attempt(timeout: float):
+            async with _async_openai_slot():
+                with metrics.span('whisper'):
+                    return await openai.Audio.atranscribe_raw('whisper-1', bytes(data), f'audio.{audio_format}', prompt=prompt)
+        return (await REQUESTS.run_async(WHISPER, 'whisper-1', attempt))['text']
+
+class _LocalASRRequest(NamedTuple):
+    clips: List[np.ndarray]
+    prompt: str
+    future: Future
+
+class LocalWhisperBackend(ASRBackend):
+    """A faster-whisper model running on the CPU, loaded once and kept in memory.
+    The notes are cut into clips of less than 30 seconds, and a single worker thread decodes the clips of all the queued notes together,
+    in batches of up to batch_size. The model uses all the cores, so running several batches at the same time wouldn't be faster.
+    faster-whisper is an optional dependency: without it, the backend declines every note.
+
+    Args:
+        model_name (str): the faster-whisper model, e.g. small, or a path to a converted model.
+        compute_type (str): the CTranslate2 compute type, e.g. int8.
+        language (Optional[str]): the language of the notes. Needed for batching, since the language is detected once per batch otherwise.
+        max_seconds (float): longer notes are declined.
+        batch_size (int): maximum number of clips decoded together.
+        batch_wait_seconds (float): how long the worker waits for more notes before running a batch.
+    """
+    name = 'local'
+
+    def __init__(self, model_name: str = LOCAL_ASR_MODEL, compute_type: str = LOCAL_ASR_COMPUTE_TYPE, language: Optional[str] = LOCAL_ASR_LANGUAGE,
+                 max_seconds: float = LOCAL_ASR_MAX_SECONDS, batch_size: int = LOCAL_ASR_BATCH_SIZE, batch_wait_seconds: float = LOCAL_ASR_BATCH_WAIT_SECONDS):
+        self.model_name = model_name
+        self.compute_type = compute_type
+        self.language = language
+        self.max_seconds = max_seconds
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self._queue: 'queue.Queue[_LocalASRRequest]' = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._model = None
+        self._pipeline = None
+
+    @staticmethod
+    def available() -> bool:
+        try:
+            import faster_whisper
+        except ImportError:
+            return False
+        return True
+
+    def _submit(self, pcm: np.ndarray, prompt: str) -> Future:
+        if not self.available():
+            raise ASRBackendDeclined('faster-whisper is not installed')
+        if len(pcm) > self.max_seconds * PCM_SAMPLE_RATE:
+            raise ASRBackendDeclined(f'{len(pcm) / PCM_SAMPLE_RATE:.0f}s is longer than {self.max_seconds:.0f}s')
+        clips = [pcm[start:end] for start, end in find_chunk_boundaries(pcm, min_chunk_seconds=LOCAL_ASR_CLIP_SECONDS / 2, max_chunk_seconds=LOCAL_ASR_CLIP_SECONDS)]
+        future = Future()
+        if not clips:
+            future.set_result('')
+            return future
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='local-asr', daemon=True)
+                self._worker.start()
+        self._queue.put(_LocalASRRequest(clips, prompt, future))
+        return future
+
+    def transcribe(self, data: bytes, audio_format: str, prompt: str) -> str:
+        with metrics.span('local_asr'):
+            return self._submit(decode_audio_to_pcm(data), prompt).result()
+
+    async def transcribe_async(self, data: bytes, audio_format: str, prompt: str) -> str:
+        pcm = await decode_audio_to_pcm_async(data)
+        with metrics.span('local_asr'):
+            return await asyncio.wrap_future(self._submit(pcm, prompt))
+
+    def _load(self):
+        from faster_whisper import WhisperModel
+        self._model = WhisperModel(self.model_name, device='cpu', compute_type=self.compute_type, cpu_threads=os.cpu_count() or 0)
+        try:
+            from faster_whisper import BatchedInferencePipeline
+            self._pipeline = BatchedInferencePipeline(model=self._model)
+        except ImportError:
+            # faster-whisper before 1.1 has no batched inference. The clips are then decoded one by one.
+            self._pipeline = None
+
+    def _next_batch(self) -> List[_LocalASRRequest]:
+        """Waits for a request, then collects the requests queued shortly after it with the same prompt, up to batch_size clips."""
+        batch = [self._queue.get()]
+        clip_count = len(batch[0].clips)
+        deadline = time.monotonic() + self.batch_wait_seconds
+        postponed = []
+        while clip_count < self.batch_size:
+            try:
+                request = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            # The prompt is shared by a whole batch, so the requests with another prompt wait for the next one.
+            if request.prompt != batch[0].prompt or clip_count + len(request.clips) > max(self.batch_size, len(batch[0].clips)):
+                postponed.append(request)
+                continue
+            batch.append(request)
+            clip_count += len(request.clips)
+        for request in postponed:
+            self._queue.put(request)
+        return batch
+
+    def _run(self):
+        try:
+            self._load()
+        except Exception as e:
+            print(f'Failed to load the local ASR model {self.model_name}: {e}')
+            while True:
+                self._queue.get().future.set_exception(ASRBackendDeclined(f'the local ASR model failed to load: {e}'))
+        while True:
+            batch = self._next_batch()
+            try:
+                texts = self._transcribe_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, text in zip(batch, texts):
+                request.future.set_result(text)
+
+    def _transcribe_batch(self, batch: List[_LocalASRRequest]) -> List[str]:
+        clips = [(index, clip) for index, request in enumerate(batch) for clip in request.clips]
+        prompt = batch[0].prompt
+        texts: List[List[str]] = [[] for _ in batch]
+        if self._pipeline is None:
+            for index, clip in clips:
+                segments, _ = self._model.transcribe(clip.astype(np.float32) / 32768, language=self.language, initial_prompt=prompt, beam_size=1, vad_filter=False)
+                texts[index].extend(segment.text for segment in segments)
+            return [join_transcripts(parts) for parts in texts]
+
+        # The clips are laid end to end in one signal, and clip_timestamps tells the pipeline where each of them is.
+        audio = np.concatenate([clip for _, clip in clips]).astype(np.float32) / 32768
+        clip_timestamps, owners, offset = [], [], 0
+        for index, clip in clips:
+            clip_timestamps.append({'start': offset, 'end': offset + len(clip)})
+            owners.append(index)
+            offset += len(clip)
+        ends = np.array([clip['end'] for clip in clip_timestamps]) / PCM_SAMPLE_RATE
+        segments, _ = self._pipeline.transcribe(audio, language=self.language, initial_prompt=prompt, clip_timestamps=clip_timestamps,
+                                                batch_size=self.batch_size, beam_size=1, without_timestamps=True)
+        for segment in segments:
+            # The segments are reported in seconds of the concatenated signal, so they are assigned to the clip containing their middle.
+            clip_index = min(int(np.searchsorted(ends, (segment.start + segment.end) / 2, side='right')), len(owners) - 1)
+            texts[owners[clip_index]].append(segment.text)
+        return [join_transcripts(parts) for parts in texts]
+
+class ASRRouter:
+    """Sends the transcriptions to the backends in order, falling back to the next one when a backend declines or fails.
+
+    Args:
+        backends (List[ASRBackend]): the backends, in the order they are tried.
+    """
+    def __init__(self, backends: List[ASRBackend]):
+        if not backends:
+            raise ValueError('At least one ASR backend is needed')
+        self.backends = backends
+
+    @classmethod
+    def from_config(cls, config: str = ASR_BACKENDS) -> 'ASRRouter':
+        """Creates the router from a comma separated list of the names in ASR_BACKEND_FACTORIES."""
+        return cls([ASR_BACKEND_FACTORIES[name.strip()]() for name in config.split(',') if name.strip()])
+
+    def _failed(self, backend: ASRBackend, error: Exception, is_last: bool):
+        if is_last:
+            raise error
+        if not isinstance(error, ASRBackendDeclined):
+            print(f'ASR backend {backend.name} failed, falling back: {error}')
+
+    def transcribe(self, data: bytes, audio_format: str, prompt: str) -> str:
+        for i, backend in enumerate(self.backends):
+            try:
+                text = backend.transcribe(data, audio_format, prompt)
+            except Exception as e:
+                self._failed(backend, e, i == len(self.backends) - 1)
+                continue
+            metrics.annotate(asr_backend=backend.name)
+            return text
+
+    async def transcribe_async(self, data: bytes, audio_format: str, prompt: str) -> str:
+        for i, backend in enumerate(self.backends):
+            try:
+                text = await backend.transcribe_async(data, audio_format, prompt)
+            except Exception as e:
+                self._failed(backend, e, i == len(self.backends) - 1)
+                continue
+            metrics.annotate(asr_backend=backend.name)
+            return text
+
+# The backends available to ASR_BACKENDS. Register more (e.g. a fake one for offline tests) before ASR_ROUTER is rebuilt.
+ASR_BACKEND_FACTORIES: Dict[str, Callable[[], ASRBackend]] = {
+    'openai': OpenAIASRBackend,
+    'local': LocalWhisperBackend,
+}
+ASR_ROUTER = ASRRouter.from_config()
 
 def transcribe_voice_message(filename: str) -> str:
-    """Invoke the Whisper ASR API to transcribe the voice message to text.
+    """Transcribe the voice message to text with the ASR backends.
+
+    Args:
+        filename (str): filename of the voice message. Note it has to be compatible with Whisper ASR API.
+
+    Returns:
+        str: Transcribed text.
+    """
+    with open(filename, 'rb') as file:
+        data = file.read()
+    return transcribe_voice_data(data, os.path.splitext(filename)[1].lstrip('.'))
+
+async def transcribe_voice_message_async(filename: str) -> str:
+    """The awaitable version of transcribe_voice_message.
 
     Args:
         filename (str): filename of the voice message. Note it has to be compatible with Whisper ASR API.
@@ -21,9 +797,54 @@ def transcribe_voice_message(filename: str) -> str:
         str: Transcribed text.
     """
     with open(filename, 'rb') as file:
-        whisper_response = openai.Audio.transcribe('whisper-1', file, prompt='简体中文')
-    transcribed_text = whisper_response['text']
-    return transcribed_text
+        data = file.read()
+    return await transcribe_voice_data_async(data, os.path.splitext(filename)[1].lstrip('.'))
+
+def transcribe_voice_data(data: bytes, audio_format: str, prompt: str = '简体中文') -> str:
+    """Transcribe in-memory audio to text with the ASR backends of ASR_ROUTER (by default, the Whisper API).
+
+    Args:
+        data (bytes): encoded audio. It has to be in a format compatible with Whisper ASR API.
+        audio_format (str): the container format of the data, e.g. mp3. It is used as the file extension for the upload.
+        prompt (str, optional): the Whisper prompt, used to hint the language.
+
+    Returns:
+        str: Transcribed text.
+    """
+    cache_key = transcript_cache_key(data=data, prompt=prompt)
+
+    def transcribe() -> str:
+        transcribed_text = RESPONSE_CACHE.get(cache_key)
+        if transcribed_text is not None:
+            return transcribed_text
+        transcribed_text = ASR_ROUTER.transcribe(data, audio_format, prompt)
+        RESPONSE_CACHE.set(cache_key, transcribed_text)
+        return transcribed_text
+
+    return IN_FLIGHT.do(cache_key, transcribe)
+
+async def transcribe_voice_data_async(data: bytes, audio_format: str, prompt: str = '简体中文') -> str:
+    """The awaitable version of transcribe_voice_data.
+
+    Args:
+        data (bytes): encoded audio. It has to be in a format compatible with Whisper ASR API.
+        audio_format (str): the container format of the data, e.g. mp3. It is used as the file extension for the upload.
+        prompt (str, optional): the Whisper prompt, used to hint the language.
+
+    Returns:
+        str: Transcribed text.
+    """
+    cache_key = transcript_cache_key(data=data, prompt=prompt)
+
+    async def transcribe() -> str:
+        transcribed_text = await RESPONSE_CACHE.get_async(cache_key)
+        if transcribed_text is not None:
+            return transcribed_text
+        transcribed_text = await ASR_ROUTER.transcribe_async(data, audio_format, prompt)
+        await RESPONSE_CACHE.set_async(cache_key, transcribed_text)
+        return transcribed_text
+
+    return await IN_FLIGHT.do_async(cache_key, transcribe)
 
 def classify_outline_content(text: str) -> Dict[str, str]:
     """Invokes GPT-3.5 API to tell the actual content of the request.
@@ -33,6 +854,20 @@ def classify_outline_content(text: str) -> Dict[str, str]:
     Returns:
     """
     parse_result = gpt_process_text(text, PROMPTS['outline-content-classification'], model='gpt-3.5-turbo')
+    return _parse_outline_content(text, parse_result)
+
+async def classify_outline_content_async(text: str) -> Dict[str, str]:
+    """The awaitable version of classify_outline_content.
+    Args:
+        text (str): the initial transcribed text to be processed.
+
+    Returns:
+        Dict[str, str]: the parsed intent, with the `intent`, `line` and `content` fields.
+    """
+    parse_result = await gpt_process_text_full_async(text, PROMPTS['outline-content-classification'], model='gpt-3.5-turbo')
+    return _parse_outline_content(text, parse_result)
+
+def _parse_outline_content(text: str, parse_result: str) -> Dict[str, str]:
     try:
         parse_result = json.loads(parse_result)
     except json.decoder.JSONDecodeError:
@@ -40,19 +875,166 @@ def classify_outline_content(text: str) -> Dict[str, str]:
         parse_result = {'content': text, 'intent': 'append', 'line': -1}
     return parse_result
 
+# The outline mode is triggered by a tiny, closed set of phrases (see PROMPTS['outline-intent-classification']),
+# so most utterances can be classified locally. The phrases are compared after normalize_utterance.
+OUTLINE_INTENT_PHRASES = {
+    True: ['进入草稿模式', '草稿模式', '草稿', '开始草稿', '打开草稿模式', '开启草稿模式', '切换到草稿模式', '进入草稿',
+           '进入大纲模式', '大纲模式', '进入提纲模式', 'enter outline mode', 'outline mode', 'outline', 'enter draft mode', 'draft mode'],
+    False: ['这个草稿不完整', '草稿不完整', '退出草稿模式', '退出大纲模式', 'exit outline mode', '结束草稿模式'],
+}
+# Fillers around the command that do not change the intent.
+# The spaces are already stripped when they are removed, so "let us" is matched as "letus".
+_UTTERANCE_FILLERS = re.compile(r'^(请|嗯|那个|我要|我想|帮我|please|lets|letus)+|(吧|啊|呀|了|呢|一下|please)+$')
+# Negations turning a trigger phrase around, e.g. 不要进入草稿模式, matched on the normalized text.
+_UTTERANCE_NEGATIONS = re.compile(r'不要|不用|不想|不需要|不必|别|dont|donot|never')
+
+def normalize_utterance(text: str) -> str:
+    """Normalizes the ASR output for the phrase matching: full-width to half-width, lower case, no punctuation, spaces or fillers."""
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = ''.join(c for c in text if c.isalnum())
+    return _UTTERANCE_FILLERS.sub('', text)
+
+class PhraseTrie:
+    """A character trie of labelled phrases, supporting exact lookup and bounded edit-distance search."""
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, phrase: str, label):
+        node = self.root
+        for c in phrase:
+            node = node.setdefault(c, {})
+        # None can never be a character, so it is used as the key of the label.
+        node[None] = (phrase, label)
+
+    def lookup(self, text: str):
+        """Returns the (phrase, label) stored for exactly this text, or None."""
+        node = self.root
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def search(self, text: str, max_distance: int) -> Optional[Tuple[str, object, int]]:
+        """Finds the phrase closest to the text in Levenshtein distance, not further than max_distance.
+        The dynamic programming rows are shared along the common prefixes, and branches whose row minimum exceeds the best distance are pruned.
+
+        Returns:
+            Optional[Tuple[str, object, int]]: the phrase, its label and the distance, or None if nothing is close enough.
+            The label is None when phrases with different labels are equally close.
+        """
+        best = None
+        best_distance = max_distance
+        first_row = list(range(len(text) + 1))
+        stack = [(child, c, first_row) for c, child in self.root.items() if c is not None]
+        while stack:
+            node, c, previous_row = stack.pop()
+            row = [previous_row[0] + 1]
+            for i in range(1, len(text) + 1):
+                row.append(min(row[i - 1] + 1, previous_row[i] + 1, previous_row[i - 1] + (text[i - 1] != c)))
+            if None in node and row[-1] <= best_distance:
+                if best is None or row[-1] < best[2]:
+                    best = (node[None][0], node[None][1], row[-1])
+                    best_distance = row[-1]
+                elif node[None][1] != best[1]:
+                    best = (best[0], None, best[2])
+            if min(row) <= best_distance:
+                stack.extend((child, cc, row) for cc, child in node.items() if cc is not None)
+        return best
+
+class OutlineIntentClassifier:
+    """Tells locally whether an utterance is an outline mode trigger, with a confidence score.
+    Only the utterances in the ambiguous band need the GPT classification.
+
+    Args:
+        phrases (Dict[bool, List[str]]): labelled trigger and non-trigger phrases.
+        accept_similarity (float): the similarity to the closest phrase from which its label is trusted. At 0.8, one edit is allowed every 5 characters,
+            so e.g. 草莓模式 is not taken for 草稿模式.
+        reject_similarity (float): the similarity below which the utterance is not a trigger.
+        max_length (int): utterances longer than this (in characters, before normalization) are never triggers.
+    """
+    def __init__(self, phrases: Dict[bool, List[str]] = OUTLINE_INTENT_PHRASES, accept_similarity: float = 0.8,
+                 reject_similarity: float = 0.4, max_length: int = 30):
+        self.trie = PhraseTrie()
+        for label, label_phrases in phrases.items():
+            for phrase in label_phrases:
+                self.trie.insert(normalize_utterance(phrase), label)
+        self.accept_similarity = accept_similarity
+        self.reject_similarity = reject_similarity
+        self.max_length = max_length
+
+    def match(self, text: str) -> Tuple[Optional[bool], float]:
+        """Finds the closest known phrase.
+
+        Returns:
+            Tuple[Optional[bool], float]: the label of the closest phrase (None if the closest phrases disagree), and the similarity in [0, 1].
+        """
+        if len(text) > self.max_length:
+            # A small trick is, because the outline mode triggering word is so short, we can directly tell outline mode is not the intent when the text is too long.
+            return False, 0.0
+        normalized = normalize_utterance(text)
+        if not normalized:
+            return False, 0.0
+        exact = self.trie.lookup(normalized)
+        if exact is not None:
+            return exact[1], 1.0
+        match = self.trie.search(normalized, max_distance=len(normalized))
+        if match is None:
+            return False, 0.0
+        phrase, label, distance = match
+        return label, 1 - distance / max(len(normalized), len(phrase))
+
+    def classify(self, text: str) -> Tuple[Optional[bool], float]:
+        """Classifies the utterance locally.
+
+        Returns:
+            Tuple[Optional[bool], float]: whether it's an outline mode trigger, or None when it's in the ambiguous band, and the confidence in [0, 1].
+        """
+        label, similarity = self.match(text)
+        if similarity < self.reject_similarity:
+            # Far from every known phrase, so it's confidently not a trigger.
+            return False, 1 - similarity
+        if label is not None and similarity >= self.accept_similarity:
+            if label and _UTTERANCE_NEGATIONS.search(normalize_utterance(text)):
+                # Close to a trigger, but negated, so GPT decides.
+                return None, similarity
+            return label, similarity
+        return None, similarity
+
+OUTLINE_INTENT_CLASSIFIER = OutlineIntentClassifier()
+
 def classify_outline_intent_mode(text: str) -> bool:
-    """Invokes GPT-3.5 API to tell whether the intent of the given text is to enter the outline mode.
+    """Tells whether the intent of the given text is to enter the outline mode.
+    It's classified locally when possible, and GPT-3.5 API is only invoked for the ambiguous utterances.
     Args:
         text (str): the initial transcribed text to be processed.
 
     Returns:
         bool: whether the intent of the given text is to enter the outline mode.
     """
-    if len(text) > 30:
-        # A small trick is, because the outline mode triggering word is so short, we can directly tell outline mode is not the intent when the text is too long.
-        return False
-    processed_text = gpt_process_text(text, PROMPTS['outline-intent-classification'], model='gpt-3.5-turbo')
-    return processed_text == 'True'
+    with metrics.span('outline_intent'):
+        is_outline_intent, _ = OUTLINE_INTENT_CLASSIFIER.classify(text)
+        metrics.annotate(outline_intent_local=is_outline_intent is not None)
+        if is_outline_intent is not None:
+            return is_outline_intent
+        processed_text = gpt_process_text(text, PROMPTS['outline-intent-classification'], model='gpt-3.5-turbo')
+        return processed_text == 'True'
+
+async def classify_outline_intent_mode_async(text: str) -> bool:
+    """The awaitable version of classify_outline_intent_mode.
+    Args:
+        text (str): the initial transcribed text to be processed.
+
+    Returns:
+        bool: whether the intent of the given text is to enter the outline mode.
+    """
+    with metrics.span('outline_intent'):
+        is_outline_intent, _ = OUTLINE_INTENT_CLASSIFIER.classify(text)
+        metrics.annotate(outline_intent_local=is_outline_intent is not None)
+        if is_outline_intent is not None:
+            return is_outline_intent
+        processed_text = await gpt_process_text_full_async(text, PROMPTS['outline-intent-classification'], model='gpt-3.5-turbo')
+        return processed_text == 'True'
 
 def preprocess_text(text: str) -> str:
     """Invokes GPT-3.5 API to preprocess the text.
@@ -65,17 +1047,18 @@ def preprocess_text(text: str) -> str:
     Returns:
         str: paraphrased text.
     """
-    response = openai.ChatCompletion.create(
-        model='gpt-3.5-turbo',
-        messages=[
-            {"role": "system", "content": PROMPTS['transcribe-and-parse']},
-            {"role": "user", "content": text},
-        ],
-        temperature=0,
-    )
+    return gpt_process_text(text, PROMPTS['transcribe-and-parse'], model='gpt-3.5-turbo')
+
+async def preprocess_text_async(text: str) -> str:
+    """The awaitable version of preprocess_text.
 
-    processed_text = response.choices[0].message.content.strip()
-    return processed_text
+    Args:
+        text (str): the initial transcribed text to be processed.
+
+    Returns:
+        str: paraphrased text.
+    """
+    return await gpt_process_text_full_async(text, PROMPTS['transcribe-and-parse'], model='gpt-3.5-turbo')
 
 def gpt_iterate_on_thoughts(text: str, target_usage: str) -> str:
     """Invokes GPT-4 API to iterate on thoughts, using the provided target usage, which is expected to be one of the keys in the CHOINCE_TO_PROMPT.
@@ -91,9 +1074,200 @@ def gpt_iterate_on_thoughts(text: str, target_usage: str) -> str:
         raise ValueError(f"Invalid target usage: {target_usage}")
     return gpt_process_text(text, system_prompt=CHOICE_TO_PROMPT[target_usage], model='gpt-4')
 
+async def gpt_iterate_on_thoughts_async(text: str, target_usage: str) -> str:
+    """The awaitable version of gpt_iterate_on_thoughts.
+
+    Args:
+        text (str): the input text.
+        target_usage (str): the target usage of the text.
+
+    Returns:
+        str: processed text/thought.
+    """
+    if target_usage not in CHOICE_TO_PROMPT:
+        raise ValueError(f"Invalid target usage: {target_usage}")
+    return await gpt_process_text_full_async(text, system_prompt=CHOICE_TO_PROMPT[target_usage], model='gpt-4')
+
+# The kinds of the events yielded by gpt_process_text_async.
+STREAM_DELTA = 'delta'
+STREAM_USAGE = 'usage'
+STREAM_FINISH = 'finish'
+STREAM_ERROR = 'error'
+
+class TextBuffer:
+    """Accumulates streamed text. Appending costs the length of the delta, and the full text is only joined when asked for."""
+    __slots__ = ('_parts', '_length')
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._length = 0
+
+    def append(self, delta: str):
+        self._parts.append(delta)
+        self._length += len(delta)
+
+    def __len__(self) -> int:
+        return self._length
 
-async def gpt_process_text_async(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4') -> Tuple[str, str]:
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            # Keep the joined text, so asking again costs nothing until more deltas arrive.
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ''
+
+class StreamEvent(NamedTuple):
+    """An event of gpt_process_text_async.
+    * STREAM_DELTA: data is the new piece of text.
+    * STREAM_USAGE: data is a dict of token counts.
+    * STREAM_FINISH: data is the finish reason. It's always the last event of a successful stream.
+    * STREAM_ERROR: data is the exception. It's the last event of a failed stream.
+    buffer is the accumulated output so far, only set when the stream was started with accumulate=True.
+    """
+    kind: str
+    data: Any = None
+    buffer: Optional[TextBuffer] = None
+
+    @property
+    def text(self) -> Optional[str]:
+        """The accumulated output so far, when the stream was started with accumulate=True."""
+        return self.buffer.text if self.buffer is not None else None
+
+async def gpt_process_text_async(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4', accumulate: bool = False) -> AsyncIterator[StreamEvent]:
     """Invokes GPT-4 API to process the text in stream mode.
+    Only the new piece of text is yielded for each token, so the cost per token doesn't grow with the output length.
+    Identical streams in flight are shared: a caller joining late first gets the deltas received so far.
+    Long texts are processed in chunks, see process_long_text_stream.
+
+    Args:
+        text (str): the transcribed text to be paraphrased.
+        system_prompt (str): the system prompt to be used. Defaults to PROMPTS['paraphrase'].
+        model (str, optional): the GPT model to be used. Defaults to 'gpt-4'.
+        accumulate (bool, optional): whether the events carry the accumulated output in StreamEvent.buffer. Defaults to False.
+
+    Yields:
+        StreamEvent: the deltas, then the usage and the finish reason, or an error.
+    """
+    buffer = TextBuffer() if accumulate else None
+    if is_long_text(text, model):
+        events = process_long_text_stream(text, system_prompt, model)
+    else:
+        cache_key = chat_cache_key(model, system_prompt, text)
+        cached_answer = await RESPONSE_CACHE.get_async(cache_key)
+        if cached_answer is not None:
+            if buffer is not None:
+                buffer.append(cached_answer)
+            yield StreamEvent(STREAM_DELTA, cached_answer, buffer)
+            yield StreamEvent(STREAM_FINISH, 'stop', buffer)
+            return
+        events = IN_FLIGHT.stream('stream:' + cache_key, lambda: _gpt_stream(text, system_prompt, model, cache_key))
+    try:
+        async for kind, data in events:
+            if kind == STREAM_DELTA and buffer is not None:
+                buffer.append(data)
+            yield StreamEvent(kind, data, buffer)
+    finally:
+        # Leaves the shared stream right away when the caller stops early, e.g. when the paraphrase is cancelled.
+        await events.aclose()
+
+class _OpenStream:
+    """A streaming completion whose first content has arrived. It holds a request slot of the event loop until closed.
+
+    Args:
+        gen: the stream of the openai library.
+        items (List): the items read to reach the first content.
+        start (float): the perf_counter value when the request was sent.
+        semaphore (asyncio.Semaphore): the slot to release when closed.
+    """
+    def __init__(self, gen, items: List[Any], start: float, semaphore: asyncio.Semaphore):
+        self.gen = gen
+        self.items = items
+        self.start = start
+        self._semaphore: Optional[asyncio.Semaphore] = semaphore
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+        async for item in self.gen:
+            yield item
+
+    async def aclose(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+            self._semaphore = None
+            await self.gen.aclose()
+
+async def _open_gpt_stream(text: str, system_prompt: str, model: str, timeout: float) -> _OpenStream:
+    """An attempt of gpt_process_text_async: sends the request, and reads the stream until the first content, or its end.
+    That's the part which is retried and hedged, since nothing was shown to the user yet.
+    """
+    session, semaphore = _async_http_client()
+    # The slot is held until the stream is closed, because the connection is busy until then.
+    await semaphore.acquire()
+    try:
+        # Measured from the moment a connection slot is free, so the time waiting for a slot doesn't count as the latency of the API.
+        start = time.perf_counter()
+        with _use_async_http_session(session):
+            gen = await openai.ChatCompletion.acreate(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": text},
+                ],
+                stream=True,
+                temperature=0,
+                request_timeout=timeout,
+            )
+        items = []
+        async for item in gen:
+            items.append(item)
+            choice = item.choices[0]
+            if choice.delta.get('content') or choice.get('finish_reason'):
+                break
+        return _OpenStream(gen, items, start, semaphore)
+    except BaseException:
+        semaphore.release()
+        raise
+
+async def _gpt_stream(text: str, system_prompt: str, model: str, cache_key: str) -> AsyncIterator[Tuple[str, Any]]:
+    """Makes the streaming request of gpt_process_text_async, yielding (kind, data) pairs."""
+    buffer = TextBuffer()
+    finish_reason = None
+    chunk_count = 0
+    try:
+        stream = await REQUESTS.run_async(CHAT_FIRST_TOKEN, model, functools.partial(_open_gpt_stream, text, system_prompt, model),
+                                          discard=_OpenStream.aclose)
+    except Exception as e:
+        yield STREAM_ERROR, e
+        return
+    try:
+        async for item in stream:
+            choice = item.choices[0]
+            delta = choice.delta
+            if "content" in delta and delta.content:
+                buffer.append(delta.content)
+                chunk_count += 1
+                if chunk_count == 1:
+                    metrics.record_stage('gpt_first_token', time.perf_counter() - stream.start, stream.start)
+                yield STREAM_DELTA, delta.content
+            if choice.get('finish_reason'):
+                finish_reason = choice.finish_reason
+    except Exception as e:
+        yield STREAM_ERROR, e
+        return
+    finally:
+        metrics.record_stage('gpt_stream', time.perf_counter() - stream.start, stream.start)
+        await stream.aclose()
+
+    # Cached as it was streamed, so a cached answer replays the same text. The full completions strip it when they read it.
+    await RESPONSE_CACHE.set_async(cache_key, buffer.text)
+    # The streaming API doesn't report usage, but each chunk carries one token.
+    metrics.count_tokens(model, 'completion', chunk_count)
+    yield STREAM_USAGE, {'completion_tokens': chunk_count}
+    yield STREAM_FINISH, finish_reason or 'stop'
+
+async def gpt_process_text_full_async(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4') -> str:
+    """The awaitable version of gpt_process_text. Unlike gpt_process_text_async, it returns the whole output at once.
 
     Args:
         text (str): the transcribed text to be paraphrased.
@@ -103,25 +1277,41 @@ async def gpt_process_text_async(text: str, system_prompt: str = PROMPTS['paraph
     Returns:
         str: output text.
     """
-    gen = await openai.ChatCompletion.acreate(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text},
-        ],
-        stream=True,
-        temperature=0,
-    )
+    if is_long_text(text, model):
+        return await process_long_text(text, system_prompt, model)
+    cache_key = chat_cache_key(model, system_prompt, text)
 
+    async def complete() -> str:
+        processed_text = await RESPONSE_CACHE.get_async(cache_key)
+        if processed_text is not None:
+            return processed_text.strip()
+        async def attempt(timeout: float):
+            async with _async_openai_slot():
+                with metrics.span('gpt_completion'):
+                    return await openai.ChatCompletion.acreate(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": text},
+                        ],
+                        temperature=0,
+                        request_timeout=timeout,
+                    )
 
-    answer = ""
-    async for item in gen:
-        delta = item.choices[0].delta
-        if "content" in delta:
-            answer += delta.content
-            yield "not_finished", answer
+        response = await REQUESTS.run_async(CHAT, model, attempt)
+        _count_usage(model, response)
+        # The cache holds the output as it came, like the streams store it, see _gpt_stream.
+        processed_text = response.choices[0].message.content
+        await RESPONSE_CACHE.set_async(cache_key, processed_text)
+        return processed_text.strip()
 
-    yield "finished", answer,
+    return await IN_FLIGHT.do_async(cache_key, complete)
+
+def _count_usage(model: str, response):
+    usage = response.get('usage')
+    if usage:
+        metrics.count_tokens(model, 'prompt', usage.get('prompt_tokens', 0))
+        metrics.count_tokens(model, 'completion', usage.get('completion_tokens', 0))
 
 def gpt_process_text(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4') -> str:
     """Invokes GPT-4 API to process the text.
@@ -134,17 +1324,253 @@ def gpt_process_text(text: str, system_prompt: str = PROMPTS['paraphrase'], mode
     Returns:
         str: output text.
     """
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text},
-        ],
-        temperature=0,
-    )
+    if is_long_text(text, model):
+        return run_on_private_loop(lambda: process_long_text(text, system_prompt, model))
+    cache_key = chat_cache_key(model, system_prompt, text)
+
+    def complete() -> str:
+        processed_text = RESPONSE_CACHE.get(cache_key)
+        if processed_text is not None:
+            return processed_text.strip()
+        def attempt(timeout: float):
+            with _sync_openai_slots, metrics.span('gpt_completion'):
+                return openai.ChatCompletion.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": text},
+                    ],
+                    temperature=0,
+                    request_timeout=timeout,
+                )
+
+        response = REQUESTS.run(CHAT, model, attempt)
+        _count_usage(model, response)
+        processed_text = response.choices[0].message.content
+        RESPONSE_CACHE.set(cache_key, processed_text)
+        return processed_text.strip()
+
+    return IN_FLIGHT.do(cache_key, complete)
+
+# tiktoken encoders per model, or None when tiktoken isn't installed.
+_token_encoders: Dict[str, Any] = {}
+_CJK_CHARACTER = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]')
+# A sentence ends with Chinese or English end punctuation (the English period only before a space, so numbers like 3.5 stay whole),
+# or with a line break.
+_SENTENCE = re.compile(r'.+?(?:[。！？!?；…\n]+|[.;](?=\s)|$)', re.S)
+_CLAUSE = re.compile(r'.+?(?:[，,、：:]+|\s+|$)', re.S)
+
+def _token_encoder(model: str):
+    if model not in _token_encoders:
+        try:
+            import tiktoken
+        except ImportError:
+            _token_encoders[model] = None
+        else:
+            try:
+                _token_encoders[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _token_encoders[model] = tiktoken.get_encoding('cl100k_base')
+    return _token_encoders[model]
+
+def count_text_tokens(text: str, model: str = 'gpt-4') -> int:
+    """Counts the tokens of the text for the model, locally. Uses tiktoken when it's installed,
+    otherwise estimates 1.5 tokens per CJK character and one token per 4 other characters, which errs on the high side.
+
+    Args:
+        text (str): the text.
+        model (str, optional): the GPT model. Defaults to 'gpt-4'.
+
+    Returns:
+        int: number of tokens.
+    """
+    encoder = _token_encoder(model)
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    cjk = len(_CJK_CHARACTER.findall(text))
+    return cjk * 3 // 2 + (len(text) - cjk + 3) // 4
+
+def is_long_text(text: str, model: str = 'gpt-4') -> bool:
+    """Tells whether the text is long enough to be processed in chunks."""
+    return count_text_tokens(text, model) > LONG_INPUT_MIN_TOKENS
+
+class TextChunk(NamedTuple):
+    """A chunk of a long text, see split_text_for_model.
+    context is the end of the previous chunk, given to GPT for reference only.
+    """
+    text: str
+    context: str = ''
+
+def _split_long_sentence(sentence: str, max_tokens: int, model: str) -> List[Tuple[str, int]]:
+    """Splits a sentence longer than max_tokens at commas or spaces, and when there is none, e.g. in a transcript without punctuation, by length."""
+    pieces = []
+    current, current_tokens = '', 0
+    for clause in _CLAUSE.findall(sentence):
+        tokens = count_text_tokens(clause, model)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append((current, current_tokens))
+            current, current_tokens = '', 0
+        while tokens > max_tokens:
+            cut = max(1, len(clause) * max_tokens // tokens)
+            pieces.append((clause[:cut], count_text_tokens(clause[:cut], model)))
+            clause = clause[cut:]
+            tokens = count_text_tokens(clause, model)
+        current += clause
+        current_tokens += tokens
+    if current:
+        pieces.append((current, current_tokens))
+    return pieces
+
+def split_text_for_model(text: str, model: str = 'gpt-4', max_tokens: int = LONG_INPUT_CHUNK_TOKENS,
+                         overlap_tokens: int = LONG_INPUT_OVERLAP_TOKENS) -> List[TextChunk]:
+    """Splits a long text into chunks of at most max_tokens, at sentence boundaries.
+    Each chunk after the first carries the last sentences of the previous one, up to overlap_tokens, as context.
+
+    Args:
+        text (str): the text.
+        model (str, optional): the GPT model the tokens are counted for. Defaults to 'gpt-4'.
+        max_tokens (int, optional): the maximum size of a chunk, not counting its context.
+        overlap_tokens (int, optional): the maximum size of the context of a chunk.
+
+    Returns:
+        List[TextChunk]: the chunks, in order.
+    """
+    sentences: List[Tuple[str, int]] = []
+    for sentence in _SENTENCE.findall(text):
+        tokens = count_text_tokens(sentence, model)
+        if tokens > max_tokens:
+            sentences.extend(_split_long_sentence(sentence, max_tokens, model))
+        else:
+            sentences.append((sentence, tokens))
+
+    groups: List[List[Tuple[str, int]]] = []
+    current: List[Tuple[str, int]] = []
+    current_tokens = 0
+    for sentence, tokens in sentences:
+        if current and current_tokens + tokens > max_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append((sentence, tokens))
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+
+    chunks = []
+    for index, group in enumerate(groups):
+        context: List[str] = []
+        context_tokens = 0
+        for sentence, tokens in reversed(groups[index - 1] if index > 0 else []):
+            if context_tokens + tokens > overlap_tokens:
+                break
+            context.insert(0, sentence)
+            context_tokens += tokens
+        chunks.append(TextChunk(''.join(sentence for sentence, _ in group).strip(), ''.join(context).strip()))
+    return chunks
+
+def _chunk_message(chunk: TextChunk) -> str:
+    if not chunk.context:
+        return chunk.text
+    return PROMPTS['long-input-chunk-user-template'].format(context=chunk.context, text=chunk.text)
+
+def _reduce_message(partial_outputs: List[str]) -> str:
+    parts = '\n\n'.join(f'PART {index + 1}:\n{output}' for index, output in enumerate(partial_outputs))
+    return PROMPTS['long-input-reduce-user-template'].format(parts=parts)
+
+async def _map_chunks(text: str, system_prompt: str, model: str) -> List[str]:
+    chunks = split_text_for_model(text, model)
+    metrics.annotate(long_input_chunks=len(chunks))
+    with metrics.span('gpt_map'):
+        return await asyncio.gather(*(gpt_process_text_full_async(_chunk_message(chunk), system_prompt, model) for chunk in chunks))
+
+async def process_long_text(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4') -> str:
+    """Processes a long text in chunks: each chunk is sent concurrently with the same system prompt, and the outputs are joined in order.
+    For the prompts in GLOBAL_VIEW_PROMPTS, e.g. summaries, the outputs of the chunks are merged by a final reduce call instead.
+    When the outputs are long enough together, the reduce call is itself processed in chunks.
+
+    Args:
+        text (str): the input text.
+        system_prompt (str): the system prompt to be used. Defaults to PROMPTS['paraphrase'].
+        model (str, optional): the GPT model to be used. Defaults to 'gpt-4'.
+
+    Returns:
+        str: output text.
+    """
+    partial_outputs = await _map_chunks(text, system_prompt, model)
+    if system_prompt in GLOBAL_VIEW_PROMPTS and len(partial_outputs) > 1:
+        return await gpt_process_text_full_async(_reduce_message(partial_outputs), system_prompt, model)
+    return '\n\n'.join(partial_outputs)
+
+async def process_long_text_stream(text: str, system_prompt: str = PROMPTS['paraphrase'], model: str = 'gpt-4') -> AsyncIterator[Tuple[str, Any]]:
+    """The streaming version of process_long_text, yielding (kind, data) pairs like the events of gpt_process_text_async.
+    All the chunks are streamed at the same time. The deltas of the first chunk are yielded as they come,
+    and those of the next chunks are held back until the chunks before them are done, so the output stays in order.
+    For the prompts in GLOBAL_VIEW_PROMPTS, the chunks are processed first and the reduce call is streamed.
+
+    Args:
+        text (str): the input text.
+        system_prompt (str): the system prompt to be used. Defaults to PROMPTS['paraphrase'].
+        model (str, optional): the GPT model to be used. Defaults to 'gpt-4'.
+
+    Yields:
+        Tuple[str, Any]: the deltas, then the usage and the finish reason, or an error.
+    """
+    if system_prompt in GLOBAL_VIEW_PROMPTS:
+        try:
+            partial_outputs = await _map_chunks(text, system_prompt, model)
+        except Exception as e:
+            yield STREAM_ERROR, e
+            return
+        if len(partial_outputs) == 1:
+            yield STREAM_DELTA, partial_outputs[0]
+            yield STREAM_FINISH, 'stop'
+            return
+        events = gpt_process_text_async(_reduce_message(partial_outputs), system_prompt, model)
+        try:
+            async for event in events:
+                yield event.kind, event.data
+        finally:
+            await events.aclose()
+        return
+
+    chunks = split_text_for_model(text, model)
+    metrics.annotate(long_input_chunks=len(chunks))
+    queues: List[asyncio.Queue] = [asyncio.Queue() for _ in chunks]
 
-    processed_text = response.choices[0].message.content.strip()
-    return processed_text
+    async def pump(chunk: TextChunk, events_queue: asyncio.Queue):
+        events = gpt_process_text_async(_chunk_message(chunk), system_prompt, model)
+        try:
+            async for event in events:
+                events_queue.put_nowait(event)
+        except Exception as e:
+            events_queue.put_nowait(StreamEvent(STREAM_ERROR, e))
+        finally:
+            await events.aclose()
+
+    tasks = [asyncio.create_task(pump(chunk, events_queue)) for chunk, events_queue in zip(chunks, queues)]
+    completion_tokens = 0
+    finish_reason = 'stop'
+    try:
+        for index, events_queue in enumerate(queues):
+            if index > 0:
+                yield STREAM_DELTA, '\n\n'
+            while True:
+                event = await events_queue.get()
+                if event.kind == STREAM_DELTA:
+                    yield STREAM_DELTA, event.data
+                elif event.kind == STREAM_USAGE:
+                    completion_tokens += event.data.get('completion_tokens', 0)
+                elif event.kind == STREAM_ERROR:
+                    yield STREAM_ERROR, event.data
+                    return
+                elif event.kind == STREAM_FINISH:
+                    if event.data != 'stop':
+                        finish_reason = event.data
+                    break
+    finally:
+        for task in tasks:
+            task.cancel()
+    yield STREAM_USAGE, {'completion_tokens': completion_tokens}
+    yield STREAM_FINISH, finish_reason
 
 def convert_audio_file_to_format(input_file: str, output_file: str, OUTPUT_FORMAT: str):
     """Converts the audio file to a specific format.
@@ -154,5 +1580,474 @@ def convert_audio_file_to_format(input_file: str, output_file: str, OUTPUT_FORMA
         output_file (str): output audio file
         OUTPUT_FORMAT (str): audio format
     """
-    audio = AudioSegment.from_file(input_file)
-    audio.export(output_file, format=OUTPUT_FORMAT)
+    with open(input_file, 'rb') as f:
+        output_data = transcode_audio(f, OUTPUT_FORMAT)
+    with open(output_file, 'wb') as f:
+        f.write(output_data)
+
+async def convert_audio_file_to_format_async(input_file: str, output_file: str, OUTPUT_FORMAT: str):
+    """The awaitable version of convert_audio_file_to_format.
+
+    Args:
+        input_file (str): input audio file
+        output_file (str): output audio file
+        OUTPUT_FORMAT (str): audio format
+    """
+    with open(input_file, 'rb') as f:
+        output_data = await transcode_audio_async(f, OUTPUT_FORMAT)
+    with open(output_file, 'wb') as f:
+        f.write(output_data)
+
+def _read_audio_input(data: AudioInput) -> bytes:
+    """Normalizes the accepted audio inputs (bytes-like objects or binary streams) to bytes."""
+    if hasattr(data, 'read'):
+        return data.read()
+    return bytes(data)
+
+def _is_iso_media(data: bytes) -> bool:
+    """Tells whether the data is an MP4/M4A (ISO base media) file, e.g. what Safari records for the web client."""
+    return data[4:8] == b'ftyp'
+
+def _run_ffmpeg(data: bytes, output_format: str, output_args: Tuple[str, ...] = (), input_args: Tuple[str, ...] = ()) -> bytes:
+    """Runs one ffmpeg process, feeding the input through stdin and collecting the output from stdout.
+
+    Args:
+        data (bytes): encoded input audio.
+        output_format (str): the ffmpeg muxer name of the output, e.g. mp3.
+        output_args (Tuple[str, ...]): extra ffmpeg output options, e.g. codec or sample rate.
+        input_args (Tuple[str, ...]): extra ffmpeg input options, e.g. the layout of raw PCM input.
+
+    Returns:
+        bytes: encoded output audio.
+    """
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', *input_args]
+    if not input_args and _is_iso_media(data):
+        # MP4 files usually have the index (moov atom) at the end, which ffmpeg cannot reach from a non-seekable pipe.
+        # This is the only case we have to spool the input to disk.
+        with tempfile.NamedTemporaryFile(suffix='.m4a') as temp_input_file:
+            temp_input_file.write(data)
+            temp_input_file.flush()
+            command += ['-i', temp_input_file.name, *output_args, '-f', output_format, 'pipe:1']
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        command += ['-i', 'pipe:0', *output_args, '-f', output_format, 'pipe:1']
+        result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to convert the audio to {output_format}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout
+
+def transcode_audio(data: AudioInput, output_format: str, output_args: Tuple[str, ...] = ()) -> bytes:
+    """Converts in-memory audio to a specific format, without any disk round-trips.
+    The conversion runs on the shared transcoding pool, so the number of concurrent ffmpeg processes is bounded by TRANSCODE_MAX_WORKERS.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        output_format (str): audio format, e.g. mp3.
+        output_args (Tuple[str, ...], optional): extra ffmpeg output options.
+
+    Returns:
+        bytes: the converted audio.
+    """
+    with metrics.span('transcode'):
+        return _transcode_pool.submit(_run_ffmpeg, _read_audio_input(data), output_format, tuple(output_args)).result()
+
+def sniff_audio_format(data: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """Tells the container and codec of the encoded audio from its magic bytes, without decoding it.
+
+    Args:
+        data (bytes): encoded audio, only the first few KB are inspected.
+
+    Returns:
+        Tuple[Optional[str], Optional[str]]: the container (as a file extension) and the codec. Either of them is None when unknown.
+    """
+    header = bytes(data[:4096])
+    if header.startswith(b'OggS'):
+        if b'OpusHead' in header:
+            return 'ogg', 'opus'
+        if b'\x01vorbis' in header:
+            return 'ogg', 'vorbis'
+        if b'\x7fFLAC' in header:
+            return 'ogg', 'flac'
+        return 'ogg', None
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        # WAV can hold other codecs too, but the recordings we receive are always PCM.
+        return 'wav', 'pcm'
+    if header.startswith(b'fLaC'):
+        return 'flac', 'flac'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        # Matroska/WebM (EBML header), which is what Chrome and Firefox's MediaRecorder produce.
+        return 'webm', 'opus' if b'A_OPUS' in header else None
+    if _is_iso_media(header):
+        return 'm4a', 'aac'
+    if len(header) > 1 and header[0] == 0xFF and header[1] & 0xF6 == 0xF0:
+        # Raw AAC in ADTS frames. Its sync word also matches the MPEG audio one below, but its layer bits are always 00.
+        return 'aac', 'aac'
+    if header.startswith(b'ID3') or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return 'mp3', 'mp3'
+    return None, None
+
+class AudioPlan(NamedTuple):
+    """The decision of AudioFormatPolicy for a piece of audio."""
+    passthrough: bool
+    input_format: Optional[str]
+    output_format: str
+    output_args: Tuple[str, ...] = ()
+
+class AudioFormatPolicy:
+    """Decides per input whether the audio can be uploaded to the ASR backend untouched, or has to be re-encoded first.
+
+    Args:
+        accepted_formats (frozenset): containers the ASR backend accepts.
+        max_upload_bytes (int): the largest upload the ASR backend accepts.
+        uncompressed_codecs (frozenset): codecs that are always re-encoded because they waste upload bandwidth.
+    """
+    def __init__(self, accepted_formats: frozenset = WHISPER_ACCEPTED_FORMATS, max_upload_bytes: int = WHISPER_MAX_UPLOAD_BYTES,
+                 uncompressed_codecs: frozenset = frozenset(['pcm'])):
+        self.accepted_formats = accepted_formats
+        self.max_upload_bytes = max_upload_bytes
+        self.uncompressed_codecs = uncompressed_codecs
+
+    def decide(self, data: bytes) -> AudioPlan:
+        container, codec = sniff_audio_format(data)
+        if container in self.accepted_formats and codec not in self.uncompressed_codecs and len(data) <= self.max_upload_bytes:
+            return AudioPlan(True, container, container)
+        return AudioPlan(False, container, COMPACT_AUDIO_FORMAT, COMPACT_AUDIO_ARGS)
+
+DEFAULT_AUDIO_POLICY = AudioFormatPolicy()
+
+def prepare_audio_for_asr(data: AudioInput, policy: AudioFormatPolicy = DEFAULT_AUDIO_POLICY) -> Tuple[bytes, str]:
+    """Gets the audio ready for the ASR upload. Telegram OGG/Opus notes and browser WebM recordings are passed through untouched,
+    other inputs are downmixed to 16 kHz mono Opus.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        policy (AudioFormatPolicy, optional): the policy deciding between passthrough and re-encoding.
+
+    Returns:
+        Tuple[bytes, str]: the audio to upload, and its format.
+    """
+    data = _read_audio_input(data)
+    plan = policy.decide(data)
+    if plan.passthrough:
+        return data, plan.output_format
+    return transcode_audio(data, plan.output_format, plan.output_args), plan.output_format
+
+async def prepare_audio_for_asr_async(data: AudioInput, policy: AudioFormatPolicy = DEFAULT_AUDIO_POLICY) -> Tuple[bytes, str]:
+    """The awaitable version of prepare_audio_for_asr.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        policy (AudioFormatPolicy, optional): the policy deciding between passthrough and re-encoding.
+
+    Returns:
+        Tuple[bytes, str]: the audio to upload, and its format.
+    """
+    data = _read_audio_input(data)
+    plan = policy.decide(data)
+    if plan.passthrough:
+        return data, plan.output_format
+    return await transcode_audio_async(data, plan.output_format, plan.output_args), plan.output_format
+
+async def transcode_audio_async(data: AudioInput, output_format: str, output_args: Tuple[str, ...] = ()) -> bytes:
+    """The awaitable version of transcode_audio. The event loop is not blocked while ffmpeg is running.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        output_format (str): audio format, e.g. mp3.
+        output_args (Tuple[str, ...], optional): extra ffmpeg output options.
+
+    Returns:
+        bytes: the converted audio.
+    """
+    future = _transcode_pool.submit(_run_ffmpeg, _read_audio_input(data), output_format, tuple(output_args))
+    with metrics.span('transcode'):
+        return await asyncio.wrap_future(future)
+
+
+def decode_audio_to_pcm(data: AudioInput) -> np.ndarray:
+    """Decodes the audio to 16 kHz mono PCM samples on the transcoding pool.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+
+    Returns:
+        np.ndarray: int16 samples.
+    """
+    return np.frombuffer(transcode_audio(data, 's16le', PCM_ARGS[2:]), dtype=np.int16)
+
+async def decode_audio_to_pcm_async(data: AudioInput) -> np.ndarray:
+    """The awaitable version of decode_audio_to_pcm."""
+    return np.frombuffer(await transcode_audio_async(data, 's16le', PCM_ARGS[2:]), dtype=np.int16)
+
+def encode_pcm(pcm: np.ndarray) -> bytes:
+    """Encodes 16 kHz mono PCM samples in the compact ASR upload format."""
+    return _transcode_pool.submit(_run_ffmpeg, pcm.astype(np.int16).tobytes(), COMPACT_AUDIO_FORMAT, COMPACT_AUDIO_ARGS, PCM_ARGS).result()
+
+async def encode_pcm_async(pcm: np.ndarray) -> bytes:
+    """The awaitable version of encode_pcm."""
+    future = _transcode_pool.submit(_run_ffmpeg, pcm.astype(np.int16).tobytes(), COMPACT_AUDIO_FORMAT, COMPACT_AUDIO_ARGS, PCM_ARGS)
+    return await asyncio.wrap_future(future)
+
+class NoSpeechDetected(Exception):
+    """Raised when a voice note has no speech in it, so there is nothing to transcribe."""
+
+class SilenceTrim(NamedTuple):
+    """The result of trim_silence."""
+    pcm: np.ndarray
+    original_seconds: float
+    speech_seconds: float
+
+    @property
+    def trimmed_seconds(self) -> float:
+        return self.original_seconds - len(self.pcm) / PCM_SAMPLE_RATE
+
+    @property
+    def silent(self) -> bool:
+        return len(self.pcm) == 0
+
+def _frame_features(pcm: np.ndarray, frame_seconds: float) -> Tuple[np.ndarray, np.ndarray]:
+    """The RMS energy and the zero-crossing rate of each full frame of the audio."""
+    frame_length = int(PCM_SAMPLE_RATE * frame_seconds)
+    n_frames = len(pcm) // frame_length
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+    frames = pcm[:n_frames * frame_length].astype(np.float32).reshape(n_frames, frame_length)
+    energy = np.sqrt(np.mean(frames ** 2, axis=1))
+    signs = np.signbit(frames)
+    zero_crossing_rate = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_length - 1)
+    return energy, zero_crossing_rate
+
+def _speech_frames(energy: np.ndarray, zero_crossing_rate: np.ndarray) -> np.ndarray:
+    if len(energy) == 0:
+        return np.zeros(0, dtype=bool)
+    # The 10th percentile is the background noise when the recording has pauses. When it has none, it's speech itself,
+    # so the threshold is also capped at half the loudness of the recording (its 90th percentile), or no frame would get over it.
+    threshold = max(VAD_MIN_ENERGY, min(3 * float(np.percentile(energy, 10)), 0.5 * float(np.percentile(energy, 90))))
+    return (energy > threshold) | ((energy > threshold / 2) & (zero_crossing_rate > VAD_UNVOICED_ZCR))
+
+def detect_speech_frames(pcm: np.ndarray, frame_seconds: float = VAD_FRAME_SECONDS) -> np.ndarray:
+    """Tells which frames of the audio contain speech, from their RMS energy and zero-crossing rate.
+    The energy threshold follows the background noise of the recording, estimated as the 10th percentile of the frame energies,
+    but stays under half the loudness of the recording, for the recordings without any pause.
+    Quiet frames with a high zero-crossing rate still count as speech, because unvoiced consonants are noise-like and weak.
+
+    Args:
+        pcm (np.ndarray): 16 kHz mono samples.
+        frame_seconds (float, optional): the length of the analysis frames.
+
+    Returns:
+        np.ndarray: one boolean per frame, True for speech.
+    """
+    return _speech_frames(*_frame_features(pcm, frame_seconds))
+
+def trim_silence(pcm: np.ndarray, max_pause_seconds: float = VAD_MAX_PAUSE_SECONDS, padding_seconds: float = VAD_PADDING_SECONDS,
+                 frame_seconds: float = VAD_FRAME_SECONDS) -> SilenceTrim:
+    """Cuts the silence before and after the speech, and shortens the pauses longer than max_pause_seconds.
+
+    Args:
+        pcm (np.ndarray): 16 kHz mono samples.
+        max_pause_seconds (float, optional): longer pauses are shortened to this length.
+        padding_seconds (float, optional): audio kept before and after each stretch of speech.
+        frame_seconds (float, optional): the length of the analysis frames.
+
+    Returns:
+        SilenceTrim: the remaining samples, and the durations before and after.
+            The samples are empty when the audio is silent, i.e. when no frame is louder than VAD_MIN_ENERGY.
+    """
+    original_seconds = len(pcm) / PCM_SAMPLE_RATE
+    energy, zero_crossing_rate = _frame_features(pcm, frame_seconds)
+    if len(energy) == 0 or float(energy.max()) <= VAD_MIN_ENERGY:
+        return SilenceTrim(pcm[:0], original_seconds, 0.0)
+    speech = _speech_frames(energy, zero_crossing_rate)
+    speech_seconds = float(np.count_nonzero(speech) * frame_seconds)
+    if speech_seconds < VAD_MIN_SPEECH_SECONDS:
+        # There is sound, but hardly anything the detector recognizes as speech, e.g. speech buried in noise.
+        # Dropping the note can't be undone, so it's transcribed as it is instead.
+        return SilenceTrim(pcm, original_seconds, speech_seconds)
+
+    padding = int(padding_seconds / frame_seconds)
+    keep = np.convolve(speech, np.ones(2 * padding + 1), mode='same') > 0
+    # The pauses left are the runs of False in keep. Padding keep with True on both sides makes the edges come in (start, end) pairs.
+    edges = np.flatnonzero(np.diff(np.concatenate(([True], keep, [True])).astype(np.int8)))
+    half_pause = int(max_pause_seconds / frame_seconds) // 2
+    for start, end in zip(edges[0::2], edges[1::2]):
+        # The leading and trailing silence is dropped entirely, the long pauses in between keep half_pause frames on each side.
+        if start > 0 and end < len(keep) and end - start > 2 * half_pause:
+            keep[start:start + half_pause] = True
+            keep[end - half_pause:end] = True
+        elif start > 0 and end < len(keep):
+            keep[start:end] = True
+
+    frame_length = int(PCM_SAMPLE_RATE * frame_seconds)
+    # The samples after the last full frame follow the last frame.
+    mask = np.concatenate((np.repeat(keep, frame_length), np.full(len(pcm) - len(keep) * frame_length, keep[-1])))
+    return SilenceTrim(pcm[mask], original_seconds, speech_seconds)
+
+def _trim_decoded_audio(pcm: np.ndarray) -> SilenceTrim:
+    """Runs trim_silence and reports the result.
+
+    Raises:
+        NoSpeechDetected: when the audio has no speech.
+    """
+    with metrics.span('vad'):
+        trim = trim_silence(pcm)
+    metrics.observe_silence_trim(trim.trimmed_seconds, trim.silent)
+    if trim.silent:
+        raise NoSpeechDetected(f'No speech in {trim.original_seconds:.1f} seconds of audio')
+    return trim
+
+def prepare_speech_for_asr(data: AudioInput, policy: AudioFormatPolicy = DEFAULT_AUDIO_POLICY) -> Tuple[bytes, str]:
+    """Like prepare_audio_for_asr, but the silence is trimmed first, see trim_silence.
+    When ffmpeg can't decode the audio, it is prepared without trimming.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        policy (AudioFormatPolicy, optional): the policy deciding between passthrough and re-encoding.
+
+    Returns:
+        Tuple[bytes, str]: the audio to upload, and its format.
+
+    Raises:
+        NoSpeechDetected: when the audio has no speech. No API call is needed then.
+    """
+    data = _read_audio_input(data)
+    if not VAD_ENABLED:
+        return prepare_audio_for_asr(data, policy)
+    try:
+        pcm = decode_audio_to_pcm(data)
+    except (OSError, RuntimeError) as e:
+        print(f'Could not decode the audio for voice activity detection, transcribing it untrimmed: {e}')
+        return prepare_audio_for_asr(data, policy)
+    trim = _trim_decoded_audio(pcm)
+    plan = policy.decide(data)
+    if plan.passthrough and trim.trimmed_seconds < VAD_MIN_TRIMMED_SECONDS:
+        return data, plan.output_format
+    return encode_pcm(trim.pcm), COMPACT_AUDIO_FORMAT
+
+async def prepare_speech_for_asr_async(data: AudioInput, policy: AudioFormatPolicy = DEFAULT_AUDIO_POLICY) -> Tuple[bytes, str]:
+    """The awaitable version of prepare_speech_for_asr.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        policy (AudioFormatPolicy, optional): the policy deciding between passthrough and re-encoding.
+
+    Returns:
+        Tuple[bytes, str]: the audio to upload, and its format.
+
+    Raises:
+        NoSpeechDetected: when the audio has no speech. No API call is needed then.
+    """
+    data = _read_audio_input(data)
+    if not VAD_ENABLED:
+        return await prepare_audio_for_asr_async(data, policy)
+    try:
+        pcm = await decode_audio_to_pcm_async(data)
+    except (OSError, RuntimeError) as e:
+        print(f'Could not decode the audio for voice activity detection, transcribing it untrimmed: {e}')
+        return await prepare_audio_for_asr_async(data, policy)
+    trim = _trim_decoded_audio(pcm)
+    plan = policy.decide(data)
+    if plan.passthrough and trim.trimmed_seconds < VAD_MIN_TRIMMED_SECONDS:
+        return data, plan.output_format
+    return await encode_pcm_async(trim.pcm), COMPACT_AUDIO_FORMAT
+
+def find_chunk_boundaries(pcm: np.ndarray, min_chunk_seconds: float = CHUNK_MIN_SECONDS, max_chunk_seconds: float = CHUNK_MAX_SECONDS,
+                          frame_seconds: float = 0.02, silence_window_seconds: float = 0.3) -> List[Tuple[int, int]]:
+    """Splits the audio into chunks no longer than max_chunk_seconds, cutting at the quietest moment of each search window,
+    so that words are not cut in half.
+
+    Args:
+        pcm (np.ndarray): 16 kHz mono samples.
+        min_chunk_seconds (float, optional): chunks are never cut shorter than this, except the last one.
+        max_chunk_seconds (float, optional): chunks are never longer than this.
+        frame_seconds (float, optional): the length of the frames the energy is computed on.
+        silence_window_seconds (float, optional): the length of the pause we are looking for.
+
+    Returns:
+        List[Tuple[int, int]]: (start, end) sample indices of the chunks, in order.
+    """
+    frame_length = int(PCM_SAMPLE_RATE * frame_seconds)
+    n_frames = len(pcm) // frame_length
+    max_frames = int(max_chunk_seconds / frame_seconds)
+    min_frames = int(min_chunk_seconds / frame_seconds)
+    if n_frames <= max_frames:
+        return [(0, len(pcm))] if len(pcm) else []
+    frames = pcm[:n_frames * frame_length].astype(np.float32).reshape(n_frames, frame_length)
+    energy = np.sqrt(np.mean(frames ** 2, axis=1))
+    # Average the energy over the window, so a single quiet frame between two syllables does not count as a pause.
+    window = max(1, int(silence_window_seconds / frame_seconds))
+    smoothed = np.convolve(energy, np.ones(window) / window, mode='same')
+
+    boundaries = []
+    start = 0
+    while n_frames - start > max_frames:
+        search_from = start + min_frames
+        search_to = start + max_frames
+        cut = search_from + int(np.argmin(smoothed[search_from:search_to]))
+        boundaries.append((start * frame_length, cut * frame_length))
+        start = cut
+    boundaries.append((start * frame_length, len(pcm)))
+    return boundaries
+
+async def transcribe_voice_data_chunked_async(data: AudioInput, max_concurrency: int = TRANSCRIBE_MAX_CONCURRENCY) -> AsyncIterator[str]:
+    """Trims the silence, splits the audio on the remaining pauses and transcribes the chunks concurrently.
+    The transcripts are yielded in order, each as soon as it and all the chunks before it are done, so the caller gets the first part early.
+    Every chunk gets the same language prompt: passing the previous transcript would make each chunk wait for the one before it.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        max_concurrency (int, optional): maximum number of chunks being transcribed at the same time.
+
+    Yields:
+        str: the transcript of each chunk, in order.
+
+    Raises:
+        NoSpeechDetected: when the audio has no speech, before any chunk is sent.
+    """
+    pcm = await decode_audio_to_pcm_async(data)
+    if VAD_ENABLED:
+        pcm = _trim_decoded_audio(pcm).pcm
+    boundaries = find_chunk_boundaries(pcm)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks: List[asyncio.Task] = []
+
+    async def transcribe_chunk(start: int, end: int) -> str:
+        chunk_data = await encode_pcm_async(pcm[start:end])
+        async with semaphore:
+            return await transcribe_voice_data_async(chunk_data, COMPACT_AUDIO_FORMAT)
+
+    tasks.extend(asyncio.create_task(transcribe_chunk(start, end)) for start, end in boundaries)
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def join_transcripts(parts: List[str]) -> str:
+    """Stitches chunk transcripts together. Chinese text is joined directly, while a space is kept between Latin words."""
+    text = ''
+    for part in parts:
+        part = part.strip()
+        if text and part and text[-1].isascii() and text[-1].isalnum() or text and text[-1] in ',.?!;:' and part[:1].isascii():
+            text += ' '
+        text += part
+    return text
+
+def needs_chunked_transcription(data: bytes) -> bool:
+    """Tells whether the audio is long enough to be transcribed in chunks."""
+    return len(data) > CHUNKED_TRANSCRIPTION_MIN_BYTES
+
+def transcribe_long_voice_data(data: AudioInput, max_concurrency: int = TRANSCRIBE_MAX_CONCURRENCY) -> str:
+    """The blocking version of transcribe_voice_data_chunked_async, returning the stitched transcript.
+
+    Args:
+        data (AudioInput): input audio, as bytes or a binary stream.
+        max_concurrency (int, optional): maximum number of chunks being transcribed at the same time.
+
+    Returns:
+        str: Transcribed text.
+    """
+    async def collect() -> str:
+        return join_transcripts([text async for text in transcribe_voice_data_chunked_async(data, max_concurrency)])
+    return run_on_private_loop(collect)
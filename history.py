@@ -0,0 +1,241 @@
+"""
+This file holds the types of the note history stored in user_data['history'] by the Telegram bot.
+* HistoryEntry: one note, with its transformations kept as an ordered revision chain.
+* PagedHistory: the list of a user's notes. Only the most recent entries stay in memory, older ones are paged from the persistence on demand.
+"""
+import sys
+import copy
+import asyncio
+import datetime
+from concurrent.futures import Executor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+# Number of the most recent entries of each user kept in memory.
+HISTORY_HOT_ENTRIES = 20
+# Number of entries read at once when older entries are paged in.
+HISTORY_PAGE_SIZE = 100
+
+# The revision kinds of the base texts. Every other kind is a target usage, i.e. a key of CHOICE_TO_PROMPT.
+TRANSCRIBED = sys.intern('transcribed')
+PARAPHRASED = sys.intern('paraphrased')
+SET_CONTENT = sys.intern('set_content')
+# The target usages that are detours with inspirations, rather than a processed version of the previous text.
+# They are recorded in the chain, but the following transformations still start from the text before them.
+DETOUR_USAGES = frozenset(['思考'])
+
+class HistoryEntry:
+    """One note and its revision chain.
+    Each revision is a (kind, text, parent) tuple, where parent is the index of the revision it was derived from (-1 for the first one).
+    The kinds are interned, so the thousands of entries of a user share the same few strings.
+
+    Args:
+        date (datetime.datetime): when the note was received.
+        model (Optional[str]): the GPT model used for the paraphrasing.
+        tag (Optional[str]): the tag of the note.
+    """
+    __slots__ = ('date', 'model', 'tag', 'revisions', 'current')
+
+    def __init__(self, date: datetime.datetime, model: Optional[str] = None, tag: Optional[str] = None):
+        self.date = date
+        self.model = model
+        self.tag = tag
+        self.revisions: List[Tuple[str, str, int]] = []
+        # The index of the revision the next transformation starts from, replacing the former `last_text_field`.
+        self.current = -1
+
+    def add_revision(self, kind: str, text: str, advance: Optional[bool] = None) -> int:
+        """Appends a revision derived from the current one.
+
+        Args:
+            kind (str): TRANSCRIBED, PARAPHRASED, SET_CONTENT or a target usage.
+            text (str): the text of the revision.
+            advance (Optional[bool]): whether the next transformation starts from this revision. Defaults to False for DETOUR_USAGES.
+
+        Returns:
+            int: the index of the new revision.
+        """
+        if advance is None:
+            advance = kind not in DETOUR_USAGES
+        self.revisions.append((sys.intern(kind), text, self.current))
+        if advance:
+            self.current = len(self.revisions) - 1
+        return len(self.revisions) - 1
+
+    @property
+    def current_text(self) -> str:
+        return self.revisions[self.current][1]
+
+    def get(self, kind: str) -> Optional[str]:
+        """Returns the text of the latest revision of the given kind, or None."""
+        for revision_kind, text, _ in reversed(self.revisions):
+            if revision_kind == kind:
+                return text
+        return None
+
+    @property
+    def transcribed(self) -> Optional[str]:
+        return self.get(TRANSCRIBED)
+
+    @property
+    def paraphrased(self) -> Optional[str]:
+        return self.get(PARAPHRASED)
+
+    def texts(self) -> Iterator[Tuple[str, str]]:
+        """Iterates over the (kind, text) of all the revisions, in order."""
+        for kind, text, _ in self.revisions:
+            yield kind, text
+
+    def to_dict(self) -> Dict:
+        """A readable dict, e.g. for the /data command. Repeated kinds are numbered."""
+        result = {'date': self.date, 'model': self.model}
+        for kind, text in self.texts():
+            key, n = kind, 1
+            while key in result:
+                n += 1
+                key = f'{kind}#{n}'
+            result[key] = text
+        return result
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def __getstate__(self):
+        return (self.date, self.model, self.tag, self.revisions, self.current)
+
+    def __setstate__(self, state):
+        self.date, self.model, self.tag, revisions, self.current = state
+        self.revisions = [(sys.intern(kind), text, parent) for kind, text, parent in revisions]
+
+    @classmethod
+    def from_dict(cls, entry: Dict) -> 'HistoryEntry':
+        """Converts an entry of the former dict format, where each transformation was stored in a field named after the
+        chain of usages (e.g. `paraphrased_海明威_高情商`), `last_text_field` pointed to the current one, and `history` listed the steps."""
+        result = cls(entry.get('date'), entry.get('model'), entry.get('tag'))
+        field = None
+        for base in (SET_CONTENT, TRANSCRIBED, PARAPHRASED):
+            if base in entry:
+                result.add_revision(base, entry[base])
+                field = base
+        for usage in entry.get('history', []):
+            if field is None or field + '_' + usage not in entry:
+                continue
+            result.add_revision(usage, entry[field + '_' + usage])
+            if usage not in DETOUR_USAGES:
+                field = field + '_' + usage
+        return result
+
+class _PagingState:
+    """The paging state of a PagedHistory, shared with its deep copies, so that the copy handed to the persistence
+    can report which entries are stored on disk."""
+    __slots__ = ('persisted', 'loader', 'executor')
+
+    def __init__(self, persisted: int = 0, loader: Optional[Callable[[int, int], List[HistoryEntry]]] = None):
+        self.persisted = persisted
+        self.loader = loader
+        self.executor: Optional[Executor] = None
+
+class PagedHistory:
+    """A list-like container of a user's HistoryEntry, keeping at most hot_entries of the most recent ones in memory.
+    An entry is only evicted once the persistence has reported it stored on disk (see mark_persisted),
+    and evicted entries are read back through the loader on demand.
+
+    Args:
+        entries (Optional[List[HistoryEntry]]): the most recent entries.
+        offset (int): the index of the first of them, i.e. the number of older entries only available through the loader.
+        hot_entries (int): number of entries kept in memory.
+    """
+    __slots__ = ('_hot', '_offset', '_state', 'hot_entries')
+
+    def __init__(self, entries: Optional[List[HistoryEntry]] = None, offset: int = 0, hot_entries: int = HISTORY_HOT_ENTRIES):
+        self._hot = list(entries or [])
+        self._offset = offset
+        self._state = _PagingState()
+        self.hot_entries = hot_entries
+
+    def mark_persisted(self, count: int, loader: Callable[[int, int], List[HistoryEntry]], executor: Optional[Executor] = None):
+        """Called by the persistence once the first `count` entries are on disk, and readable with loader(start, stop).
+        slice_async runs the loader on `executor`, or on the default executor of the event loop when it's None."""
+        self._state.persisted = count
+        self._state.loader = loader
+        self._state.executor = executor
+        self._evict()
+
+    def _evict(self):
+        # The last stored entry may still be modified (e.g. by process_thoughts), so it's never evicted.
+        while len(self._hot) > self.hot_entries and self._offset < self._state.persisted - 1 and self._state.loader is not None:
+            self._hot.pop(0)
+            self._offset += 1
+
+    def __len__(self) -> int:
+        return self._offset + len(self._hot)
+
+    def _load(self, start: int, stop: int) -> List[HistoryEntry]:
+        return self._state.loader(start, stop)
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self[start:stop][::step]
+            cold = self._load(start, min(stop, self._offset)) if start < self._offset else []
+            return cold + self._hot[max(0, start - self._offset):max(0, stop - self._offset)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('history index out of range')
+        if index >= self._offset:
+            return self._hot[index - self._offset]
+        return self._load(index, index + 1)[0]
+
+    async def slice_async(self, start: int, stop: int) -> List[HistoryEntry]:
+        """Like history[start:stop], but the entries on disk are read on the executor of the persistence, so the event loop doesn't wait for the disk."""
+        stop = min(stop, len(self))
+        entries: List[HistoryEntry] = []
+        # More entries may be evicted while the disk is read, so the boundary is checked again after each read.
+        while start + len(entries) < min(stop, self._offset):
+            loaded = await asyncio.get_running_loop().run_in_executor(self._state.executor, self._load, start + len(entries), min(stop, self._offset))
+            if not loaded:
+                break
+            entries += loaded
+        first = start + len(entries)
+        return entries + self._hot[max(0, first - self._offset):max(0, stop - self._offset)]
+
+    def __iter__(self) -> Iterator[HistoryEntry]:
+        for start in range(0, self._offset, HISTORY_PAGE_SIZE):
+            yield from self._load(start, min(start + HISTORY_PAGE_SIZE, self._offset))
+        yield from list(self._hot)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def append(self, entry: HistoryEntry):
+        self._hot.append(entry)
+        self._evict()
+
+    def clear(self):
+        self._hot = []
+        self._offset = 0
+        self._state.persisted = 0
+
+    def __deepcopy__(self, memo) -> 'PagedHistory':
+        # The Application deep-copies the user_data before handing it to the persistence. Only the hot entries are copied,
+        # and the paging state is shared, so mark_persisted on the copy lets the original evict.
+        result = PagedHistory.__new__(PagedHistory)
+        result._hot = copy.deepcopy(self._hot, memo)
+        result._offset = self._offset
+        result._state = self._state
+        result.hot_entries = self.hot_entries
+        return result
+
+    def __getstate__(self):
+        # Pickled on its own (e.g. outside of SQLitePersistence), the whole history is materialized.
+        return list(self)
+
+    def __setstate__(self, entries: List[HistoryEntry]):
+        self._hot = entries
+        self._offset = 0
+        self._state = _PagingState()
+        self.hot_entries = HISTORY_HOT_ENTRIES
+
+    def __repr__(self) -> str:
+        return f'PagedHistory({len(self)} entries, {len(self._hot)} in memory)'
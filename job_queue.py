@@ -0,0 +1,193 @@
+"""
+This file holds the job queue behind the /jobs routes of the Flask API.
+Instead of keeping the request open for the whole Whisper + GPT latency, a job is submitted and answered with 202 and a job id,
+then run on a bounded worker pool. Clients poll the job, or subscribe to its events.
+When the queue is full, submit raises QueueFull, which the API turns into a 429 with Retry-After.
+"""
+import os
+import math
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import metrics
+
+# Number of jobs running at the same time.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Number of jobs waiting for a worker. Submissions beyond it are rejected.
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', 32))
+# How long a finished job stays available for polling.
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue is full.
+
+    Args:
+        retry_after (int): estimated number of seconds until a slot frees up.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f'Job queue is full, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+class Job:
+    """A submitted job. The function running it can publish intermediate events (e.g. the transcript before the paraphrase),
+    which are kept so that late subscribers get all of them.
+
+    Args:
+        kind (str): the kind of the job, e.g. 'transcribe'.
+    """
+    __slots__ = ('id', 'kind', 'status', 'result', 'error', 'events', 'created', 'started', 'finished', '_cond')
+
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.events: List[Tuple[str, Any]] = []
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._cond = threading.Condition()
+
+    def publish(self, event: str, data: Any):
+        """Records an intermediate event and wakes up the subscribers."""
+        with self._cond:
+            self.events.append((event, data))
+            self._cond.notify_all()
+
+    def _set_status(self, status: str, result: Any = None, error: Optional[str] = None):
+        with self._cond:
+            self.status = status
+            if status == RUNNING:
+                self.started = time.time()
+            else:
+                self.result, self.error, self.finished = result, error, time.time()
+            self._cond.notify_all()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the job is finished or the timeout expires. Returns whether the job is finished."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.is_finished, timeout)
+
+    def iter_events(self, timeout: Optional[float] = None) -> Iterator[Tuple[str, Any]]:
+        """Yields the published events as they arrive, starting from the first one, until the job is finished.
+        Then yields ('done', result) or ('error', error). Stops silently if nothing happens within timeout seconds.
+        """
+        sent = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: len(self.events) > sent or self.is_finished, timeout):
+                    return
+                pending = self.events[sent:]
+                finished = self.is_finished
+            sent += len(pending)
+            yield from pending
+            if finished:
+                yield ('done', self.result) if self.status == DONE else ('error', self.error)
+                return
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {'id': self.id, 'kind': self.kind, 'status': self.status, 'created': self.created}
+        if self.started is not None:
+            result['queued_seconds'] = round(self.started - self.created, 3)
+        if self.finished is not None and self.started is not None:
+            result['running_seconds'] = round(self.finished - self.started, 3)
+        if self.status == DONE:
+            result['result'] = self.result
+        elif self.status == FAILED:
+            result['error'] = self.error
+        return result
+
+class JobQueue:
+    """A bounded worker pool with a bounded queue in front of it.
+
+    Args:
+        workers (int): number of jobs running at the same time.
+        max_queued (int): number of jobs allowed to wait for a worker.
+        ttl (int): how long a finished job stays available, in seconds.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_DEPTH, ttl: int = JOB_TTL_SECONDS):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        # Ordered by submission, so the expired jobs are at the front.
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._queued = 0
+        self._running = 0
+        # Moving average of the job durations, used to estimate Retry-After.
+        self._mean_seconds = 10.0
+
+    def submit(self, kind: str, func: Callable[..., Any], *args) -> Job:
+        """Submits func(job, *args) to run on the pool. Its return value becomes the result of the job.
+
+        Raises:
+            QueueFull: if max_queued jobs are already waiting.
+        """
+        with self._lock:
+            self._expire()
+            if self._queued >= self.max_queued:
+                raise QueueFull(self.retry_after())
+            job = Job(kind)
+            self._jobs[job.id] = job
+            self._queued += 1
+        self._pool.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job: Job, func: Callable[..., Any], args: tuple):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        job._set_status(RUNNING)
+        metrics.record_stage('job_queued', job.started - job.created, traced=False)
+        try:
+            with metrics.start_trace(f'job.{job.kind}', job_id=job.id):
+                job._set_status(DONE, result=func(job, *args))
+        except Exception as e:
+            print(f'Job {job.id} ({job.kind}) failed: {e}')
+            job._set_status(FAILED, error=str(e))
+        with self._lock:
+            self._running -= 1
+            self._mean_seconds = 0.8 * self._mean_seconds + 0.2 * (job.finished - job.started)
+
+    def retry_after(self) -> int:
+        """Estimates the seconds until a queue slot frees up, i.e. until one of the busy workers finishes its job."""
+        return max(1, math.ceil(self._mean_seconds / self.workers))
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        # The jobs are in order of creation, so the ones created after the deadline end the scan.
+        # The older ones still running, or finished recently, are skipped rather than holding back the expiry of the jobs behind them.
+        expired = []
+        for job_id, job in self._jobs.items():
+            if job.created > deadline:
+                break
+            if job.is_finished and job.finished <= deadline:
+                expired.append(job_id)
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'workers': self.workers, 'running': self._running, 'queued': self._queued, 'max_queued': self.max_queued,
+                    'jobs': len(self._jobs), 'mean_seconds': round(self._mean_seconds, 3)}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
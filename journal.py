@@ -0,0 +1,277 @@
+"""
+This file holds the journal behind PERSONAL_LOG_FILE: an append-only log of JSON lines, e.g. {"content": ..., "date": "2023-07-01 12:00:00"}.
+* Records are handed to a background writer through a queue, so the request threads never wait for the disk.
+  The writer appends them in batches and fsyncs at most every JOURNAL_FSYNC_SECONDS.
+* The file being written is rotated when a new day starts or when it exceeds JOURNAL_ROTATE_BYTES.
+  Rotated segments are gzipped next to it, one gzip member per day, and the sidecar index (<file>.index.json)
+  maps each day to its segment and to the offset of its member, so reading a date range only decompresses the days asked for.
+* Batches and rotations hold an exclusive flock on <file>.lock, so the web app and the Telegram bot can feed the same journal from two processes.
+
+Usage, to print the entries since a date:
+    python journal.py personal_log.jsonl 2023-07-01 [2023-07-07]
+"""
+import os
+import sys
+import json
+import gzip
+import zlib
+import time
+import queue
+import fcntl
+import atexit
+import datetime
+import threading
+import contextlib
+from typing import Any, Dict, Iterator, List, Optional
+
+# The file being written is rotated when it exceeds this size, and at the first record of a new day.
+JOURNAL_ROTATE_BYTES = int(os.environ.get('JOURNAL_ROTATE_BYTES', 64 * 1024 * 1024))
+# Longest time a written record may stay in the page cache before being fsynced.
+JOURNAL_FSYNC_SECONDS = float(os.environ.get('JOURNAL_FSYNC_SECONDS', 1.0))
+# Maximum number of records written at once.
+JOURNAL_BATCH_SIZE = 256
+JOURNAL_COMPRESS_LEVEL = 6
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_CLOSE = object()
+
+def _record_day(line: bytes) -> str:
+    try:
+        return json.loads(line)['date'][:10]
+    except (ValueError, KeyError, TypeError):
+        return ''
+
+class Journal:
+    """A journal of JSON records, see the module docstring. Use get_journal to share one instance per file.
+
+    Args:
+        path (str): the file being written. The segments, the index and the lock file are named after it.
+        rotate_bytes (int): the size the file is rotated at.
+        fsync_interval (float): longest time between a write and its fsync.
+        batch_size (int): maximum number of records written at once.
+    """
+    def __init__(self, path: str, rotate_bytes: int = JOURNAL_ROTATE_BYTES, fsync_interval: float = JOURNAL_FSYNC_SECONDS,
+                 batch_size: int = JOURNAL_BATCH_SIZE):
+        self.path = os.path.abspath(path)
+        self.index_path = self.path + '.index.json'
+        self.rotate_bytes = rotate_bytes
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        # SimpleQueue.put never blocks nor takes a Python-level lock, so writing a record costs the callers almost nothing.
+        self._queue: 'queue.SimpleQueue[Any]' = queue.SimpleQueue()
+        self._lock_file = open(self.path + '.lock', 'a')
+        # The first day of the file being written, as last seen by this process, with the file size it was seen at.
+        self._active_day: Optional[str] = None
+        self._active_size = -1
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: Dict[str, Any]):
+        """Queues a record. Its `date` defaults to now, in DATE_FORMAT."""
+        if 'date' not in record:
+            record = {**record, 'date': datetime.datetime.now().strftime(DATE_FORMAT)}
+        self._queue.put(record)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the records queued so far are written and fsynced. Returns False on timeout.
+        Once the journal is closed there is no writer left to wait for, so it returns right away."""
+        if not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        # The writer may stop before it gets to the event, if the journal is closed in the meanwhile.
+        while not done.wait(0.1 if deadline is None else min(0.1, max(0.0, deadline - time.monotonic()))):
+            if not self._thread.is_alive():
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def close(self):
+        """Writes the queued records and stops the writer."""
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            timeout = max(0.0, self.fsync_interval - (time.monotonic() - last_sync)) if dirty else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            records: List[Dict[str, Any]] = []
+            waiters: List[threading.Event] = []
+            closing = False
+            while item is not None:
+                if item is _CLOSE:
+                    closing = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    records.append(item)
+                if len(records) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if records:
+                try:
+                    self._append(fd, records)
+                    dirty = True
+                except Exception as e:
+                    print(f'Could not write {len(records)} records to the journal {self.path}: {e}')
+            if dirty and (waiters or closing or time.monotonic() - last_sync >= self.fsync_interval):
+                os.fsync(fd)
+                dirty = False
+                last_sync = time.monotonic()
+            for waiter in waiters:
+                waiter.set()
+            if closing:
+                os.close(fd)
+                return
+
+    def _append(self, fd: int, records: List[Dict[str, Any]]):
+        lines = [(record['date'][:10], (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('UTF-8')) for record in records]
+        with self._locked():
+            start = 0
+            while start < len(lines):
+                # The records of the same day are written at once.
+                day = lines[start][0]
+                end = start
+                while end < len(lines) and lines[end][0] == day:
+                    end += 1
+                data = b''.join(line for _, line in lines[start:end])
+                size = os.fstat(fd).st_size
+                if size and (self._first_day(size) != day or size + len(data) > self.rotate_bytes):
+                    self._rotate(fd)
+                    size = 0
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                if not size:
+                    self._active_day = day
+                self._active_size = size + len(data)
+                start = end
+
+    def _first_day(self, size: int) -> str:
+        # Another process may have written or rotated the file since this one last did.
+        if size != self._active_size or self._active_day is None:
+            with open(self.path, 'rb') as f:
+                self._active_day = _record_day(f.readline())
+        return self._active_day
+
+    def _load_index(self) -> Dict[str, Any]:
+        try:
+            with open(self.index_path, encoding='UTF-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': []}
+
+    def _rotate(self, fd: int):
+        """Compresses the file being written into a new segment, one gzip member per day, then empties it. Called with the lock held."""
+        index = self._load_index()
+        number = index['segments'][-1]['number'] + 1 if index['segments'] else 1
+        name = f'{os.path.basename(self.path)}.{number:06d}.gz'
+        segment_path = os.path.join(os.path.dirname(self.path), name)
+        days: Dict[str, int] = {}
+        records = 0
+        with open(self.path, 'rb') as source, open(segment_path + '.tmp', 'wb') as target:
+            day, compressor = None, None
+            for line in source:
+                line_day = _record_day(line) or day or ''
+                if compressor is None or line_day != day:
+                    if compressor is not None:
+                        target.write(compressor.flush())
+                    day = line_day
+                    days.setdefault(day, target.tell())
+                    # wbits=31 writes a gzip member, and concatenated members are a valid gzip file.
+                    compressor = zlib.compressobj(JOURNAL_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+                target.write(compressor.compress(line))
+                records += 1
+            if compressor is not None:
+                target.write(compressor.flush())
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(segment_path + '.tmp', segment_path)
+        index['segments'].append({'number': number, 'file': name, 'records': records, 'days': days})
+        with open(self.index_path + '.tmp', 'w', encoding='UTF-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + '.tmp', self.index_path)
+        # Every writer appends with O_APPEND, so after the truncation they all continue at the start of the emptied file.
+        os.ftruncate(fd, 0)
+        self._active_day, self._active_size = None, 0
+
+    def read(self, since: datetime.date, until: Optional[datetime.date] = None) -> Iterator[Dict[str, Any]]:
+        """Yields the records from `since` to `until` included, in order. Only the segments and the days in the range are read.
+
+        Args:
+            since (datetime.date): the first day.
+            until (Optional[datetime.date]): the last day. Defaults to no limit.
+
+        Yields:
+            Dict[str, Any]: the records.
+        """
+        self.flush()
+        first, last = since.isoformat(), until.isoformat() if until is not None else None
+        # The index and the file being written are read together, so a rotation in the meanwhile can't hide or repeat records.
+        with self._locked():
+            index = self._load_index()
+            with open(self.path, 'rb') as f:
+                active = f.read()
+        for segment in index['segments']:
+            days = [day for day in segment['days'] if day >= first and (last is None or day <= last)]
+            if not days:
+                continue
+            with open(os.path.join(os.path.dirname(self.path), segment['file']), 'rb') as f:
+                f.seek(segment['days'][days[0]])
+                with gzip.GzipFile(fileobj=f) as lines:
+                    yield from self._filter(lines, first, last)
+        yield from self._filter(active.splitlines(), first, last)
+
+    @staticmethod
+    def _filter(lines, first: str, last: Optional[str]) -> Iterator[Dict[str, Any]]:
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            day = record.get('date', '')[:10]
+            if last is not None and day > last:
+                return
+            if day >= first:
+                yield record
+
+_journals: Dict[str, Journal] = {}
+_journals_lock = threading.Lock()
+
+def get_journal(path: str) -> Journal:
+    """The journal of the file, started on first use. There is one writer per file and process."""
+    path = os.path.abspath(path)
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
+
+if __name__ == '__main__':
+    journal = get_journal(sys.argv[1])
+    since = datetime.date.fromisoformat(sys.argv[2])
+    until = datetime.date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+    for record in journal.read(since, until):
+        print(json.dumps(record, ensure_ascii=False))
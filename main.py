@@ -1,45 +1,236 @@
-import openai
-import tempfile
-from flask import Flask, request, jsonify, send_from_directory
-from pydub import AudioSegment
+from flask import Flask, Response, request, jsonify, send_from_directory
 import json
+import math
+import asyncio
 from datetime import datetime
-from core import transcribe_voice_message, gpt_process_text, convert_audio_file_to_format
+from typing import Any, AsyncIterator, Iterator
+from core import transcribe_voice_data, gpt_process_text, prepare_speech_for_asr, NoSpeechDetected, needs_chunked_transcription, transcribe_long_voice_data, transcript_cache_key, RESPONSE_CACHE
+from core import gpt_process_text_async, close_http_clients, STREAM_DELTA, STREAM_ERROR
+from job_queue import Job, JobQueue, QueueFull
+from journal import get_journal
+import metrics
 from prompts import PROMPTS
 
 app = Flask(__name__)
+# Runs the jobs submitted to the /jobs routes. See job_queue.py for the configs.
+job_queue = JobQueue()
 
 # Configs
 # TODO: move to a config file
-OUTPUT_FORMAT = "mp3"
 # For my use case, I want to log all the content to a file, so I can later use it for GPT analysis and dispatching.
-# Change it to an actual file name will enable this logging.
+# Change it to an actual file name will enable this logging. The file is a rotating, compressed journal, see journal.py.
 PERSONAL_LOG_FILE = None
+# The longest time a poll or a subscription of a job is kept open while nothing happens.
+JOB_MAX_WAIT_SECONDS = 60
 
 @app.route('/transcribe', methods=['POST'])
+@metrics.traced('flask.transcribe')
 def transcribe():
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file'}), 400
 
     audio_file = request.files['audio']
-    file_type = audio_file.content_type
-    ext_name = file_type.split('/')[-1]
-    temp_audio_file = tempfile.NamedTemporaryFile(suffix=f'.{ext_name}')
-    with tempfile.NamedTemporaryFile(suffix=f'.{ext_name}') as temp_audio_file:
-        print(temp_audio_file.name)
-        audio_file.save(temp_audio_file.name)
-        # Default is AAC, we need to convert it to mp3.
-        with tempfile.NamedTemporaryFile(suffix=f'.{OUTPUT_FORMAT}') as temp_output_file:
-            convert_audio_file_to_format(temp_audio_file.name, temp_output_file.name, OUTPUT_FORMAT)
+    transcribed_text = transcribe_audio_bytes(audio_file.read())
+    return jsonify(transcribed_text)
+
+@app.route('/transcribe_and_process', methods=['POST'])
+def transcribe_and_process():
+    """Transcribes the uploaded audio and paraphrases it in one round trip, streamed as server-sent events:
+    `transcript` once the ASR finishes, `delta` for each piece of the paraphrased text, and `done` (or `error`) at the end.
+    Each event carries a JSON string.
+    """
+    if 'audio' not in request.files:
+        return jsonify({'error': 'No audio file'}), 400
+
+    # The request is gone once the generator runs, so the upload is read here.
+    audio_bytes = request.files['audio'].read()
+
+    def generate() -> Iterator[str]:
+        # The trace covers the streaming, which only starts once the route has returned.
+        with metrics.start_trace('flask.transcribe_and_process'):
+            try:
+                transcribed_text = transcribe_audio_bytes(audio_bytes)
+            except Exception as e:
+                print(f'Transcription failed: {e}')
+                yield sse_event('error', f'Transcription failed: {e}')
+                return
+            yield sse_event('transcript', transcribed_text)
+            if not transcribed_text:
+                # Nothing was said, so there is nothing to paraphrase either.
+                yield sse_event('done', '')
+                return
+
+            pieces = []
+            for event in iterate_async_generator(gpt_process_text_async(transcribed_text, PROMPTS['paraphrase'], 'gpt-4')):
+                if event.kind == STREAM_DELTA:
+                    pieces.append(event.data)
+                    yield sse_event('delta', event.data)
+                elif event.kind == STREAM_ERROR:
+                    print(f'Processing failed: {event.data}')
+                    yield sse_event('error', f'Processing failed: {event.data}')
+                    return
+            processed_text = ''.join(pieces).strip()
+            print(processed_text)
+            if PERSONAL_LOG_FILE:
+                log_content_to_file(processed_text, PERSONAL_LOG_FILE)
+            yield sse_event('done', processed_text)
+
+    return sse_response(generate())
+
+def transcribe_job(job: Job, audio_bytes: bytes) -> str:
+    return transcribe_audio_bytes(audio_bytes)
+
+def process_job(job: Job, text: str) -> str:
+    processed_text = gpt_process_text(text, PROMPTS['paraphrase'], 'gpt-4')
+    if PERSONAL_LOG_FILE:
+        log_content_to_file(processed_text, PERSONAL_LOG_FILE)
+    return processed_text
+
+def transcribe_and_process_job(job: Job, audio_bytes: bytes) -> dict:
+    # The intermediate results are published, so the subscribers of /jobs/<id>/events see the same events as /transcribe_and_process.
+    transcribed_text = transcribe_audio_bytes(audio_bytes)
+    job.publish('transcript', transcribed_text)
+    if not transcribed_text:
+        return {'transcript': '', 'processed': ''}
+    pieces = []
+    for event in iterate_async_generator(gpt_process_text_async(transcribed_text, PROMPTS['paraphrase'], 'gpt-4')):
+        if event.kind == STREAM_DELTA:
+            pieces.append(event.data)
+            job.publish('delta', event.data)
+        elif event.kind == STREAM_ERROR:
+            raise event.data
+    processed_text = ''.join(pieces).strip()
+    if PERSONAL_LOG_FILE:
+        log_content_to_file(processed_text, PERSONAL_LOG_FILE)
+    return {'transcript': transcribed_text, 'processed': processed_text}
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind: str):
+    """Submits a transcribe, process or transcribe_and_process job, with the same input as the synchronous routes.
+    Answers 202 with the job id right away, or 429 with Retry-After when the queue is full.
+    """
+    if kind == 'process':
+        data = request.get_json(force=True)
+        func, arg = process_job, data['text']
+    elif kind in ('transcribe', 'transcribe_and_process'):
+        if 'audio' not in request.files:
+            return jsonify({'error': 'No audio file'}), 400
+        func = transcribe_job if kind == 'transcribe' else transcribe_and_process_job
+        arg = request.files['audio'].read()
+    else:
+        return jsonify({'error': f'Unknown job kind {kind}'}), 404
+
+    try:
+        job = job_queue.submit(kind, func, arg)
+    except QueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    response = jsonify(job.to_dict())
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    """Polls a job. With `?wait=<seconds>`, blocks until the job is finished or the wait expires (long polling)."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    # Flask answers the default of None when the value doesn't parse.
+    wait = request.args.get('wait', type=float) if 'wait' in request.args else 0.0
+    if wait is None or math.isnan(wait):
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    wait = min(max(wait, 0.0), JOB_MAX_WAIT_SECONDS)
+    if wait > 0:
+        job.wait(wait)
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id: str):
+    """Subscribes to a job as server-sent events: the intermediate events, if any, then `done` or `error`."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    def generate() -> Iterator[str]:
+        for event, data in job.iter_events(timeout=JOB_MAX_WAIT_SECONDS):
+            yield sse_event(event, data)
+
+    return sse_response(generate())
+
+@app.route('/jobs/stats')
+def job_stats():
+    return jsonify(job_queue.stats())
+
+def transcribe_audio_bytes(audio_bytes: bytes) -> str:
+    """Transcribes an uploaded recording, going through the transcript cache.
+
+    Args:
+        audio_bytes (bytes): the uploaded audio file.
+
+    Returns:
+        str: the transcribed text, empty when the recording has no speech.
+    """
+    metrics.observe_audio('web', len(audio_bytes))
+    cache_key = transcript_cache_key(data=audio_bytes)
+    transcribed_text = RESPONSE_CACHE.get(cache_key)
+    metrics.annotate(transcript_cached=transcribed_text is not None)
+    if transcribed_text is not None:
+        return transcribed_text
+    try:
+        if needs_chunked_transcription(audio_bytes):
+            # Long recordings are split on silence and the chunks are transcribed in parallel.
+            transcribed_text = transcribe_long_voice_data(audio_bytes)
+        else:
+            # The silence is trimmed first. Browsers usually record WebM/Opus or AAC, which are uploaded untouched
+            # unless there is a lot of silence to cut. Anything else is encoded compactly.
+            audio_data, audio_format = prepare_speech_for_asr(audio_bytes)
 
             # Send audio file to Whisper ASR API
-            transcribed_text = transcribe_voice_message(temp_output_file.name)
+            transcribed_text = transcribe_voice_data(audio_data, audio_format)
+    except NoSpeechDetected as e:
+        # Not cached: the detector may be wrong, and uploading the recording again must give it another chance.
+        print(e)
+        return ''
+    RESPONSE_CACHE.set(cache_key, transcribed_text)
 
     print(transcribed_text)
-    return jsonify(transcribed_text)
+    return transcribed_text
+
+def sse_response(events: Iterator[str]) -> Response:
+    # Disable the buffering of reverse proxies like Nginx, otherwise the events arrive all at once.
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def sse_event(event: str, data: Any) -> str:
+    """Formats a server-sent event. The data is JSON encoded, so the newlines in the text don't break the framing."""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+def iterate_async_generator(agen: AsyncIterator) -> Iterator:
+    """Consumes an async generator from the synchronous Flask handlers, one item at a time, on a private event loop.
+    The pooled aiohttp session belongs to that loop, so it's closed together with the loop.
+
+    Args:
+        agen (AsyncIterator): the async generator, e.g. gpt_process_text_async(...).
+
+    Yields:
+        The items of agen, as soon as each of them arrives.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        # Also reached when the client disconnects and the generator is closed midway.
+        loop.run_until_complete(agen.aclose())
+        loop.run_until_complete(close_http_clients())
+        loop.close()
 
 # Replace with your OpenAI API key
 @app.route('/process', methods=['POST'])
+@metrics.traced('flask.process')
 def process_audio():
     if request.method == 'POST':
         data = request.get_json(force=True)
@@ -52,6 +243,16 @@ def process_audio():
             log_content_to_file(processed_text, PERSONAL_LOG_FILE)
         return jsonify(processed_text)
 
+@app.route('/cache/stats')
+def cache_stats():
+    # Hit/miss counters of the transcript (asr) and GPT output (chat) caches.
+    return jsonify(RESPONSE_CACHE.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Per-stage latency histograms, audio sizes and token counts, in the Prometheus text format.
+    return Response(metrics.render_prometheus(), content_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/')
 def index():
     return send_from_directory('static', 'index.html')
@@ -64,9 +265,8 @@ def log_content_to_file(content: str, file_name: str):
         content (str): Content to be logged.
         file_name (str): Logging filename.
     """
-    content_json = json.dumps({'content': content, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, ensure_ascii=False)
-    with open(file_name, 'a', encoding='UTF-8') as f:
-        f.write(content_json + '\n')
+    # Only queued here. The journal writes it in the background, so the request doesn't wait for the disk.
+    get_journal(file_name).write({'content': content, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
 
 if __name__ == '__main__':
     app.run(debug=True)
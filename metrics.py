@@ -0,0 +1,287 @@
+"""
+This file holds the lightweight tracing and metrics shared by core, the Telegram bot and the web app.
+* span / record_stage: time a stage of the current request, e.g. telegram_download, transcode, whisper, outline_intent, gpt_first_token or telegram_edit.
+  Every timing goes to the STAGE_SECONDS histogram, and to the trace of the request when there is one.
+* start_trace / traced: opens the trace of a request, e.g. a voice message or a web request. The trace follows the request through the asyncio tasks it creates.
+  When TRACE_LOG_FILE is set, each finished trace is written to it as a JSON line, with its spans and attributes (audio bytes/seconds, trimmed silence, token counts...).
+  The file is a journal (see journal.py), so the traces are written by its background thread, and rotated and compressed like the personal log.
+* render_prometheus: the histograms and counters in the Prometheus text format, served by the web app at /metrics,
+  and by the bot with serve_metrics when METRICS_PORT is set.
+The hot path only costs a perf_counter call, a bisect and a lock per stage, so the instrumentation is always on.
+"""
+import os
+import time
+import uuid
+import bisect
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from journal import get_journal
+
+# Write each finished trace to this file as a JSON line. Disabled when empty.
+TRACE_LOG_FILE = os.environ.get('TRACE_LOG_FILE', '')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+BYTES_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(8))
+AUDIO_SECONDS_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Histogram:
+    """A Prometheus histogram with fixed buckets.
+
+    Args:
+        name (str): the metric name.
+        help (str): the description.
+        buckets (Sequence[float]): the upper bounds of the buckets, sorted. +Inf is implied.
+        label_names (Sequence[str]): the names of the labels, whose values are passed to observe in the same order.
+    """
+    def __init__(self, name: str, help: str, buckets: Sequence[float], label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        # Label values -> [count per bucket (the last one is +Inf), sum].
+        self._series: Dict[Tuple[str, ...], List] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{_format_number(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_number(total)}'
+            yield f'{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}'
+
+class Counter:
+    """A Prometheus counter.
+
+    Args:
+        name (str): the metric name, ending with _total.
+        help (str): the description.
+        label_names (Sequence[str]): the names of the labels, whose values are passed to inc in the same order.
+    """
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_format_labels(self.label_names, labels)} {_format_number(value)}'
+
+REGISTRY: List[Any] = []
+
+STAGE_SECONDS = Histogram('voicenote_stage_seconds', 'Time spent in each stage of the requests.', SECONDS_BUCKETS, ['stage'])
+REQUEST_SECONDS = Histogram('voicenote_request_seconds', 'End-to-end time of the requests, per kind of trace.', SECONDS_BUCKETS, ['trace'])
+AUDIO_BYTES = Histogram('voicenote_audio_bytes', 'Size of the received voice notes.', BYTES_BUCKETS, ['source'])
+AUDIO_SECONDS = Histogram('voicenote_audio_seconds', 'Duration of the received voice notes, when known.', AUDIO_SECONDS_BUCKETS, ['source'])
+TOKENS = Counter('voicenote_tokens_total', 'Tokens used by the GPT calls.', ['model', 'kind'])
+TRIMMED_SILENCE_SECONDS = Histogram('voicenote_trimmed_silence_seconds', 'Silence cut from the voice notes before the transcription.',
+                                    (0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+SILENT_NOTES = Counter('voicenote_silent_notes_total', 'Voice notes dropped before the transcription because they had no speech.')
+REQUEST_ERRORS = Counter('voicenote_request_errors_total', 'Requests ended by an exception, per kind of trace.', ['trace'])
+
+class Trace:
+    """The timings and attributes of one request.
+
+    Args:
+        name (str): the kind of request, e.g. telegram.voice.
+        attrs (Dict[str, Any]): the initial attributes, e.g. the chat id.
+    """
+    __slots__ = ('name', 'trace_id', 'start', 'wall_start', 'attrs', 'spans')
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.attrs = attrs
+        # (stage, offset from the start of the trace, duration)
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def to_dict(self, duration: float) -> Dict[str, Any]:
+        return {
+            'trace': self.name,
+            'trace_id': self.trace_id,
+            'start': round(self.wall_start, 3),
+            'duration': round(duration, 4),
+            'attrs': self.attrs,
+            'spans': [{'stage': stage, 'offset': round(offset, 4), 'duration': round(duration, 4)} for stage, offset, duration in self.spans],
+        }
+
+# The trace of the running request. asyncio tasks copy it when created, so the speculative tasks of a request report to the same trace.
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('voicenote_trace', default=None)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+@contextlib.contextmanager
+def start_trace(name: str, **attrs) -> Iterator[Trace]:
+    """Opens the trace of a request for the duration of the block.
+
+    Args:
+        name (str): the kind of request, used as the label of REQUEST_SECONDS.
+        attrs: the initial attributes of the trace.
+    """
+    trace = Trace(name, attrs)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.attrs['error'] = type(e).__name__
+        REQUEST_ERRORS.inc(1, name)
+        raise
+    finally:
+        duration = time.perf_counter() - trace.start
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # The block was left from another context, e.g. a streamed response closed by another thread.
+            pass
+        REQUEST_SECONDS.observe(duration, name)
+        if TRACE_LOG_FILE:
+            _write_trace(trace, duration)
+
+def traced(name: str):
+    """Decorates a handler, sync or async, so each call runs in its own trace."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with start_trace(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_trace(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _write_trace(trace: Trace, duration: float):
+    # Only queued here: the journal thread serializes and appends it, so the event loop never waits for the disk.
+    get_journal(TRACE_LOG_FILE).write(trace.to_dict(duration))
+
+def record_stage(stage: str, seconds: float, start: Optional[float] = None, traced: bool = True):
+    """Records the duration of a stage.
+
+    Args:
+        stage (str): the stage name.
+        seconds (float): the duration.
+        start (Optional[float]): the perf_counter value when the stage started. Defaults to now minus the duration.
+        traced (bool): whether to add it to the current trace too. Set it to False in long-lived tasks, whose context belongs to an earlier request.
+    """
+    STAGE_SECONDS.observe(seconds, stage)
+    trace = _current_trace.get() if traced else None
+    if trace is not None:
+        if start is None:
+            start = time.perf_counter() - seconds
+        trace.spans.append((stage, start - trace.start, seconds))
+
+@contextlib.contextmanager
+def span(stage: str, traced: bool = True) -> Iterator[None]:
+    """Records the duration of the block as a stage. Works around awaits too."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, start, traced)
+
+def annotate(**attrs):
+    """Sets attributes of the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+def observe_audio(source: str, num_bytes: int, seconds: Optional[float] = None):
+    """Records the size, and the duration when known, of a received voice note."""
+    AUDIO_BYTES.observe(num_bytes, source)
+    if seconds is not None:
+        AUDIO_SECONDS.observe(seconds, source)
+    annotate(audio_bytes=num_bytes, audio_seconds=seconds)
+
+def observe_silence_trim(trimmed_seconds: float, silent: bool = False):
+    """Records the silence cut from a voice note, and whether the whole note was silent."""
+    TRIMMED_SILENCE_SECONDS.observe(trimmed_seconds)
+    if silent:
+        SILENT_NOTES.inc()
+    annotate(trimmed_seconds=round(trimmed_seconds, 2), silent=silent)
+
+def count_tokens(model: str, kind: str, count: int):
+    """Counts the tokens of a GPT call, e.g. kind='completion', and adds them to the current trace."""
+    TOKENS.inc(count, model, kind)
+    trace = _current_trace.get()
+    if trace is not None:
+        key = f'{kind}_tokens'
+        trace.attrs[key] = trace.attrs.get(key, 0) + count
+
+def render_prometheus() -> str:
+    """All the metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the logs.
+        pass
+
+def serve_metrics(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Serves /metrics on a daemon thread, for the processes without a web server, i.e. the Telegram bot."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,293 @@
+"""
+This file holds the outline document edited by voice in the outline mode of the Telegram bot, stored in user_data['outline'].
+* OutlineDocument: the lines of the outline, each with a stable id and a nesting depth, kept in an implicit treap,
+  so inserting, replacing or removing the line at any position costs O(log n).
+  The line numbers coming back from classify_outline_content are 1-based and untrusted, so the line-based edits clamp or reject them instead of raising.
+* OutlineDocument.paginate: splits the rendered outline into Telegram-sized pages. The page breaks of the previous rendering are kept when possible,
+  so an edit only changes the pages it touches and the bot only edits those messages.
+"""
+import random
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+INDENT = '  '
+BULLET = '* '
+
+class OutlineNode:
+    """A line of the outline, and a node of the treap.
+
+    Args:
+        node_id (int): the stable id of the line.
+        text (str): the content of the line, without the bullet.
+        depth (int): the nesting level, 0 for the top level.
+        priority (float): the heap priority of the treap.
+    """
+    __slots__ = ('id', 'text', 'depth', 'priority', 'size', 'left', 'right', 'parent')
+
+    def __init__(self, node_id: int, text: str, depth: int, priority: float):
+        self.id = node_id
+        self.text = text
+        self.depth = depth
+        self.priority = priority
+        # Number of nodes in the subtree, which gives the position of the nodes without storing it.
+        self.size = 1
+        self.left: Optional['OutlineNode'] = None
+        self.right: Optional['OutlineNode'] = None
+        self.parent: Optional['OutlineNode'] = None
+
+    def __repr__(self) -> str:
+        return f'OutlineNode({self.id}, {self.text!r}, depth={self.depth})'
+
+def _size(node: Optional[OutlineNode]) -> int:
+    return node.size if node is not None else 0
+
+def _update(node: OutlineNode):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+
+def _split(node: Optional[OutlineNode], count: int) -> Tuple[Optional[OutlineNode], Optional[OutlineNode]]:
+    """Splits the subtree into its first `count` nodes and the rest."""
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        left, node.left = _split(node.left, count)
+        _update(node)
+        if left is not None:
+            left.parent = None
+        return left, node
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    _update(node)
+    if right is not None:
+        right.parent = None
+    return node, right
+
+def _merge(left: Optional[OutlineNode], right: Optional[OutlineNode]) -> Optional[OutlineNode]:
+    """Concatenates two subtrees."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+class OutlineDocument:
+    """The lines of an outline, in order. Positions are 0-based indices, and lines are 1-based line numbers, as shown to the user."""
+    def __init__(self):
+        self._root: Optional[OutlineNode] = None
+        self._nodes: Dict[int, OutlineNode] = {}
+        self._next_id = 1
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]) -> 'OutlineDocument':
+        """Builds a document from rendered lines, e.g. the plain list the outline mode used to keep in user_data['outline_text']."""
+        document = cls()
+        for line in lines:
+            stripped = line.lstrip(' ')
+            depth = (len(line) - len(stripped)) // len(INDENT)
+            document.append(stripped[len(BULLET):] if stripped.startswith(BULLET) else stripped, depth)
+        return document
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __repr__(self) -> str:
+        return f'OutlineDocument({len(self)} lines)'
+
+    def __contains__(self, node_id: int) -> bool:
+        return node_id in self._nodes
+
+    def __iter__(self) -> Iterator[OutlineNode]:
+        stack: List[OutlineNode] = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def node(self, node_id: int) -> Optional[OutlineNode]:
+        return self._nodes.get(node_id)
+
+    def node_at(self, index: int) -> Optional[OutlineNode]:
+        """The node at the 0-based position, or None when out of range."""
+        if not 0 <= index < len(self):
+            return None
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def index_of(self, node_id: int) -> int:
+        """The 0-based position of the node, found by walking up to the root."""
+        node = self._nodes[node_id]
+        index = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                index += _size(node.parent.left) + 1
+            node = node.parent
+        return index
+
+    def insert(self, index: int, text: str, depth: int = 0) -> OutlineNode:
+        """Inserts a line at the 0-based position, clamped to the document.
+
+        Args:
+            index (int): the position of the new line.
+            text (str): the content of the line.
+            depth (int, optional): the nesting level, at most one more than the line before it.
+
+        Returns:
+            OutlineNode: the new line.
+        """
+        index = min(max(index, 0), len(self))
+        previous = self.node_at(index - 1)
+        depth = min(max(depth, 0), previous.depth + 1 if previous is not None else 0)
+        node = OutlineNode(self._next_id, text, depth, random.random())
+        self._next_id += 1
+        self._nodes[node.id] = node
+        left, right = _split(self._root, index)
+        self._set_root(_merge(_merge(left, node), right))
+        return node
+
+    def append(self, text: str, depth: int = 0) -> OutlineNode:
+        return self.insert(len(self), text, depth)
+
+    def remove(self, node_id: int) -> OutlineNode:
+        """Removes a line by id. Its children move up one level, so the nesting stays valid."""
+        index = self.index_of(node_id)
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._set_root(_merge(left, right))
+        del self._nodes[node_id]
+        node.left = node.right = node.parent = None
+        for child in self._following_children(index, node.depth):
+            child.depth -= 1
+        return node
+
+    def set_depth(self, node_id: int, depth: int) -> int:
+        """Changes the nesting level of a line, clamped between 0 and one more than the line before it. Returns the new depth."""
+        index = self.index_of(node_id)
+        previous = self.node_at(index - 1)
+        node = self._nodes[node_id]
+        node.depth = min(max(depth, 0), previous.depth + 1 if previous is not None else 0)
+        return node.depth
+
+    def _following_children(self, index: int, depth: int) -> Iterator[OutlineNode]:
+        # The lines nested under a line are the ones right after it, with a greater depth.
+        while True:
+            node = self.node_at(index)
+            if node is None or node.depth <= depth:
+                return
+            yield node
+            index += 1
+
+    def _set_root(self, root: Optional[OutlineNode]):
+        self._root = root
+        if root is not None:
+            root.parent = None
+
+    def insert_after_line(self, line: int, text: str) -> OutlineNode:
+        """Adds a line after the 1-based line number, at the same depth. A negative number, e.g. -1, or any number past the end appends it;
+        0 inserts it first."""
+        if line < 0 or line > len(self):
+            line = len(self)
+        previous = self.node_at(line - 1)
+        return self.insert(line, text, previous.depth if previous is not None else 0)
+
+    def replace_line(self, line: int, text: str) -> Optional[OutlineNode]:
+        """Replaces the content of the 1-based line number. Returns None, without any change, when the line doesn't exist."""
+        node = self.node_at(line - 1)
+        if node is not None:
+            node.text = text
+        return node
+
+    def remove_line(self, line: int) -> Optional[OutlineNode]:
+        """Removes the 1-based line number. Returns None, without any change, when the line doesn't exist."""
+        node = self.node_at(line - 1)
+        return self.remove(node.id) if node is not None else None
+
+    @staticmethod
+    def render_line(node: OutlineNode) -> str:
+        return INDENT * node.depth + BULLET + node.text
+
+    def lines(self) -> List[str]:
+        return [self.render_line(node) for node in self]
+
+    def text(self) -> str:
+        return '\n'.join(self.lines())
+
+    def paginate(self, limit: int = 4096, breaks: Iterable[int] = ()) -> List[Tuple[int, str]]:
+        """Splits the rendered outline into pages of at most `limit` characters, without cutting lines unless a single line is too long.
+        A new page starts at each line whose id is in `breaks` (the page starts of the previous rendering), or when the page is full.
+        The lines pushed out of a full page are carried into the next page, ignoring its break, rather than getting a page of their own,
+        so the pages after the last overflowing one keep both their text and their index, i.e. their message.
+        New pages are only filled to 3/4 of the limit, so that the lines added later fit without overflowing.
+
+        Args:
+            limit (int, optional): the maximum length of a page.
+            breaks (Iterable[int], optional): ids of the lines that started a page before.
+
+        Returns:
+            List[Tuple[int, str]]: the id of the first line, and the text, of each page. Empty when the document is.
+        """
+        breaks = list(breaks)
+        was_paginated = bool(breaks)
+        # The first page starts at the first line, whatever it is now.
+        breaks = set(breaks[1:])
+        pages: List[Tuple[int, str]] = []
+        start_id: Optional[int] = None
+        lines: List[str] = []
+        length = 0
+        page_limit = limit
+        carrying = False
+        for node in self:
+            line = self.render_line(node)
+            if lines and node.id in breaks and not carrying:
+                pages.append((start_id, '\n'.join(lines)))
+                lines, length = [], 0
+            elif lines and length + 1 + len(line) > page_limit:
+                pages.append((start_id, '\n'.join(lines)))
+                lines, length = [], 0
+                carrying = True
+            elif node.id in breaks:
+                # The carried lines fit in this former page.
+                carrying = False
+                page_limit = limit
+            if not lines:
+                start_id = node.id
+                page_limit = limit if node.id in breaks or was_paginated and not pages else limit * 3 // 4
+            # A line longer than a page fills pages of its own. The page before it was flushed above, since the line can't fit in it.
+            while len(line) > limit:
+                pages.append((start_id, line[:limit]))
+                line = line[limit:]
+            length += len(line) + (1 if lines else 0)
+            lines.append(line)
+        if lines:
+            pages.append((start_id, '\n'.join(lines)))
+        return pages
+
+    def __getstate__(self):
+        # Pickled as a flat list, so the persisted form doesn't depend on the random shape of the treap.
+        return {'lines': [(node.id, node.text, node.depth) for node in self], 'next_id': self._next_id}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for node_id, text, depth in state['lines']:
+            node = OutlineNode(node_id, text, depth, random.random())
+            self._nodes[node_id] = node
+            self._set_root(_merge(self._root, node))
+        self._next_id = state['next_id']
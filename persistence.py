@@ -0,0 +1,286 @@
+"""
+This file holds the persistence backend of the Telegram bot, replacing PicklePersistence("gpt_archive.pickle").
+PicklePersistence re-serializes every user's whole history into one file on every flush, and unpickles all of it on startup.
+SQLitePersistence instead keeps one row per user and one row per history entry:
+* user_data is loaded lazily, the first time an update from the user is processed, so startup time doesn't depend on the archive size.
+* Only the history entries that were added or changed since the last flush are written.
+* The history is loaded as a PagedHistory, so only the most recent entries are kept in memory, and older ones are read on demand.
+It also contains migrate_pickle_persistence, a one-shot migrator from the existing pickle file.
+
+Usage of the migrator:
+    python persistence.py gpt_archive.pickle gpt_archive.sqlite3
+"""
+import sys
+import json
+import pickle
+import asyncio
+import sqlite3
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from telegram.ext import BasePersistence, PersistenceInput
+from history import HistoryEntry, PagedHistory, HISTORY_HOT_ENTRIES
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS history (user_id INTEGER, idx INTEGER, entry BLOB, PRIMARY KEY (user_id, idx));
+CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS singletons (name TEXT PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));
+"""
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _load_entry(blob: bytes) -> HistoryEntry:
+    entry = pickle.loads(blob)
+    # Entries migrated from the pickle archive are still in the former dict format.
+    return entry if isinstance(entry, HistoryEntry) else HistoryEntry.from_dict(entry)
+
+class SQLitePersistence(BasePersistence):
+    """A BasePersistence storing the bot data in SQLite, with per-user rows and per-entry history writes.
+
+    Args:
+        filepath (str): the SQLite file.
+        store_data (Optional[PersistenceInput]): which kinds of data to store. Defaults to all of them.
+        update_interval (float): seconds between two flushes of the changed data by the Application.
+    """
+    def __init__(self, filepath: str, store_data: Optional[PersistenceInput] = None, update_interval: float = 60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        # All the database work runs on this single thread, so the event loop never waits for the disk,
+        # and the connection is only ever used from one thread.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._db: Optional[sqlite3.Connection] = None
+        # Older history entries are paged in from the handlers' thread, or from the executor by PagedHistory.slice_async,
+        # through separate read connections.
+        self._readers = threading.local()
+        self._loaded_user_ids = set()
+        # The users whose data could not be loaded. Their user_data in the Application is empty rather than what is stored,
+        # so it's never written back, or it would replace the stored data.
+        self._failed_user_ids = set()
+        # What is known to be on disk for each user: the pickled non-history fields, the number of history entries,
+        # and the pickle of the last entry, which is the only one the bot modifies after appending it.
+        self._user_blobs: Dict[int, bytes] = {}
+        self._history_counts: Dict[int, int] = {}
+        self._last_entry_blobs: Dict[int, bytes] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.filepath, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    # user_data
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        # Nothing is loaded up front, see refresh_user_data.
+        return {}
+
+    def _read_history(self, user_id: int, start: int, stop: int) -> List[HistoryEntry]:
+        """The loader of PagedHistory: reads the entries [start, stop) of a user."""
+        reader = getattr(self._readers, 'db', None)
+        if reader is None:
+            self._connect()
+            reader = self._readers.db = sqlite3.connect(self.filepath, isolation_level=None)
+        rows = reader.execute('SELECT entry FROM history WHERE user_id = ? AND idx >= ? AND idx < ? ORDER BY idx', (user_id, start, stop)).fetchall()
+        return [_load_entry(entry) for (entry,) in rows]
+
+    def _load_user(self, user_id: int) -> Dict:
+        db = self._connect()
+        row = db.execute('SELECT data FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        count = db.execute('SELECT COUNT(*) FROM history WHERE user_id = ?', (user_id,)).fetchone()[0]
+        if row is None and not count:
+            return {}
+        data = pickle.loads(row[0]) if row is not None else {}
+        self._user_blobs[user_id] = row[0] if row is not None else b''
+        # Only the most recent entries are read, so loading a user costs the same no matter how long the history is.
+        offset = max(0, count - HISTORY_HOT_ENTRIES)
+        entries = db.execute('SELECT entry FROM history WHERE user_id = ? AND idx >= ? ORDER BY idx', (user_id, offset)).fetchall()
+        history = PagedHistory([_load_entry(entry) for (entry,) in entries], offset=offset)
+        history.mark_persisted(count, partial(self._read_history, user_id), self._executor)
+        data['history'] = history
+        self._history_counts[user_id] = count
+        if entries:
+            self._last_entry_blobs[user_id] = entries[-1][0]
+        return data
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        # Called by the Application before the handlers of an update run, which is where the user's data is loaded on first access.
+        if user_id in self._loaded_user_ids:
+            return
+        try:
+            loaded = await self._run(self._load_user, user_id)
+        except Exception:
+            # Loaded again on the next update. The error is reported by the Application, and the handlers don't run.
+            self._failed_user_ids.add(user_id)
+            raise
+        self._loaded_user_ids.add(user_id)
+        self._failed_user_ids.discard(user_id)
+        # Anything set before the data was loaded wins over what is stored.
+        for key, value in loaded.items():
+            user_data.setdefault(key, value)
+
+    def _write_user(self, user_id: int, data: Dict):
+        if user_id in self._failed_user_ids:
+            print(f'Not writing the data of user {user_id}, which could not be loaded.')
+            return
+        db = self._connect()
+        fields = {key: value for key, value in data.items() if key != 'history'}
+        blob = _dumps(fields)
+        if self._user_blobs.get(user_id) != blob:
+            db.execute('INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)', (user_id, blob))
+            self._user_blobs[user_id] = blob
+
+        history = data.get('history', [])
+        stored_count = self._history_counts.get(user_id)
+        if stored_count is None:
+            stored_count = db.execute('SELECT COUNT(*) FROM history WHERE user_id = ?', (user_id,)).fetchone()[0]
+        if len(history) < stored_count:
+            # The history was cleared or truncated.
+            db.execute('DELETE FROM history WHERE user_id = ? AND idx >= ?', (user_id, len(history)))
+            stored_count = len(history)
+            self._last_entry_blobs.pop(user_id, None)
+        rows = []
+        # The last stored entry may have been changed since (e.g. by process_thoughts), the ones before are immutable.
+        # All of these are in memory, because PagedHistory never evicts the last stored entry or anything after it.
+        for idx in range(max(0, stored_count - 1), len(history)):
+            entry_blob = _dumps(history[idx])
+            if idx == stored_count - 1 and self._last_entry_blobs.get(user_id) == entry_blob:
+                continue
+            rows.append((user_id, idx, entry_blob))
+        if rows:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO history (user_id, idx, entry) VALUES (?, ?, ?)', rows)
+            db.execute('COMMIT')
+        self._history_counts[user_id] = len(history)
+        if rows and rows[-1][1] == len(history) - 1:
+            self._last_entry_blobs[user_id] = rows[-1][2]
+        if isinstance(history, PagedHistory):
+            # Lets the in-memory history evict the entries that are now on disk.
+            history.mark_persisted(len(history), partial(self._read_history, user_id), self._executor)
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        await self._run(self._write_user, user_id, data)
+
+    def _drop_user(self, user_id: int):
+        db = self._connect()
+        db.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        db.execute('DELETE FROM history WHERE user_id = ?', (user_id,))
+        for cache in (self._user_blobs, self._history_counts, self._last_entry_blobs):
+            cache.pop(user_id, None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._run(self._drop_user, user_id)
+
+    def _list_user_ids(self) -> List[int]:
+        db = self._connect()
+        return [user_id for (user_id,) in db.execute('SELECT user_id FROM users UNION SELECT DISTINCT user_id FROM history')]
+
+    async def get_user_ids(self) -> List[int]:
+        """Returns the ids of every user with stored data, including the ones not loaded yet."""
+        return await self._run(self._list_user_ids)
+
+    async def load_user_data(self, user_id: int) -> Dict:
+        """Reads a user's stored data, without going through the Application, e.g. for scheduled jobs."""
+        return await self._run(self._load_user, user_id)
+
+    # chat_data, bot_data and callback_data are small, so they are stored as one blob each.
+
+    def _read_table(self, query: str) -> List[Tuple]:
+        return self._connect().execute(query).fetchall()
+
+    def _execute(self, query: str, parameters: Tuple):
+        self._connect().execute(query, parameters)
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        rows = await self._run(self._read_table, 'SELECT chat_id, data FROM chats')
+        return {chat_id: pickle.loads(data) for chat_id, data in rows}
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        await self._run(self._execute, 'INSERT OR REPLACE INTO chats (chat_id, data) VALUES (?, ?)', (chat_id, _dumps(data)))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._run(self._execute, 'DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def _get_singleton(self, name: str):
+        rows = await self._run(self._read_table, 'SELECT name, data FROM singletons')
+        return next((pickle.loads(data) for row_name, data in rows if row_name == name), None)
+
+    async def get_bot_data(self) -> Dict:
+        return await self._get_singleton('bot_data') or {}
+
+    async def update_bot_data(self, data: Dict) -> None:
+        await self._run(self._execute, 'INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)', ('bot_data', _dumps(data)))
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> Optional[Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]]:
+        return await self._get_singleton('callback_data')
+
+    async def update_callback_data(self, data: Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]) -> None:
+        await self._run(self._execute, 'INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)', ('callback_data', _dumps(data)))
+
+    # conversations
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        rows = await self._run(self._read_table, 'SELECT name, key, state FROM conversations')
+        return {tuple(json.loads(key)): pickle.loads(state) for row_name, key, state in rows if row_name == name}
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        if new_state is None:
+            await self._run(self._execute, 'DELETE FROM conversations WHERE name = ? AND key = ?', (name, json.dumps(key)))
+        else:
+            await self._run(self._execute, 'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                            (name, json.dumps(key), _dumps(new_state)))
+
+    async def flush(self) -> None:
+        # Every write is committed as it happens, so there is nothing buffered. Just release the database.
+        def close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        await self._run(close)
+
+def migrate_pickle_persistence(pickle_file: str, db_file: str) -> int:
+    """Copies the data of a single-file PicklePersistence into an SQLitePersistence database.
+
+    Args:
+        pickle_file (str): the PicklePersistence file, e.g. gpt_archive.pickle.
+        db_file (str): the SQLite file to create or fill.
+
+    Returns:
+        int: the number of users migrated.
+    """
+    with open(pickle_file, 'rb') as f:
+        data = pickle.load(f)
+    persistence = SQLitePersistence(db_file)
+    for user_id, user_data in data.get('user_data', {}).items():
+        persistence._write_user(user_id, user_data)
+    for chat_id, chat_data in data.get('chat_data', {}).items():
+        persistence._execute('INSERT OR REPLACE INTO chats (chat_id, data) VALUES (?, ?)', (chat_id, _dumps(chat_data)))
+    if data.get('bot_data'):
+        persistence._execute('INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)', ('bot_data', _dumps(data['bot_data'])))
+    if data.get('callback_data'):
+        persistence._execute('INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)', ('callback_data', _dumps(data['callback_data'])))
+    for name, states in (data.get('conversations') or {}).items():
+        for key, state in states.items():
+            persistence._execute('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)', (name, json.dumps(key), _dumps(state)))
+    persistence._connect().close()
+    return len(data.get('user_data', {}))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    print(f'Migrated {migrate_pickle_persistence(sys.argv[1], sys.argv[2])} users.')
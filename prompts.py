@@ -83,6 +83,20 @@ GPT，帮我写一篇200字的文章
     
     'high-eq-style': """请扮演我的对话教练，帮助我把我的语言加工地更加“高情商”一些。我说话的问题是过度理性，只关注事实，但是会假设对方和我一样理性，从而不关注对方的感受。有的时候让对方觉得我缺乏关心，缺乏同理心，从而不喜欢我。我接下来给你我的话，你帮我用更高情商的方式重述。听懂了不需要回答我。""",
     
+    'long-input-chunk-user-template': """CONTEXT (the end of the previous part of the text, for reference only. Don't output it):
+{context}
+
+TEXT:
+{text}""",
+
+    'long-input-reduce-user-template': """The text was too long, so it was split into parts and each part was processed separately. The results of the parts are below, in order. Merge them into one result for the whole text, following the same instructions. Only output the merged result.
+
+{parts}""",
+
+    'daily-summary': """下面是我一天里用语音记下的笔记，每条前面是记录的时间。请用中文写一份简明的当日总结：先写最重要的想法和结论，再列出提到的待办事项（如果有）。相关的笔记放在一起总结，不要逐条复述，也不要编造笔记里没有的内容。""",
+
+    'weekly-summary': """下面是我过去一周每天的笔记总结，每段前面是日期。请用中文写一份周总结：归纳这一周的主要主题和进展，指出想法在这一周里的变化，并列出仍待完成的事项。不要编造总结里没有的内容。""",
+
     'help-think': """阅读下面的文本，输出一个简明的有启发性的问题，一个简明的对作者观点的批判反驳，以帮助作者进一步思考""",
 }
 
@@ -91,4 +105,13 @@ CHOICE_TO_PROMPT = {
     '装逼':   PROMPTS['zhuangbility-style'],
     '高情商': PROMPTS['high-eq-style'],
     '思考':   PROMPTS['help-think'],
-}
\ No newline at end of file
+}
+
+# These prompts need a view of the whole text, e.g. summaries. When a long text is processed in chunks,
+# the outputs of the chunks are merged by one more call with the same prompt, instead of being joined.
+GLOBAL_VIEW_PROMPTS = frozenset([
+    PROMPTS['hmw-style'],
+    PROMPTS['help-think'],
+    PROMPTS['daily-summary'],
+    PROMPTS['weekly-summary'],
+])
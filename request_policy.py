@@ -0,0 +1,352 @@
+"""
+This file holds the request execution layer of core. Every call to the OpenAI API goes through REQUESTS, which adds:
+* A deadline for the whole call, retries included. DeadlineExceeded is raised when it passes.
+* Retries on the errors worth retrying (rate limits, 5xx, timeouts, connection errors), after a jittered exponential backoff, or the Retry-After of the API.
+* Hedging: when an attempt takes longer than the p95 latency of its endpoint and model, a backup attempt is started, and the first one to complete wins.
+  Hedges are limited to HEDGE_MAX_RATIO of the calls, so that a slow API doesn't get twice the load.
+The latencies are tracked per endpoint and model over a rolling window by LATENCIES, which also drives route_model:
+a model whose p95 time to first token is over its budget in LATENCY_BUDGETS is replaced by LATENCY_FALLBACK_MODEL, until its old samples expire.
+The deadline, retries and hedging of the calls made inside `with using_policy(...)` can be changed, e.g. BACKGROUND_POLICY for the daily summaries.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+import contextlib
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, NamedTuple, Optional, Set, Tuple, TypeVar
+import aiohttp
+import openai
+import metrics
+
+# The default deadline of a call, retries included.
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 120))
+REQUEST_MAX_RETRIES = int(os.environ.get('REQUEST_MAX_RETRIES', 2))
+# The backoff before the nth retry is random between 0 and RETRY_BASE_SECONDS * 2^n, capped to RETRY_MAX_SECONDS.
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 8
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '1') not in ('', '0', 'false')
+HEDGE_QUANTILE = 0.95
+# Never hedge sooner than this, so the fast calls are never sent twice.
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('HEDGE_MIN_DELAY_SECONDS', 1.0))
+# At most this fraction of the calls get a backup attempt.
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', 0.1))
+# The latencies older than this are forgotten, so that the decisions follow the current state of the API.
+LATENCY_WINDOW_SECONDS = 600
+LATENCY_WINDOW_SAMPLES = 500
+# The percentiles are only trusted, and acted upon, with this many samples.
+LATENCY_MIN_SAMPLES = 20
+# The p95 time to first token each model should stay under, e.g. 'gpt-4=10,gpt-4-32k=15'. Over it, the calls are routed to LATENCY_FALLBACK_MODEL.
+LATENCY_BUDGETS = {model: float(seconds) for model, seconds in
+                   (item.split('=') for item in os.environ.get('LATENCY_BUDGETS', 'gpt-4=10').split(',') if item)}
+LATENCY_FALLBACK_MODEL = os.environ.get('LATENCY_FALLBACK_MODEL', 'gpt-3.5-turbo')
+
+# The endpoints whose latencies are tracked.
+CHAT = 'chat'
+CHAT_FIRST_TOKEN = 'chat_first_token'
+WHISPER = 'whisper'
+
+T = TypeVar('T')
+
+REQUEST_RETRIES = metrics.Counter('voicenote_request_retries_total', 'Retries of the OpenAI calls, per endpoint.', ['endpoint'])
+HEDGED_REQUESTS = metrics.Counter('voicenote_hedged_requests_total', 'Backup attempts of the slow OpenAI calls, and how many of them won.', ['endpoint', 'outcome'])
+DEADLINES_EXCEEDED = metrics.Counter('voicenote_deadlines_exceeded_total', 'OpenAI calls given up at their deadline, per endpoint.', ['endpoint'])
+ROUTED_REQUESTS = metrics.Counter('voicenote_routed_requests_total', 'Calls sent to the fallback model because the chosen one was over its latency budget.',
+                                  ['model', 'fallback'])
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call didn't complete before its deadline, retries and hedges included."""
+
+class RequestPolicy(NamedTuple):
+    """How a call is executed.
+
+    Args:
+        deadline (float): seconds until the call is given up, retries included.
+        max_retries (int): number of retries after the first attempt.
+        hedge (bool): whether a backup attempt is started when the first one is slow.
+    """
+    deadline: float = REQUEST_DEADLINE_SECONDS
+    max_retries: int = REQUEST_MAX_RETRIES
+    hedge: bool = HEDGE_ENABLED
+
+DEFAULT_POLICY = RequestPolicy()
+# For the batch work, where the latency doesn't matter but the load does.
+BACKGROUND_POLICY = RequestPolicy(deadline=600, max_retries=4, hedge=False)
+
+_current_policy: 'contextvars.ContextVar[RequestPolicy]' = contextvars.ContextVar('request_policy', default=DEFAULT_POLICY)
+
+@contextlib.contextmanager
+def using_policy(policy: RequestPolicy) -> Iterator[None]:
+    """Executes the calls made inside the block, including in the tasks started from it, with the given policy."""
+    token = _current_policy.set(policy)
+    try:
+        yield
+    finally:
+        _current_policy.reset(token)
+
+def current_policy() -> RequestPolicy:
+    return _current_policy.get()
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether the error is transient, i.e. the same request may succeed later."""
+    if isinstance(error, DeadlineExceeded):
+        # A TimeoutError, like the timeouts worth retrying, but the time of the call is already over, e.g. in a nested call.
+        return False
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                          openai.error.APIConnectionError, openai.error.TryAgain, aiohttp.ClientError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+def retry_delay(error: BaseException, retry: int) -> float:
+    """The seconds to wait before the nth retry: the Retry-After of the API when it sends one, or else a random backoff (full jitter)."""
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('retry-after', 0))
+    except ValueError:
+        retry_after = 0
+    return max(retry_after, random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** retry)))
+
+class LatencyTracker:
+    """The latencies of the successful attempts, per endpoint and model, over the last LATENCY_WINDOW_SECONDS.
+    Thread-safe, since the blocking calls run on several threads.
+    """
+    def __init__(self, window_seconds: float = LATENCY_WINDOW_SECONDS, max_samples: int = LATENCY_WINDOW_SAMPLES):
+        self.window_seconds = window_seconds
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        # (time of the sample, latency) pairs, oldest first.
+        self._samples: Dict[Tuple[str, str], Deque[Tuple[float, float]]] = {}
+
+    def observe(self, endpoint: str, model: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get((endpoint, model))
+            if samples is None:
+                samples = self._samples[(endpoint, model)] = deque(maxlen=self.max_samples)
+            samples.append((time.monotonic(), seconds))
+
+    def percentile(self, endpoint: str, model: str, quantile: float = HEDGE_QUANTILE) -> Optional[float]:
+        """The latency under which `quantile` of the recent attempts completed, or None without enough samples."""
+        with self._lock:
+            samples = self._samples.get((endpoint, model))
+            if not samples:
+                return None
+            expired = time.monotonic() - self.window_seconds
+            while samples and samples[0][0] < expired:
+                samples.popleft()
+            if len(samples) < LATENCY_MIN_SAMPLES:
+                return None
+            latencies = sorted(seconds for _, seconds in samples)
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """The sample counts and the p50/p95 of each endpoint and model, e.g. for debugging."""
+        with self._lock:
+            keys = list(self._samples)
+        return {f'{endpoint}:{model}': {'p50': self.percentile(endpoint, model, 0.5), 'p95': self.percentile(endpoint, model, 0.95),
+                                        'samples': len(self._samples[(endpoint, model)])} for endpoint, model in keys}
+
+LATENCIES = LatencyTracker()
+
+def route_model(model: str) -> str:
+    """The model to use instead of `model`: LATENCY_FALLBACK_MODEL when the p95 time to first token of the model is over its budget, or else the model itself.
+    Once a model is avoided, its samples age out of the window, and it's tried again.
+    """
+    budget = LATENCY_BUDGETS.get(model)
+    if budget is None or model == LATENCY_FALLBACK_MODEL:
+        return model
+    p95 = LATENCIES.percentile(CHAT_FIRST_TOKEN, model)
+    if p95 is None or p95 <= budget:
+        return model
+    print(f'{model} is over its latency budget (p95 {p95:.1f}s > {budget}s), using {LATENCY_FALLBACK_MODEL} instead.')
+    ROUTED_REQUESTS.inc(1, model, LATENCY_FALLBACK_MODEL)
+    metrics.annotate(routed_from=model)
+    return LATENCY_FALLBACK_MODEL
+
+def _consume_exception(future):
+    # The exceptions of the losing attempts are not raised by anyone, and shouldn't be reported as never retrieved.
+    if not future.cancelled():
+        future.exception()
+
+class RequestExecutor:
+    """Runs the attempts of the calls with the current policy. An attempt is a function taking the seconds left until the deadline,
+    e.g. to pass them as request_timeout, and making one request.
+
+    Args:
+        latencies (LatencyTracker): where the latencies of the attempts are recorded, and the hedging delays are read.
+        max_workers (int): number of threads running the blocking attempts.
+    """
+    def __init__(self, latencies: LatencyTracker = LATENCIES, max_workers: int = 64):
+        self.latencies = latencies
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='request')
+        self._hedge_lock = threading.Lock()
+        # A token bucket: each call earns HEDGE_MAX_RATIO of a hedge, and each hedge costs one.
+        self._hedge_tokens = 1.0
+
+    def _hedge_delay(self, endpoint: str, model: str, policy: RequestPolicy) -> Optional[float]:
+        with self._hedge_lock:
+            self._hedge_tokens = min(10.0, self._hedge_tokens + HEDGE_MAX_RATIO)
+        if not policy.hedge:
+            return None
+        p95 = self.latencies.percentile(endpoint, model, HEDGE_QUANTILE)
+        return max(HEDGE_MIN_DELAY_SECONDS, p95) if p95 is not None else None
+
+    def _take_hedge(self, endpoint: str) -> bool:
+        with self._hedge_lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+        HEDGED_REQUESTS.inc(1, endpoint, 'fired')
+        return True
+
+    def _give_up(self, endpoint: str, policy: RequestPolicy, error: Optional[BaseException]):
+        DEADLINES_EXCEEDED.inc(1, endpoint)
+        raise DeadlineExceeded(f'The {endpoint} call did not complete within {policy.deadline} seconds') from error
+
+    # The awaitable calls
+
+    async def run_async(self, endpoint: str, model: str, attempt: Callable[[float], Awaitable[T]],
+                        discard: Optional[Callable[[T], Awaitable[None]]] = None) -> T:
+        """Runs the call with retries and hedging, within the deadline of the current policy.
+
+        Args:
+            endpoint (str): the endpoint, e.g. CHAT.
+            model (str): the model, e.g. gpt-4.
+            attempt (Callable[[float], Awaitable[T]]): makes one request, given the seconds left.
+            discard (Optional[Callable[[T], Awaitable[None]]]): releases the result of an attempt which completed but lost, e.g. closes a stream.
+
+        Returns:
+            T: the result of the first successful attempt.
+
+        Raises:
+            DeadlineExceeded: when the deadline passed first.
+            Exception: the error of the last attempt, when it's not retryable or there are no retries left.
+        """
+        policy = current_policy()
+        deadline = time.monotonic() + policy.deadline
+        error = None
+        for retry in range(policy.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                return await asyncio.wait_for(self._hedged_async(endpoint, model, attempt, discard, policy, deadline), remaining)
+            except Exception as e:
+                error = e
+                if time.monotonic() >= deadline:
+                    break
+                if not is_retryable(e) or retry == policy.max_retries:
+                    raise
+                delay = retry_delay(e, retry)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f'Retrying the {endpoint} call to {model} in {delay:.1f}s after: {e!r}')
+                REQUEST_RETRIES.inc(1, endpoint)
+                await asyncio.sleep(delay)
+        self._give_up(endpoint, policy, error)
+
+    async def _timed_async(self, endpoint: str, model: str, attempt: Callable[[float], Awaitable[T]], deadline: float) -> T:
+        start = time.monotonic()
+        result = await attempt(deadline - start)
+        self.latencies.observe(endpoint, model, time.monotonic() - start)
+        return result
+
+    async def _hedged_async(self, endpoint: str, model: str, attempt: Callable[[float], Awaitable[T]],
+                            discard: Optional[Callable[[T], Awaitable[None]]], policy: RequestPolicy, deadline: float) -> T:
+        delay = self._hedge_delay(endpoint, model, policy)
+        first = asyncio.ensure_future(self._timed_async(endpoint, model, attempt, deadline))
+        first.add_done_callback(_consume_exception)
+        tasks: Set[asyncio.Future] = {first}
+        winner = None
+        try:
+            if delay is None or delay >= deadline - time.monotonic():
+                winner = first
+                return await first
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self._take_hedge(endpoint):
+                backup = asyncio.ensure_future(self._timed_async(endpoint, model, attempt, deadline))
+                backup.add_done_callback(_consume_exception)
+                tasks.add(backup)
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # When both completed, the first attempt wins, and the result of the other one is discarded below.
+                for task in sorted(done, key=lambda task: task is not first):
+                    if task.exception() is None:
+                        winner = task
+                        if task is not first:
+                            HEDGED_REQUESTS.inc(1, endpoint, 'won')
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    if discard is not None and task.done() and not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
+
+    # The blocking calls
+
+    def run(self, endpoint: str, model: str, attempt: Callable[[float], T]) -> T:
+        """The blocking version of run_async. The attempts run on a thread pool, so the deadline holds even when a request doesn't time out on its own.
+        The losing attempts can't be interrupted, and complete in the background.
+        """
+        policy = current_policy()
+        deadline = time.monotonic() + policy.deadline
+        error = None
+        for retry in range(policy.max_retries + 1):
+            if deadline - time.monotonic() <= 0:
+                break
+            try:
+                return self._hedged(endpoint, model, attempt, policy, deadline)
+            except DeadlineExceeded:
+                break
+            except Exception as e:
+                error = e
+                if not is_retryable(e) or retry == policy.max_retries:
+                    raise
+                delay = retry_delay(e, retry)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f'Retrying the {endpoint} call to {model} in {delay:.1f}s after: {e!r}')
+                REQUEST_RETRIES.inc(1, endpoint)
+                time.sleep(delay)
+        self._give_up(endpoint, policy, error)
+
+    def _timed(self, endpoint: str, model: str, attempt: Callable[[float], T], deadline: float) -> T:
+        start = time.monotonic()
+        result = attempt(deadline - start)
+        self.latencies.observe(endpoint, model, time.monotonic() - start)
+        return result
+
+    def _submit(self, endpoint: str, model: str, attempt: Callable[[float], T], deadline: float) -> Future:
+        # Each attempt runs in a copy of the caller's context, so its spans are added to the caller's trace.
+        return self._pool.submit(contextvars.copy_context().run, self._timed, endpoint, model, attempt, deadline)
+
+    def _hedged(self, endpoint: str, model: str, attempt: Callable[[float], T], policy: RequestPolicy, deadline: float) -> T:
+        delay = self._hedge_delay(endpoint, model, policy)
+        first = self._submit(endpoint, model, attempt, deadline)
+        futures = {first}
+        if delay is not None and delay < deadline - time.monotonic():
+            done, _ = wait(futures, timeout=delay)
+            if not done and self._take_hedge(endpoint):
+                futures.add(self._submit(endpoint, model, attempt, deadline))
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded()
+            for future in sorted(done, key=lambda future: future is not first):
+                if future.exception() is None:
+                    if future is not first:
+                        HEDGED_REQUESTS.inc(1, endpoint, 'won')
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+REQUESTS = RequestExecutor()
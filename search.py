@@ -0,0 +1,275 @@
+"""
+This file holds the full-text search over a user's notes, behind the /search command of the Telegram bot.
+* tokenize: Chinese (and the other CJK scripts) has no spaces, so CJK runs are indexed as overlapping character bigrams,
+  and the other scripts as lowercased words.
+* NoteIndex: an inverted index over the texts of the history entries (the transcript, the paraphrase and the style outputs),
+  ranked with BM25. Each entry is a document, identified by its index in the history.
+  Entries are only ever appended, and only the last one gets new revisions, so the postings are append-only arrays.
+* get_index: the indexes are kept in memory for the SEARCH_CACHED_USERS most recent users, and kept up to date by index_entry and index_revision.
+  Building one costs seconds for tens of thousands of notes, so it's only done once: the indexes are saved as snapshots in SEARCH_INDEX_DIR,
+  and a snapshot only needs the notes added since it was saved.
+"""
+import os
+import re
+import math
+import heapq
+import pickle
+import asyncio
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from history import HistoryEntry, PagedHistory, HISTORY_PAGE_SIZE
+
+# Number of users whose index is kept in memory.
+SEARCH_CACHED_USERS = int(os.environ.get('SEARCH_CACHED_USERS', 16))
+# Where the snapshots of the indexes are saved. Disabled when empty, and the indexes are then built again after each restart.
+SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR', 'search_index')
+# Save the snapshot of an index after indexing this many notes at once.
+SEARCH_SNAPSHOT_NOTES = 1000
+# BM25 parameters.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_TOKEN_RE = re.compile(f'([{_CJK}]+)|([0-9a-z\u00c0-\u024f\u0400-\u04ff]+)')
+_CJK_RE = re.compile(f'[{_CJK}]')
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into the indexed terms: the character bigrams of the CJK runs, a lone CJK character as is, and lowercased words."""
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text.lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+class NoteIndex:
+    """The inverted index of a user's history. Each term maps to the postings of the documents containing it, in ascending order.
+    A posting packs the document id and the count of the term in it as doc << 8 | count, so each costs 4 bytes and a single append.
+    The counts are capped at 255, far past the point where BM25 stops rewarding them.
+    """
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        # The number of terms of each document, i.e. of each history entry indexed so far.
+        self.lengths = array('I')
+        self.total_length = 0
+        # Whether it changed since its snapshot was saved.
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __repr__(self) -> str:
+        return f'NoteIndex({len(self)} notes, {len(self.postings)} terms)'
+
+    def add(self, doc: int, text: str):
+        """Indexes a text of the document. Only the next document, or the last one, can be added to.
+
+        Args:
+            doc (int): the index of the history entry.
+            text (str): one of its texts.
+        """
+        if doc == len(self.lengths):
+            self.lengths.append(0)
+        elif doc != len(self.lengths) - 1:
+            raise ValueError(f'Only note {len(self.lengths) - 1} or {len(self.lengths)} can be indexed, not {doc}')
+        tokens = tokenize(text)
+        for token, count in Counter(tokens).items():
+            posting = self.postings.get(token)
+            if posting is None:
+                self.postings[token] = array('I', (doc << 8 | min(count, 255),))
+            elif posting[-1] >> 8 == doc:
+                posting[-1] = doc << 8 | min((posting[-1] & 255) + count, 255)
+            else:
+                posting.append(doc << 8 | min(count, 255))
+        self.lengths[doc] += len(tokens)
+        self.total_length += len(tokens)
+        self.dirty = True
+
+    def add_entries(self, start: int, entries: Iterable[HistoryEntry]):
+        """Indexes all the texts of the entries, as the documents from `start`, which must be the next one."""
+        if start != len(self.lengths):
+            raise ValueError(f'Only note {len(self.lengths)} can be added, not {start}')
+        # The loop runs once per term of each entry, so it's kept free of attribute lookups.
+        postings = self.postings
+        get = postings.get
+        for doc, entry in enumerate(entries, start):
+            tokens = []
+            for _, text in entry.texts():
+                tokens += tokenize(text)
+            self.lengths.append(len(tokens))
+            self.total_length += len(tokens)
+            doc <<= 8
+            for token, count in Counter(tokens).items():
+                posting = get(token)
+                if posting is None:
+                    postings[token] = array('I', (doc | (count if count < 255 else 255),))
+                else:
+                    posting.append(doc | (count if count < 255 else 255))
+            self.dirty = True
+
+    def _query_terms(self, query: str) -> List[str]:
+        terms = []
+        for term in dict.fromkeys(tokenize(query)):
+            if len(term) == 1 and _CJK_RE.match(term):
+                # A lone character is mostly indexed inside bigrams, so it's looked up through the bigrams containing it.
+                terms.extend(t for t in self.postings if len(t) == 2 and term in t)
+            terms.append(term)
+        return terms
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """Ranks the documents matching any term of the query with BM25.
+
+        Args:
+            query (str): the words to search.
+            limit (int, optional): the maximum number of results.
+
+        Returns:
+            List[Tuple[int, float]]: the document ids and their scores, best first. The most recent note wins ties.
+        """
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1
+        scores: Dict[int, float] = {}
+        lengths = self.lengths
+        norm = BM25_K1 * (1 - BM25_B)
+        scale = BM25_K1 * BM25_B / average_length
+        for term in self._query_terms(query):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5)) * (BM25_K1 + 1)
+            for packed in posting:
+                doc, tf = packed >> 8, packed & 255
+                scores[doc] = scores.get(doc, 0.0) + idf * tf / (tf + norm + scale * lengths[doc])
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+
+    def matches(self, query: str) -> List[str]:
+        """The terms of the query found in the index, to highlight the results."""
+        return [term for term in self._query_terms(query) if term in self.postings]
+
+_indexes: 'OrderedDict[int, NoteIndex]' = OrderedDict()
+# The indexes being loaded or built, by user. Their index is in _indexes already, but incomplete.
+_builds: Dict[int, 'asyncio.Task[NoteIndex]'] = {}
+
+def _snapshot_path(user_id: int) -> str:
+    return os.path.join(SEARCH_INDEX_DIR, f'{user_id}.pickle')
+
+def _read_snapshot(user_id: int) -> Optional[NoteIndex]:
+    try:
+        with open(_snapshot_path(user_id), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f'Could not read the search index of {user_id}, building it again: {e}')
+        return None
+
+def _write_snapshot(user_id: int, data: bytes):
+    os.makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+    path = _snapshot_path(user_id)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+async def save_index(user_id: int, index: NoteIndex):
+    """Saves the snapshot of the index if it changed. It's pickled on the event loop, where the index is modified, and written in a thread."""
+    if not SEARCH_INDEX_DIR or not index.dirty:
+        return
+    index.dirty = False
+    data = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+    await asyncio.to_thread(_write_snapshot, user_id, data)
+
+async def save_indexes():
+    """Saves the snapshots of all the indexes in memory, e.g. on shutdown."""
+    for user_id, index in list(_indexes.items()):
+        await save_index(user_id, index)
+
+async def _build_index(user_id: int, history: PagedHistory) -> NoteIndex:
+    index = await asyncio.to_thread(_read_snapshot, user_id) if SEARCH_INDEX_DIR else None
+    # A snapshot longer than the history is from before a /clear.
+    if index is None or len(index) > len(history):
+        index = NoteIndex()
+    # Registered right away, so the entries added during the build are indexed by index_entry, once the build has reached them.
+    _indexes[user_id] = index
+    added = 0
+    try:
+        while _indexes.get(user_id) is index and len(index) < len(history):
+            start = len(index)
+            # The older pages are read from the disk on the persistence thread.
+            entries = await history.slice_async(start, start + HISTORY_PAGE_SIZE)
+            if len(index) != start:
+                # index_entry got there first, with an entry appended in the meanwhile.
+                continue
+            index.add_entries(start, entries)
+            added += len(index) - start
+    except BaseException:
+        # An incomplete index must not be served. The next search starts over, from the snapshot if any.
+        if _indexes.get(user_id) is index:
+            del _indexes[user_id]
+        raise
+    if added >= SEARCH_SNAPSHOT_NOTES:
+        await save_index(user_id, index)
+    return index
+
+async def _evict_indexes():
+    # The oldest complete indexes go first. The ones being built are needed by their build.
+    for user_id in [user_id for user_id in _indexes if user_id not in _builds][:max(0, len(_indexes) - SEARCH_CACHED_USERS)]:
+        index = _indexes.pop(user_id, None)
+        if index is not None:
+            await save_index(user_id, index)
+
+async def get_index(user_id: int, history: PagedHistory) -> NoteIndex:
+    """The index of the user, from memory, or else from its snapshot, or else built from the history.
+    The entries missing from it are read page by page, off the event loop, so a long history doesn't block the other users.
+    Concurrent calls for the same user wait for the same build, rather than getting the index while it's incomplete.
+    """
+    build = _builds.get(user_id)
+    if build is None and user_id not in _indexes:
+        build = _builds[user_id] = asyncio.ensure_future(_build_index(user_id, history))
+        build.add_done_callback(lambda _: _builds.pop(user_id, None) if _builds.get(user_id) is build else None)
+    if build is not None:
+        # Shielded, so a cancelled search doesn't cancel the build the other searches wait for.
+        index = await asyncio.shield(build)
+        await _evict_indexes()
+    else:
+        index = _indexes[user_id]
+    if _indexes.get(user_id) is index:
+        _indexes.move_to_end(user_id, last=True)
+    return index
+
+def index_entry(user_id: int, doc: int, entry: HistoryEntry):
+    """Indexes an entry just appended to the history, if the index of the user is in memory."""
+    index = _indexes.get(user_id)
+    if index is not None and doc == len(index):
+        index.add_entries(doc, [entry])
+
+def index_revision(user_id: int, doc: int, text: str):
+    """Indexes a revision just added to the last entry of the history, if the index of the user is in memory."""
+    index = _indexes.get(user_id)
+    if index is not None and doc == len(index) - 1:
+        index.add(doc, text)
+
+def drop_index(user_id: int):
+    """Forgets the index of the user, and its snapshot, e.g. on /clear. A build in progress stops at its next page."""
+    _indexes.pop(user_id, None)
+    _builds.pop(user_id, None)
+    if SEARCH_INDEX_DIR and os.path.exists(_snapshot_path(user_id)):
+        os.remove(_snapshot_path(user_id))
+
+def snippet(entry: HistoryEntry, terms: Iterable[str], width: int = 80) -> str:
+    """The part of the entry around the first match, from its current text if it matches, or else from the first text that does."""
+    terms = list(terms)
+    texts = [entry.current_text] + [text for _, text in entry.texts()]
+    for text in texts:
+        lowered = text.lower()
+        positions = [position for position in (lowered.find(term) for term in terms) if position >= 0]
+        if positions:
+            start = max(0, min(positions) - width // 4)
+            return ('…' if start else '') + text[start:start + width].replace('\n', ' ') + ('…' if start + width < len(text) else '')
+    text = texts[0]
+    return text[:width].replace('\n', ' ') + ('…' if len(text) > width else '')
@@ -0,0 +1,271 @@
+"""
+This file holds the daily summaries of the Telegram bot, sent every night by a job scheduled with schedule_daily_summaries on the bot's JobQueue.
+* Only the history entries added since the last run are read: user_data['summary_watermark'] is the number of entries already summarized.
+  Users who have never been summarized start from SUMMARY_BACKFILL_DAYS ago, not from their first note.
+* Each complete day of notes is summarized once, and kept in user_data['daily_summaries'],
+  so the weekly rollups sent on Mondays are made from the daily summaries instead of the raw notes.
+* The users are summarized by SUMMARY_MAX_CONCURRENCY workers, and the GPT calls are paced to SUMMARY_REQUESTS_PER_MINUTE,
+  backing off when the API answers with a rate limit. A run thus never holds more than a few of the OPENAI_MAX_CONCURRENCY slots
+  the interactive requests need. A run stops after SUMMARY_RUN_MAX_SECONDS, and the next run starts with the users left over.
+"""
+import os
+import asyncio
+import datetime
+from zoneinfo import ZoneInfo
+from typing import Dict, List, Optional
+import openai
+from telegram.error import TelegramError
+from telegram.ext import Application, CallbackContext
+
+import metrics
+from core import gpt_process_text_full_async
+from request_policy import BACKGROUND_POLICY, using_policy
+from history import HistoryEntry, PagedHistory
+from prompts import PROMPTS
+
+DAILY_SUMMARIES_ENABLED = os.environ.get('DAILY_SUMMARIES', '1') not in ('', '0', 'false')
+# When the job runs, and which timezone the days of the notes are counted in.
+SUMMARY_TIMEZONE = ZoneInfo(os.environ.get('SUMMARY_TIMEZONE', 'UTC'))
+DAILY_SUMMARY_TIME = datetime.time.fromisoformat(os.environ.get('DAILY_SUMMARY_TIME', '00:10')).replace(tzinfo=SUMMARY_TIMEZONE)
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', 'gpt-4')
+# Number of users summarized at the same time.
+SUMMARY_MAX_CONCURRENCY = int(os.environ.get('SUMMARY_MAX_CONCURRENCY', 4))
+SUMMARY_REQUESTS_PER_MINUTE = float(os.environ.get('SUMMARY_REQUESTS_PER_MINUTE', 60))
+SUMMARY_RUN_MAX_SECONDS = float(os.environ.get('SUMMARY_RUN_MAX_SECONDS', 3600))
+SUMMARY_MAX_RETRIES = 3
+# How far back the first summary of a user goes.
+SUMMARY_BACKFILL_DAYS = 1
+# Daily summaries older than this are dropped. They are only kept for the weekly rollups.
+SUMMARY_KEEP_DAYS = 14
+SUMMARY_KEEP_WEEKS = 8
+# Telegram allows about 30 messages per second across all chats, and the interactive replies need some of them.
+TELEGRAM_MESSAGES_PER_MINUTE = 600
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class Pacer:
+    """Spaces out the calls to at most rate_per_minute, and holds everyone back after a rate limit error.
+
+    Args:
+        rate_per_minute (float): the maximum number of calls per minute.
+    """
+    def __init__(self, rate_per_minute: float):
+        self.interval = 60 / rate_per_minute
+        self._ready_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._ready_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._ready_at = max(loop.time(), self._ready_at) + self.interval
+
+    def back_off(self, seconds: float):
+        self._ready_at = max(self._ready_at, asyncio.get_running_loop().time() + seconds)
+
+def _local_time(date: datetime.datetime) -> datetime.datetime:
+    # Telegram dates are in UTC.
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(SUMMARY_TIMEZONE)
+
+def _local_date(date: datetime.datetime) -> datetime.date:
+    return _local_time(date).date()
+
+def _notes_text(entries: List[HistoryEntry]) -> str:
+    return '\n'.join(f"[{_local_time(entry.date).strftime('%H:%M')}] {entry.current_text}" for entry in entries if entry.revisions)
+
+async def _first_index_since(history: PagedHistory, start: int, day: datetime.date) -> int:
+    """The index of the first entry from `day` on, at or after start. The entries are in date order, so it's a binary search,
+    which only reads a few entries of the older history from the disk, off the event loop."""
+    low, high = start, len(history)
+    while low < high:
+        middle = (low + high) // 2
+        entry = (await history.slice_async(middle, middle + 1))[0]
+        if _local_date(entry.date) < day:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+class SummaryRun:
+    """One run of the daily summaries, over all the users.
+
+    Args:
+        application (Application): the bot, whose persistence lists and loads the users.
+        today (datetime.date): the day of the run. The notes of the days before it are summarized.
+    """
+    def __init__(self, application: Application, today: datetime.date):
+        self.application = application
+        self.today = today
+        self.gpt_pacer = Pacer(SUMMARY_REQUESTS_PER_MINUTE)
+        self.telegram_pacer = Pacer(TELEGRAM_MESSAGES_PER_MINUTE)
+        self.stats = {'users': 0, 'daily': 0, 'weekly': 0, 'failed': 0, 'left_over': 0}
+
+    async def run(self, max_seconds: float = SUMMARY_RUN_MAX_SECONDS) -> Dict[str, int]:
+        """Summarizes every user, until done or until max_seconds have passed. Returns the counts of the run."""
+        persistence = self.application.persistence
+        user_ids = sorted(await persistence.get_user_ids())
+        # Start after the last user of the previous run, so the users left over by a run that ran out of time go first.
+        cursor = self.application.bot_data.get('summary_cursor')
+        if cursor is not None:
+            user_ids = [user_id for user_id in user_ids if user_id > cursor] + [user_id for user_id in user_ids if user_id <= cursor]
+        pending = iter(enumerate(user_ids))
+        deadline = asyncio.get_running_loop().time() + max_seconds
+        # The users finish out of order, so the cursor only moves past the users whose predecessors are all done too.
+        done = [False] * len(user_ids)
+        done_before = 0
+
+        async def worker():
+            nonlocal done_before
+            for position, user_id in pending:
+                if asyncio.get_running_loop().time() > deadline:
+                    self.stats['left_over'] += 1
+                    continue
+                try:
+                    await self.summarize_user(user_id)
+                    self.stats['users'] += 1
+                except Exception as e:
+                    print(f'[{user_id}] Daily summary failed: {e}')
+                    self.stats['failed'] += 1
+                done[position] = True
+                while done_before < len(done) and done[done_before]:
+                    done_before += 1
+                if done_before:
+                    self.application.bot_data['summary_cursor'] = user_ids[done_before - 1]
+
+        await asyncio.gather(*(worker() for _ in range(SUMMARY_MAX_CONCURRENCY)))
+        return self.stats
+
+    async def summarize_user(self, user_id: int):
+        """Sends the summaries due for a user, and saves the watermark and the summaries with the user's data.
+        The users the bot has talked to since it started have their data in memory already, the others are read from the persistence.
+        """
+        with metrics.start_trace('telegram.daily_summary', user_id=user_id):
+            in_memory = user_id in self.application.user_data
+            data = self.application.user_data[user_id] if in_memory else await self.application.persistence.load_user_data(user_id)
+            if not data or not data.get('history'):
+                return
+            chat_id = data.get('user_id', user_id)
+            try:
+                await self._summarize_days(data, chat_id)
+                await self._roll_up_week(data, chat_id)
+            finally:
+                self._prune(data)
+                await self._save(user_id, data, in_memory)
+
+    async def _save(self, user_id: int, data: Dict, in_memory: bool):
+        if not in_memory and user_id not in self.application.user_data:
+            await self.application.persistence.update_user_data(user_id, data)
+            return
+        if not in_memory:
+            # The user sent something while being summarized, so the data loaded by the Application is the one to update.
+            fields = {key: data[key] for key in ('summary_watermark', 'daily_summaries', 'weekly_summaries') if key in data}
+            self.application.user_data[user_id].update(fields)
+        # Saved by the next flush of the Application.
+        self.application.mark_data_for_update_persistence(user_ids=user_id)
+
+    async def _summarize_days(self, data: Dict, chat_id: int):
+        history = data['history']
+        watermark = min(data.get('summary_watermark', 0), len(history))
+        if 'summary_watermark' not in data:
+            watermark = await _first_index_since(history, 0, self.today - datetime.timedelta(days=SUMMARY_BACKFILL_DAYS))
+        # The notes of today are left for the next run, once the day is complete.
+        end = await _first_index_since(history, watermark, self.today)
+        days: Dict[datetime.date, List[HistoryEntry]] = {}
+        for entry in await history.slice_async(watermark, end):
+            days.setdefault(_local_date(entry.date), []).append(entry)
+
+        daily_summaries = data.setdefault('daily_summaries', {})
+        for day, entries in days.items():
+            text = _notes_text(entries)
+            if text:
+                summary = await self._summarize(text, PROMPTS['daily-summary'])
+                daily_summaries[day.isoformat()] = summary
+                self.stats['daily'] += 1
+                await self._send(chat_id, f'Summary of {day.isoformat()}:\n\n{summary}')
+            # Moved forward day by day, so the days already sent are not summarized again if the run is interrupted.
+            watermark += len(entries)
+            data['summary_watermark'] = watermark
+        data['summary_watermark'] = end
+
+    async def _roll_up_week(self, data: Dict, chat_id: int):
+        # On Mondays, the week before is rolled up from its daily summaries.
+        if self.today.weekday() != 0:
+            return
+        week_start = self.today - datetime.timedelta(days=7)
+        weekly_summaries = data.setdefault('weekly_summaries', {})
+        if week_start.isoformat() in weekly_summaries:
+            return
+        daily_summaries = data.get('daily_summaries', {})
+        days = [week_start + datetime.timedelta(days=offset) for offset in range(7)]
+        parts = [f'{day.isoformat()}:\n{daily_summaries[day.isoformat()]}' for day in days if day.isoformat() in daily_summaries]
+        if not parts:
+            return
+        summary = await self._summarize('\n\n'.join(parts), PROMPTS['weekly-summary'])
+        weekly_summaries[week_start.isoformat()] = summary
+        self.stats['weekly'] += 1
+        await self._send(chat_id, f'Summary of the week of {week_start.isoformat()}:\n\n{summary}')
+
+    def _prune(self, data: Dict):
+        oldest = (self.today - datetime.timedelta(days=SUMMARY_KEEP_DAYS)).isoformat()
+        for key in [key for key in data.get('daily_summaries', {}) if key < oldest]:
+            del data['daily_summaries'][key]
+        weekly_summaries = data.get('weekly_summaries', {})
+        for key in sorted(weekly_summaries)[:-SUMMARY_KEEP_WEEKS]:
+            del weekly_summaries[key]
+
+    async def _summarize(self, text: str, system_prompt: str) -> str:
+        for attempt in range(SUMMARY_MAX_RETRIES + 1):
+            await self.gpt_pacer.wait()
+            try:
+                return await gpt_process_text_full_async(text, system_prompt, SUMMARY_MODEL)
+            except openai.error.RateLimitError as e:
+                if attempt == SUMMARY_MAX_RETRIES:
+                    raise
+                headers = getattr(e, 'headers', None) or {}
+                try:
+                    delay = float(headers.get('retry-after', 0)) or 10 * 2 ** attempt
+                except ValueError:
+                    delay = 10 * 2 ** attempt
+                print(f'Rate limited while summarizing, pausing the summaries for {delay} seconds.')
+                self.gpt_pacer.back_off(delay)
+
+    async def _send(self, chat_id: int, text: str):
+        for start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+            await self.telegram_pacer.wait()
+            try:
+                await self.application.bot.send_message(chat_id, text[start:start + TELEGRAM_MESSAGE_LIMIT])
+            except TelegramError as e:
+                # E.g. the user blocked the bot. The summary is kept anyway, and not sent again.
+                print(f'[{chat_id}] Could not send the summary: {e}')
+                return
+
+async def run_daily_summaries(application: Application, today: Optional[datetime.date] = None) -> Dict[str, int]:
+    """Sends the daily summaries, and the weekly ones on Mondays, to every user with new notes.
+
+    Args:
+        application (Application): the bot.
+        today (Optional[datetime.date]): the day of the run. Defaults to the current day in SUMMARY_TIMEZONE.
+
+    Returns:
+        Dict[str, int]: the counts of the run: users summarized, summaries sent, failures, and users left over for the next run.
+    """
+    today = today or datetime.datetime.now(SUMMARY_TIMEZONE).date()
+    # The summaries can wait, so their calls are not hedged, which would compete with the interactive ones.
+    with using_policy(BACKGROUND_POLICY):
+        return await SummaryRun(application, today).run()
+
+async def _daily_summaries_job(context: CallbackContext):
+    stats = await run_daily_summaries(context.application)
+    print(f'Daily summaries: {stats}')
+
+def schedule_daily_summaries(application: Application):
+    """Schedules the daily summaries on the JobQueue of the bot, which needs python-telegram-bot[job-queue]."""
+    if not DAILY_SUMMARIES_ENABLED:
+        return
+    if application.job_queue is None:
+        print('The daily summaries are disabled, install python-telegram-bot[job-queue] to enable them.')
+        return
+    application.job_queue.run_daily(_daily_summaries_job, DAILY_SUMMARY_TIME, name='daily_summaries')
@@ -3,6 +3,8 @@ import tempfile
 import json
 import re 
 import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Union
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -10,32 +12,53 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     BotCommand,
+    Message,
 
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     CommandHandler,
     ConversationHandler,
     MessageHandler,
     CallbackContext,
     Application,
-    PicklePersistence,
     CallbackQueryHandler,
 )
 import telegram.ext.filters as filters
 
 import core
+import metrics
 from core import (
-    gpt_process_text,
     gpt_process_text_async,
-    convert_audio_file_to_format,
-    classify_outline_intent_mode,
-    gpt_iterate_on_thoughts,
-    classify_outline_content,
+    STREAM_DELTA,
+    STREAM_ERROR,
+    prepare_speech_for_asr_async,
+    NoSpeechDetected,
+    needs_chunked_transcription,
+    transcribe_voice_data_chunked_async,
+    join_transcripts,
+    classify_outline_intent_mode_async,
+    gpt_iterate_on_thoughts_async,
+    classify_outline_content_async,
+    close_http_clients,
 )
 from prompts import PROMPTS, CHOICE_TO_PROMPT
-
-OUTPUT_FORMAT = "mp3"
+from persistence import SQLitePersistence, migrate_pickle_persistence
+from history import HistoryEntry, PagedHistory, HISTORY_HOT_ENTRIES, TRANSCRIBED, PARAPHRASED, SET_CONTENT
+from outline import OutlineDocument
+from summaries import schedule_daily_summaries
+from journal import get_journal
+from request_policy import route_model
+from update_processor import ChatOrderedUpdateProcessor
+from search import get_index, index_entry, index_revision, drop_index, save_indexes, snippet
+
+# The bot data used to be stored with PicklePersistence in PICKLE_ARCHIVE_FILE. It's migrated to ARCHIVE_FILE on the first start.
+PICKLE_ARCHIVE_FILE = 'gpt_archive.pickle'
+ARCHIVE_FILE = 'gpt_archive.sqlite3'
+# Serve the Prometheus metrics on this port. Disabled when 0.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# Also write the texts added to the histories to this journal, e.g. the PERSONAL_LOG_FILE of main.py. Disabled when empty.
+JOURNAL_FILE = os.environ.get('JOURNAL_FILE', '')
 
 telegram_api_token = os.environ.get('TELEGRAM_BOT_TOKEN')
 print(f'Bot token: {telegram_api_token}')
@@ -45,6 +68,11 @@ outline_markup = ReplyKeyboardMarkup([['End outline mode.']], resize_keyboard=Tr
 
 REGULAR, OUTLINE = range(2)
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+EMPTY_OUTLINE_TEXT = '(Empty outline. Send voice messages to add lines.)'
+# Number of notes listed by /search.
+SEARCH_RESULTS = 10
+
 async def initialize_user_data(context: CallbackContext):
     """
     Initialize the user data.
@@ -58,10 +86,24 @@ async def initialize_user_data(context: CallbackContext):
     if 'user_id' not in context.user_data:
         context.user_data['user_id'] = user_id
     if 'history' not in context.user_data:
-        context.user_data['history'] = []
+        context.user_data['history'] = PagedHistory()
     if 'active_model' not in context.user_data:
         context.user_data['active_model'] = 'gpt-4'
 
+def journal_revision(context: CallbackContext, entry: HistoryEntry, kind: str, text: str):
+    """Adds a revision to the history entry, and writes it to the journal when JOURNAL_FILE is set.
+    The record has the fields written by main.log_content_to_file, dated when the revision is made, plus where it comes from.
+    """
+    entry.add_revision(kind, text)
+    if JOURNAL_FILE:
+        get_journal(JOURNAL_FILE).write({'content': text, 'source': 'telegram', 'user_id': context.user_data.get('user_id'), 'kind': kind})
+
+def append_history(context: CallbackContext, entry: HistoryEntry):
+    """Appends the entry to the history of the user, and to the search index."""
+    history = context.user_data['history']
+    history.append(entry)
+    index_entry(context.user_data['user_id'], len(history) - 1, entry)
+
 async def start(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text('Send me a voice message, and I will transcribe it for you. Note I am not a QA bot, and will not answer your questions. I will only listen to you and transcribe your voice message, with paraphrasing from GPT-4. Type /help for more information.', reply_markup=target_usage_markup)
     return REGULAR
@@ -71,10 +113,11 @@ async def help(update: Update, context: CallbackContext) -> int:
 
 *Usage*: Send me a voice message, and I will transcribe it for you\. Note I am not a QA bot, and will not answer your questions\. I will only listen to you and transcribe your voice message, with paraphrasing from GPT\-4\.
 
-*Data and privacy*: I log your transcriptions and paraphrased texts, to support a future service of sending summary of your voice messages\. I will not share your data with any third party\. I will not use your data for any purposes other than to provide you with a better service\. You can always check what data are logged by sending /data command, and clear your data \(on our end\) by sending /clear command\.
+*Data and privacy*: I log your transcriptions and paraphrased texts, to send you a summary of your voice messages every day, and every week on Mondays\. I will not share your data with any third party\. I will not use your data for any purposes other than to provide you with a better service\. You can always check what data are logged by sending /data command, and clear your data \(on our end\) by sending /clear command\.
 
 *Commands*: 
 /help: Display this help message\.
+/search <words\>: Search your notes\.
 /data: Display any information we had about you from our end\.
 /clear: Clear any information we had about you from our end\.""", parse_mode='MarkdownV2')
     return REGULAR
@@ -88,13 +131,45 @@ async def data(update: Update, context: CallbackContext) -> int:
     member = await context.bot.get_chat_member(chat_id, user_id)
     user_full_name = member.user.full_name
     print(f'[{user_full_name}] /data')
-    to_send = str(context.user_data)
-    if len(to_send) > 4096:
-        await update.message.reply_text(f"Your data is too long to be displayed. It contains {len(context.user_data['history'])} entries. The last message is {context.user_data['history'][-1]}. It records across the time period from {context.user_data['history'][0]['date']} to {context.user_data['history'][-1]['date']}.")
+    history = context.user_data.get('history', [])
+    to_send = ''
+    # Only short histories are displayed in full, so the older entries are not paged in from the disk just to find out they don't fit.
+    if len(history) <= HISTORY_HOT_ENTRIES:
+        to_send = str({**context.user_data, 'history': [entry.to_dict() for entry in history]})
+    if not to_send or len(to_send) > 4096:
+        await update.message.reply_text(f"Your data is too long to be displayed. It contains {len(history)} entries. The last message is {history[-1]}. It records across the time period from {history[0].date} to {history[-1].date}.")
     else:
         await update.message.reply_text(to_send)
     return REGULAR
 
+@metrics.traced('telegram.search')
+async def search(update: Update, context: CallbackContext) -> int:
+    """
+    Search the notes of the user, e.g. /search 产品 roadmap. The notes are ranked by relevance, with their date and the matching part.
+    """
+    query = ' '.join(context.args or [])
+    if not query:
+        await update.message.reply_text("Usage: /search <words>, e.g. /search 周末 计划")
+        return REGULAR
+    await initialize_user_data(context)
+    history = context.user_data['history']
+    with metrics.span('search'):
+        index = await get_index(context.user_data['user_id'], history)
+        results = index.search(query, SEARCH_RESULTS)
+    print(f'[{context.user_data["user_full_name"]}] /search {query}: {len(results)} results')
+    if not results:
+        await update.message.reply_text(f"No notes found for {query}.")
+        return REGULAR
+    terms = index.matches(query)
+    lines = []
+    for doc, _ in results:
+        # Older notes are read from the disk, off the event loop.
+        entry = (await history.slice_async(doc, doc + 1))[0]
+        lines.append(f'{entry.date:%Y-%m-%d %H:%M} {snippet(entry, terms)}')
+    to_send = '\n\n'.join(lines)
+    await update.message.reply_text(to_send[:TELEGRAM_MESSAGE_LIMIT])
+    return REGULAR
+
 async def clear(update: Update, context: CallbackContext) -> int:
     """
     Clear any information we had about the user from our end.
@@ -105,20 +180,16 @@ async def clear(update: Update, context: CallbackContext) -> int:
     user_full_name = member.user.full_name
     print(f'[{user_full_name}] /clear')
     context.user_data.clear()
+    drop_index(user_id)
     await update.message.reply_text("Your data has been cleared.")
     return REGULAR
 
-# TODO: send out daily summaries to users.
-
 async def set_last_message(update: Update, context: CallbackContext) -> int:
     text = update.message.text
     await initialize_user_data(context)
-    context.user_data['history'].append({
-        'date': update.message.date,
-        'set_content': text,
-        'last_text_field': 'set_content',
-        'history': ['set_content']
-    })
+    entry = HistoryEntry(update.message.date)
+    journal_revision(context, entry, SET_CONTENT, text)
+    append_history(context, entry)
     await update.message.reply_text("Your message has been set as the last message. Now you can use the buttons to transform it.")
     return REGULAR
 
@@ -127,6 +198,7 @@ async def warn_if_not_voice_message(update: Update, context: CallbackContext) ->
         await update.message.reply_text("Please send me a voice message. I will transcribe it and paraphrase for you.")
     return REGULAR
 
+@metrics.traced('telegram.thoughts')
 async def process_thoughts(update: Update, context: CallbackContext) -> int:
     await initialize_user_data(context)
     if len(context.user_data['history']) == 0:
@@ -134,44 +206,65 @@ async def process_thoughts(update: Update, context: CallbackContext) -> int:
         return
     print(context.user_data['history'][-1])
     last_thought = context.user_data['history'][-1]
-    last_text_field = last_thought['last_text_field']
-    last_thought_text = last_thought[last_text_field]
+    last_thought_text = last_thought.current_text
     target_usage = update.message.text
-    result = gpt_iterate_on_thoughts(last_thought_text, target_usage)
-    new_text_field = last_text_field + '_' + target_usage
-    # When the target usage is 思考, we don't update the last_text_field because it's not a continuation or processed version of the previous thought, but a detour with inspirations.
-    # TODO: make it part of the usage definition
-    if target_usage != '思考':
-        context.user_data['history'][-1]['last_text_field'] = new_text_field
-    context.user_data['history'][-1]['history'].append(target_usage)
-    context.user_data['history'][-1][new_text_field] = result
-    print(context.user_data['history'][-1])
+    result = await gpt_iterate_on_thoughts_async(last_thought_text, target_usage)
+    # When the target usage is 思考, the current revision doesn't move, because it's not a continuation or processed version of the previous thought,
+    # but a detour with inspirations. See DETOUR_USAGES.
+    journal_revision(context, last_thought, target_usage, result)
+    index_revision(context.user_data['user_id'], len(context.user_data['history']) - 1, result)
+    print(last_thought)
     await update.message.reply_text(result)
     return REGULAR
 
-async def transcribe_message(user_full_name: str, update: Update, context: CallbackContext) -> str:
+async def transcribe_message(user_full_name: str, update: Update, context: CallbackContext, on_partial: Optional[Callable[[str], Awaitable]] = None) -> str:
     """A utility function to transcribe a voice message.
 
     Args:
         user_full_name (str): full name of the user
         update (Update): from the telegram bot API
         context (CallbackContext): from the telegram bot API
+        on_partial (Optional[Callable[[str], Awaitable]]): called with the transcript of each chunk as soon as it is ready, for long voice messages.
 
     Returns:
-        str: transcribed text
+        str: transcribed text, empty when the voice message has no speech
     """
+    # A re-sent or forwarded voice note keeps its file_unique_id, so neither the download nor the transcription is needed again.
+    cache_key = core.transcript_cache_key(file_unique_id=update.message.voice.file_unique_id)
+    transcribed_text = await core.RESPONSE_CACHE.get_async(cache_key)
+    metrics.annotate(chat_id=update.effective_chat.id, transcript_cached=transcribed_text is not None)
+    if transcribed_text is not None:
+        print(f'[{user_full_name}] (cached) {transcribed_text}')
+        return transcribed_text
+
     file_id = update.message.voice.file_id
-    voice_file = await context.bot.get_file(file_id)
+    with metrics.span('telegram_download'):
+        voice_file = await context.bot.get_file(file_id)
     
-    # Download the voice message
-    voice_data = await voice_file.download_as_bytearray()
-
-    with tempfile.NamedTemporaryFile('wb+', suffix=f'.ogg') as temp_audio_file:
-        temp_audio_file.write(voice_data)
-        temp_audio_file.seek(0)
-        with tempfile.NamedTemporaryFile(suffix=f'.{OUTPUT_FORMAT}') as temp_output_file:
-            convert_audio_file_to_format(temp_audio_file.name, temp_output_file.name, OUTPUT_FORMAT)
-            transcribed_text = core.transcribe_voice_message(temp_output_file.name)
+        # Download the voice message
+        voice_data = await voice_file.download_as_bytearray()
+    metrics.observe_audio('telegram', len(voice_data), update.message.voice.duration)
+
+    try:
+        if needs_chunked_transcription(voice_data):
+            # Long voice messages are split on silence and the chunks are transcribed in parallel.
+            parts = []
+            async for part in transcribe_voice_data_chunked_async(voice_data):
+                parts.append(part)
+                if on_partial is not None:
+                    await on_partial(part)
+            transcribed_text = join_transcripts(parts)
+        else:
+            # The silence is trimmed first. Telegram voice notes are OGG/Opus, which Whisper accepts natively,
+            # so they are uploaded untouched unless there is a lot of silence to cut.
+            # The decoding and encoding run in ffmpeg processes on the transcoding pool, so other chats are not blocked in the meanwhile.
+            audio_data, audio_format = await prepare_speech_for_asr_async(voice_data)
+            transcribed_text = await core.transcribe_voice_data_async(audio_data, audio_format)
+    except NoSpeechDetected as e:
+        # Not cached: the detector may be wrong, and sending the note again must give it another chance.
+        print(f'[{user_full_name}] {e}')
+        return ''
+    await core.RESPONSE_CACHE.set_async(cache_key, transcribed_text)
     print(f'[{user_full_name}] {transcribed_text}')
     return transcribed_text
 
@@ -191,6 +284,7 @@ async def get_user_full_name(update: Update, context: CallbackContext) -> str:
     user_full_name = member.user.full_name
     return user_full_name
 
+@metrics.traced('telegram.voice')
 async def transcribe_voice_message(update: Update, context: CallbackContext) -> int:
     user_full_name = await get_user_full_name(update, context)
     # We need to log the user info and histories in the user_data so we can send out daily summaries.
@@ -198,10 +292,23 @@ async def transcribe_voice_message(update: Update, context: CallbackContext) ->
     await initialize_user_data(context)
     
     # Call the Whisper ASR API
+    partial_sent = False
+    async def send_partial(part: str):
+        # For long voice messages, each chunk is sent as soon as it is transcribed, instead of waiting for the whole message.
+        nonlocal partial_sent
+        if not partial_sent:
+            await update.message.reply_text("Transcribed text:")
+            partial_sent = True
+        await update.message.reply_text(part, reply_markup=target_usage_markup)
+
     try:
-        transcribed_text = await transcribe_message(user_full_name, update, context)
-        await update.message.reply_text("Transcribed text:")
-        await update.message.reply_text(transcribed_text, reply_markup=target_usage_markup)
+        transcribed_text = await transcribe_message(user_full_name, update, context, on_partial=send_partial)
+        if not transcribed_text.strip():
+            await update.message.reply_text("No speech detected in the voice message.", reply_markup=target_usage_markup)
+            return REGULAR
+        if not partial_sent:
+            await update.message.reply_text("Transcribed text:")
+            await update.message.reply_text(transcribed_text, reply_markup=target_usage_markup)
     except Exception as e:
         print(f'[{user_full_name}] Error: {e}')
         await update.message.reply_text(f"Error: {e}", reply_markup=target_usage_markup)
@@ -219,72 +326,42 @@ async def transcribe_voice_message(update: Update, context: CallbackContext) ->
         # result_obj = {'tag': '思考', 'content': transcribed_text}
 
     result_obj = {'tag': '思考', 'content': transcribed_text}
+    # model = 'gpt-3.5-turbo' if result_obj['tag'] == '草稿' else 'gpt-4'
+    # When the chosen model is slower than its latency budget, the note is paraphrased by a faster one, recorded in the history entry.
+    model = route_model(context.user_data['active_model'])
+    # Speculative execution: the paraphrasing starts together with the outline intent classification instead of waiting for it,
+    # because the vast majority of the notes are not outline triggers. If it turns out to be one, the paraphrasing is thrown away.
+    intent_task = asyncio.create_task(classify_outline_intent_mode_async(result_obj['content']))
+    paraphrase_messages = []
+    paraphrase_task = asyncio.create_task(stream_paraphrase(update, context, result_obj['content'], model, paraphrase_messages))
+    try:
+        is_outline_intent = await intent_task
+    except Exception as e:
+        print(f'[{user_full_name}] Error in the outline intent classification: {e}')
+        is_outline_intent = False
+
     # Model switch
-    if classify_outline_intent_mode(result_obj['content']):
+    if is_outline_intent:
+        await cancel_paraphrase(paraphrase_task, paraphrase_messages)
         await update.message.reply_text("Entering outline mode. Now you can use natural language to edit the outline.")
-        context.user_data['outline_text'] = []
+        context.user_data['outline'] = OutlineDocument()
+        context.user_data['outline_view'] = {'messages': [], 'breaks': [], 'pages': []}
+        context.user_data.pop('outline_text', None)
+        await render_outline(update, context)
         print(f'[{user_full_name}] Entering outline mode.')
         return OUTLINE
     
-    # Some more info on the history and last_text_field:
-    # The history records the order of the fields being calculated, from which how the idea got transformed could be reproduced.
-    # The last_text_field records the last field that was calculated, which is used to determine which field to use as the input for the next step.
-    result_obj['history'] = ['tag']
-    result_obj['last_text_field'] = 'content'
-    # model = 'gpt-3.5-turbo' if result_obj['tag'] == '草稿' else 'gpt-4'
-    model = context.user_data['active_model']
-    result_obj['model'] = model
-    result_obj['history'].append('model')
-    result_obj['transcribed'] = transcribed_text
-    result_obj['history'].append('transcribed')
-    result_obj['last_text_field'] = 'transcribed'
-    print(f'[{user_full_name}] {result_obj}')
+    # Some more info on the revisions:
+    # The revisions record the order of the texts being calculated, from which how the idea got transformed could be reproduced.
+    # The current revision is the one used as the input for the next step.
+    entry = HistoryEntry(update.message.date, model=model, tag=result_obj['tag'])
+    journal_revision(context, entry, TRANSCRIBED, transcribed_text)
+    print(f'[{user_full_name}] {entry}')
     try:
-        # Uncomment to use synchronous API
-        # paraphrased_text = gpt_process_text(result_obj['content'], PROMPTS['paraphrase'], model)
-        
-        # Uncomment to use asynchronous API
-        await update.message.reply_text(f"Paraphrased using {model.upper()}:")
-        placeholder_message = await update.message.reply_text("...")
-        await update.message.chat.send_action(action="typing")
-        previous_text = ''
-        message_count = 0
-        async for status, paraphrased_text in gpt_process_text_async(result_obj['content'], PROMPTS['paraphrase'], model):
-            paraphrased_text = paraphrased_text[message_count * 4096:]
-            if len(paraphrased_text) > 4096:
-                # send out the current message
-                await context.bot.edit_message_text(paraphrased_text[message_count * 4096: (message_count + 1) * 4096],
-                    chat_id=placeholder_message.chat_id,
-                    message_id=placeholder_message.message_id,
-                    reply_markup=target_usage_markup)
-                # maintain variables
-                message_count += 1
-                placeholder_message = await update.message.reply_text("...")
-            if status != 'finished' and abs(len(paraphrased_text) - len(previous_text)) < 50:
-                continue
-            if status == 'finished' and abs(len(paraphrased_text) - len(previous_text)) == 0:
-                continue
-            try:
-                await context.bot.edit_message_text(paraphrased_text,
-                    chat_id=placeholder_message.chat_id,
-                    message_id=placeholder_message.message_id,
-                    reply_markup=target_usage_markup)
-            except BadRequest as e:
-                if str(e).startswith("Message is not modified"):
-                    continue
-                else:
-                    await context.bot.edit_message_text(paraphrased_text,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id)
-            await asyncio.sleep(0.01)
-            previous_text = paraphrased_text 
-                 
-        result_obj['paraphrased'] = paraphrased_text
-        result_obj['history'].append('paraphrased')
-        result_obj['date'] = update.message.date
-        result_obj['last_text_field'] = 'paraphrased'
+        paraphrased_text = await paraphrase_task
+        journal_revision(context, entry, PARAPHRASED, paraphrased_text)
         print(f'[{user_full_name}] {paraphrased_text}')
-        context.user_data['history'].append(result_obj)
+        append_history(context, entry)
         # await update.message.reply_text(paraphrased_text, reply_markup=target_usage_markup)
     except Exception as e:
         print(f'[{user_full_name}] Error: {e}')
@@ -293,7 +370,277 @@ async def transcribe_voice_message(update: Update, context: CallbackContext) ->
 
     return REGULAR
 
+async def stream_paraphrase(update: Update, context: CallbackContext, text: str, model: str, sent_messages: list) -> str:
+    """Paraphrases the text with GPT and streams the output to the chat by editing placeholder messages.
+
+    Args:
+        update (Update): from the telegram bot API
+        context (CallbackContext): from the telegram bot API
+        text (str): the text to be paraphrased
+        model (str): the GPT model to be used
+        sent_messages (list): every message sent by this function is appended to it, so they can be cleaned up if the paraphrasing is cancelled.
+
+    Returns:
+        str: paraphrased text
+    """
+    # Uncomment to use synchronous API
+    # paraphrased_text = gpt_process_text(text, PROMPTS['paraphrase'], model)
+
+    # Uncomment to use asynchronous API
+    sent_messages.append(await update.message.reply_text(f"Paraphrased using {model.upper()}:"))
+    placeholder_message = await update.message.reply_text("...")
+    sent_messages.append(placeholder_message)
+    page_messages = [placeholder_message]
+    await update.message.chat.send_action(action="typing")
+    pager = TelegramPager()
+    def page_text(index: int) -> str:
+        # Telegram rejects an edit to an empty or blank text, e.g. before the first visible delta or when the model returns nothing.
+        page = pager.page_text(index)
+        return page if page.strip() else "..."
+    async for event in gpt_process_text_async(text, PROMPTS['paraphrase'], model):
+        if event.kind == STREAM_ERROR:
+            raise event.data
+        if event.kind != STREAM_DELTA:
+            continue
+        pager.feed(event.data)
+        while len(page_messages) < pager.page_count:
+            # The current page is full: make sure its final text is sent, and continue on a new message.
+            await edit_scheduler.flush(context.bot, page_messages[-1], pager.page_text(len(page_messages) - 1))
+            page_messages.append(await update.message.reply_text("..."))
+            sent_messages.append(page_messages[-1])
+        # The page is only joined when the scheduler actually sends the edit, so the pending deltas are coalesced for free.
+        page_index = len(page_messages) - 1
+        edit_scheduler.submit(context.bot, page_messages[-1], lambda: page_text(page_index))
+    await edit_scheduler.flush(context.bot, page_messages[-1], page_text(-1) if pager.text().strip() else "(The model returned no text.)")
+    return pager.text()
+
+class MessageRef(NamedTuple):
+    """Identifies a sent message by its ids, e.g. when only the ids are kept in user_data. Accepted by EditScheduler in place of a Message."""
+    chat_id: int
+    message_id: int
+
+class EditScheduler:
+    """Schedules the edits of streamed messages within the Telegram rate limits.
+    Each chat gets at most one edit per per_chat_interval seconds, and the whole bot at most global_rate edits per second.
+    Edits submitted in the meanwhile are coalesced, so only the latest text of each message is sent.
+    "Message is not modified" errors are ignored and RetryAfter (flood wait) is honored here, instead of in every handler.
+
+    Args:
+        per_chat_interval (float): minimum seconds between two edits in the same chat.
+        global_rate (float): maximum edits per second across all chats.
+    """
+    def __init__(self, per_chat_interval: float = float(os.environ.get('TELEGRAM_EDIT_INTERVAL', 1.0)),
+                 global_rate: float = float(os.environ.get('TELEGRAM_EDIT_GLOBAL_RATE', 30))):
+        self.per_chat_interval = per_chat_interval
+        self.global_rate = global_rate
+        # chat_id -> message_id -> [bot, text or text factory, waiters], in the order the messages were first submitted.
+        self._pending: Dict[int, 'OrderedDict[int, list]'] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._chat_ready_at: Dict[int, float] = {}
+        self._global_ready_at = 0.0
+        self._global_lock = asyncio.Lock()
+
+    def submit(self, bot, message: Union[Message, MessageRef], text: Union[str, Callable[[], str]]):
+        """Schedules an edit of the message, replacing any edit of it not sent yet.
+
+        Args:
+            bot: the bot sending the edit.
+            message (Union[Message, MessageRef]): the message to edit.
+            text (Union[str, Callable[[], str]]): the new text, or a function returning it at the time the edit is sent.
+        """
+        return self._enqueue(bot, message, text, None)
+
+    async def flush(self, bot, message: Union[Message, MessageRef], text: Union[str, Callable[[], str]]):
+        """Schedules an edit of the message and waits until it is sent. Used for the final text, which must not be lost."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(bot, message, text, waiter)
+        await waiter
+
+    def discard(self, message: Union[Message, MessageRef]):
+        """Drops the edits of a message not sent yet, e.g. because the message is being deleted."""
+        pending = self._pending.get(message.chat_id, {}).pop(message.message_id, None)
+        for waiter in pending[2] if pending else []:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _enqueue(self, bot, message: Union[Message, MessageRef], text: Union[str, Callable[[], str]], waiter: Optional[asyncio.Future]):
+        chat_pending = self._pending.setdefault(message.chat_id, OrderedDict())
+        edit = chat_pending.get(message.message_id)
+        if edit is None:
+            edit = chat_pending[message.message_id] = [bot, text, []]
+        edit[1] = text
+        if waiter is not None:
+            edit[2].append(waiter)
+        if message.chat_id not in self._workers:
+            self._workers[message.chat_id] = asyncio.create_task(self._run_chat(message.chat_id))
+
+    async def _acquire_global_slot(self):
+        async with self._global_lock:
+            loop = asyncio.get_running_loop()
+            delay = self._global_ready_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._global_ready_at = max(loop.time(), self._global_ready_at) + 1 / self.global_rate
+
+    async def _run_chat(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        chat_pending = self._pending[chat_id]
+        try:
+            while chat_pending:
+                delay = self._chat_ready_at.get(chat_id, 0) - loop.time()
+                if delay > 0:
+                    # The edits submitted while waiting are coalesced into the pending ones.
+                    await asyncio.sleep(delay)
+                    continue
+                await self._acquire_global_slot()
+                if not chat_pending:
+                    break
+                message_id, (bot, text, waiters) = chat_pending.popitem(last=False)
+                self._chat_ready_at[chat_id] = loop.time() + self.per_chat_interval
+                try:
+                    await self._send(bot, chat_id, message_id, text() if callable(text) else text)
+                except RetryAfter as e:
+                    print(f'[{chat_id}] Flood control, retrying the edit in {e.retry_after} seconds.')
+                    self._chat_ready_at[chat_id] = loop.time() + float(e.retry_after)
+                    # Put it back unless a newer text was submitted in the meanwhile.
+                    newer = chat_pending.get(message_id)
+                    if newer is None:
+                        chat_pending[message_id] = [bot, text, waiters]
+                        chat_pending.move_to_end(message_id, last=False)
+                    else:
+                        newer[2].extend(waiters)
+                    continue
+                except Exception as e:
+                    print(f'[{chat_id}] Error editing message {message_id}: {e}')
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            del self._workers[chat_id]
+            if not chat_pending:
+                del self._pending[chat_id]
+
+    async def _send(self, bot, chat_id: int, message_id: int, text: str):
+        # The reply keyboard is already attached to the transcript message, and edits can only carry inline keyboards anyway.
+        try:
+            # The worker task of a chat outlives the request that started it, so its context may hold an earlier trace.
+            with metrics.span('telegram_edit', traced=False):
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except BadRequest as e:
+            if not str(e).startswith("Message is not modified"):
+                raise
+
+edit_scheduler = EditScheduler()
+
+class TelegramPager:
+    """Splices streamed deltas into pages of at most `limit` characters, the Telegram message size limit.
+    Feeding a delta costs its length, and only the page being displayed is joined, so the cost doesn't grow with the output length.
+    """
+    def __init__(self, limit: int = 4096):
+        self.limit = limit
+        self._pages: List[List[str]] = [[]]
+        self.last_page_length = 0
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def feed(self, delta: str):
+        while delta:
+            room = self.limit - self.last_page_length
+            if room == 0:
+                self._pages.append([])
+                self.last_page_length = 0
+                room = self.limit
+            piece = delta[:room]
+            self._pages[-1].append(piece)
+            self.last_page_length += len(piece)
+            delta = delta[room:]
+
+    def page_text(self, index: int) -> str:
+        page = self._pages[index]
+        if len(page) > 1:
+            page[:] = [''.join(page)]
+        return page[0] if page else ''
+
+    def text(self) -> str:
+        return ''.join(self.page_text(i) for i in range(len(self._pages)))
+
+async def cancel_paraphrase(paraphrase_task: asyncio.Task, sent_messages: list):
+    """Cancels a speculative paraphrasing and deletes the messages it has sent.
+
+    Args:
+        paraphrase_task (asyncio.Task): the task running stream_paraphrase
+        sent_messages (list): the messages sent by stream_paraphrase
+    """
+    paraphrase_task.cancel()
+    # asyncio.wait doesn't raise what ended the task, so only a cancellation of this handler itself (e.g. on shutdown) propagates.
+    await asyncio.wait([paraphrase_task])
+    if not paraphrase_task.cancelled() and paraphrase_task.exception() is not None:
+        print(f'The cancelled paraphrasing had failed: {paraphrase_task.exception()}')
+    for message in sent_messages:
+        edit_scheduler.discard(message)
+        try:
+            await message.delete()
+        except BadRequest:
+            pass
+
+def get_outline(context: CallbackContext) -> OutlineDocument:
+    """The outline being edited, converted from the plain list kept in user_data['outline_text'] by former versions."""
+    if 'outline' not in context.user_data:
+        context.user_data['outline'] = OutlineDocument.from_lines(context.user_data.pop('outline_text', []))
+    return context.user_data['outline']
+
+async def render_outline(update: Update, context: CallbackContext):
+    """Shows the outline in place. The first page is a pinned message, and longer outlines continue on more messages.
+    Only the pages whose text changed since the last rendering are edited, pages are added or deleted as the outline grows or shrinks,
+    and the page breaks are kept, so an edit usually touches a single message.
+
+    Args:
+        update (Update): from the telegram bot API
+        context (CallbackContext): from the telegram bot API
+    """
+    document = get_outline(context)
+    view = context.user_data.setdefault('outline_view', {'messages': [], 'breaks': [], 'pages': []})
+    pages = document.paginate(TELEGRAM_MESSAGE_LIMIT, view['breaks']) or [(None, EMPTY_OUTLINE_TEXT)]
+    chat_id = update.effective_chat.id
+    for index, (_, text) in enumerate(pages):
+        if index < len(view['messages']):
+            if text != view['pages'][index]:
+                edit_scheduler.submit(context.bot, MessageRef(chat_id, view['messages'][index]), text)
+            continue
+        message = await context.bot.send_message(chat_id, text)
+        view['messages'].append(message.message_id)
+        if index == 0:
+            try:
+                await message.pin(disable_notification=True)
+            except TelegramError as e:
+                print(f'[{chat_id}] Could not pin the outline: {e}')
+    for message_id in view['messages'][len(pages):]:
+        edit_scheduler.discard(MessageRef(chat_id, message_id))
+        try:
+            await context.bot.delete_message(chat_id, message_id)
+        except BadRequest:
+            pass
+    del view['messages'][len(pages):]
+    view['breaks'] = [start for start, _ in pages if start is not None]
+    view['pages'] = [text for _, text in pages]
+
+async def unpin_outline(update: Update, context: CallbackContext):
+    """Unpins the first page of the outline when leaving the outline mode. The messages stay, as the record of the outline."""
+    view = context.user_data.pop('outline_view', None)
+    if view and view['messages']:
+        try:
+            await context.bot.unpin_chat_message(update.effective_chat.id, view['messages'][0])
+        except TelegramError as e:
+            print(f'[{update.effective_chat.id}] Could not unpin the outline: {e}')
+
 async def end_outline_mode(update: Update, context: CallbackContext) -> int:
+    await unpin_outline(update, context)
     await update.message.reply_text(
         "End outline mode. Back to regular mode.",
         reply_markup=target_usage_markup,
@@ -301,27 +648,35 @@ async def end_outline_mode(update: Update, context: CallbackContext) -> int:
     print(f'[{get_user_full_name(update, context)}] Exiting outline mode.')
     return REGULAR
 
+@metrics.traced('telegram.outline')
 async def outline_transcribe_voice_message(update: Update, context: CallbackContext) -> int:
     # Transcribe the voice message, without GPT paraphrasing.
     user_full_name = await get_user_full_name(update, context)
     transcribed_text = await transcribe_message(user_full_name, update, context)
+    if not transcribed_text.strip():
+        await update.message.reply_text('No speech detected in the voice message.')
+        return OUTLINE
 
     # Implementation V1: use JSON as the intermediate format.
     # Identify the intent and content of the transcribed text.
-    parsed_text = classify_outline_content(transcribed_text)
+    parsed_text = await classify_outline_content_async(transcribed_text)
     if parsed_text['intent'] == 'exit':
+        await unpin_outline(update, context)
         await update.message.reply_text('Exiting outline mode.')
         return REGULAR
+    document = get_outline(context)
+    # The line number comes from GPT, so it may be missing, a string, or out of range. The document clamps or rejects it.
+    try:
+        line = int(parsed_text.get('line', -1))
+    except (TypeError, ValueError):
+        line = -1
     if parsed_text['intent'] == 'append':
-        if parsed_text['line'] == -1:
-            context.user_data['outline_text'].append('* ' + parsed_text['content'])
-        else:
-            # note the python index starts from 0, but the line number starts from 1.
-            context.user_data['outline_text'].insert(parsed_text['line'], '* ' + parsed_text['content'])
+        document.insert_after_line(line, parsed_text['content'])
     if parsed_text['intent'] == 'modify':
-        # note the python index starts from 0, but the line number starts from 1.
-        context.user_data['outline_text'][parsed_text['line'] - 1] = '* ' + parsed_text['content']
-    await update.message.reply_text('\n'.join(context.user_data['outline_text']))
+        if document.replace_line(line, parsed_text['content']) is None:
+            await update.message.reply_text(f'There is no line {line}. The outline has {len(document)} lines.')
+            return OUTLINE
+    await render_outline(update, context)
 
     # Implementation V2: directly use GPT to get the new text
     # text = '\n'.join(context.user_data['outline_text'])
@@ -360,20 +715,18 @@ async def post_init(application: Application):
     await application.bot.set_my_commands([
         BotCommand(command="/start", description="Start the bot."),
         BotCommand(command="/help", description="View more detailed help messages."),
+        BotCommand(command="/search", description="Search your notes."),
         BotCommand(command="/data", description="Check what data we store about you."),
         BotCommand(command="/clear", description="Clear all the data we stored about you."),
         BotCommand(command="/model", description="Select the model for transcribing."),
     ])
 
-def main():
-    persistence = PicklePersistence(filepath="gpt_archive.pickle")
-    application = Application.builder() \
-        .token(telegram_api_token) \
-        .persistence(persistence) \
-        .arbitrary_callback_data(True) \
-        .post_init(post_init) \
-        .build()
+async def post_shutdown(application: Application):
+    await close_http_clients()
+    await save_indexes()
 
+def add_handlers(application: Application):
+    """Registers all the handlers of the bot."""
     regular_handlers =  [
             # target usage
             MessageHandler(filters.Regex('^' + target_usage + '$'), process_thoughts) 
@@ -402,6 +755,7 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help))
     application.add_handler(CommandHandler("clear", clear))
+    application.add_handler(CommandHandler("search", search))
     application.add_handler(CommandHandler("data", data))
     application.add_handler(CommandHandler("model", model_selection))
     application.add_handler(CallbackQueryHandler(model_selection_callback, pattern='^gpt-'))
@@ -412,6 +766,25 @@ def main():
         application.add_handler(MessageHandler(filters.Regex('^' + target_usage + '$'), process_thoughts))
     application.add_handler(MessageHandler(~filters.VOICE & ~filters.COMMAND, set_last_message))
 
+def main():
+    if not os.path.exists(ARCHIVE_FILE) and os.path.exists(PICKLE_ARCHIVE_FILE):
+        print(f'Migrated {migrate_pickle_persistence(PICKLE_ARCHIVE_FILE, ARCHIVE_FILE)} users from {PICKLE_ARCHIVE_FILE} to {ARCHIVE_FILE}.')
+    persistence = SQLitePersistence(filepath=ARCHIVE_FILE)
+    if METRICS_PORT:
+        metrics.serve_metrics(METRICS_PORT)
+        print(f'Serving metrics on port {METRICS_PORT}.')
+    application = Application.builder() \
+        .token(telegram_api_token) \
+        .persistence(persistence) \
+        .arbitrary_callback_data(True) \
+        .concurrent_updates(ChatOrderedUpdateProcessor()) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown) \
+        .build()
+
+    add_handlers(application)
+    schedule_daily_summaries(application)
+
     # Run the bot until the user presses Ctrl-C
     print('Bot is running...')
     application.run_polling()
@@ -0,0 +1,10 @@
+"""
+This file holds the shared setup of the tests: the repository root on the import path, and no on-disk response cache,
+so the tests never read nor write the cache of a real run.
+"""
+import os
+import sys
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ['CACHE_DB_FILE'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
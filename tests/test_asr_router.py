@@ -0,0 +1,67 @@
+"""
+This file holds the tests of the ASR backends routing, with fake backends instead of the Whisper API.
+"""
+import asyncio
+from typing import List
+import pytest
+import core
+from core import ASRBackend, ASRBackendDeclined, ASRRouter
+
+class FakeBackend(ASRBackend):
+    """Answers a fixed transcript, or raises a fixed error, and records the calls."""
+    def __init__(self, name: str, text: str = '', error: Exception = None):
+        self.name = name
+        self.text = text
+        self.error = error
+        self.calls: List[str] = []
+
+    def transcribe(self, data: bytes, audio_format: str, prompt: str) -> str:
+        self.calls.append(prompt)
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+def test_incomplete_backend_fails_when_created():
+    class Incomplete(ASRBackend):
+        name = 'incomplete'
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_declined_backend_falls_back_to_the_next_one():
+    declining = FakeBackend('local', error=ASRBackendDeclined('too long'))
+    fallback = FakeBackend('openai', text='你好')
+    router = ASRRouter([declining, fallback])
+    assert router.transcribe(b'audio', 'ogg', 'prompt') == '你好'
+    assert declining.calls == ['prompt'] and fallback.calls == ['prompt']
+
+def test_failed_backend_falls_back_to_the_next_one(capsys):
+    failing = FakeBackend('local', error=RuntimeError('model crashed'))
+    fallback = FakeBackend('openai', text='hello')
+    assert ASRRouter([failing, fallback]).transcribe(b'audio', 'ogg', '') == 'hello'
+    assert 'model crashed' in capsys.readouterr().out
+
+def test_first_backend_answering_wins():
+    first = FakeBackend('local', text='first')
+    second = FakeBackend('openai', text='second')
+    assert ASRRouter([first, second]).transcribe(b'audio', 'ogg', '') == 'first'
+    assert second.calls == []
+
+def test_last_backend_error_is_raised():
+    router = ASRRouter([FakeBackend('local', error=ASRBackendDeclined('too long')), FakeBackend('openai', error=RuntimeError('down'))])
+    with pytest.raises(RuntimeError, match='down'):
+        router.transcribe(b'audio', 'ogg', '')
+    with pytest.raises(ASRBackendDeclined):
+        ASRRouter([FakeBackend('local', error=ASRBackendDeclined('too long'))]).transcribe(b'audio', 'ogg', '')
+
+def test_async_declined_backend_falls_back_to_the_next_one():
+    fallback = FakeBackend('openai', text='你好')
+    router = ASRRouter([FakeBackend('local', error=ASRBackendDeclined('not installed')), fallback])
+    assert asyncio.run(router.transcribe_async(b'audio', 'ogg', 'prompt')) == '你好'
+    assert fallback.calls == ['prompt']
+
+def test_router_from_config_with_a_registered_backend(monkeypatch):
+    fake = FakeBackend('fake', text='offline')
+    monkeypatch.setitem(core.ASR_BACKEND_FACTORIES, 'fake', lambda: fake)
+    monkeypatch.setattr(core, 'ASR_ROUTER', ASRRouter.from_config('fake, openai'))
+    assert [backend.name for backend in core.ASR_ROUTER.backends] == ['fake', 'openai']
+    assert core.transcribe_voice_data(b'audio', 'ogg') == 'offline'
@@ -0,0 +1,26 @@
+"""
+This file holds the tests of the audio format sniffing and of the passthrough decisions, on hand-made headers.
+"""
+from core import AudioFormatPolicy, sniff_audio_format
+
+def test_adts_aac_is_not_taken_for_mp3():
+    # MPEG-4 and MPEG-2 ADTS headers, with and without CRC.
+    for second_byte in (0xF1, 0xF9, 0xF0, 0xF8):
+        assert sniff_audio_format(bytes([0xFF, second_byte, 0x50, 0x80]) + bytes(100)) == ('aac', 'aac')
+
+def test_mp3_frames_and_id3():
+    # MPEG-1 Layer III and MPEG-2 Layer III frame headers.
+    assert sniff_audio_format(bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(100)) == ('mp3', 'mp3')
+    assert sniff_audio_format(bytes([0xFF, 0xF3, 0x90, 0x64]) + bytes(100)) == ('mp3', 'mp3')
+    assert sniff_audio_format(b'ID3\x04\x00' + bytes(100)) == ('mp3', 'mp3')
+
+def test_other_containers():
+    assert sniff_audio_format(b'OggS' + bytes(24) + b'OpusHead') == ('ogg', 'opus')
+    assert sniff_audio_format(b'RIFF\x00\x00\x00\x00WAVEfmt ') == ('wav', 'pcm')
+    assert sniff_audio_format(b'fLaC' + bytes(10)) == ('flac', 'flac')
+    assert sniff_audio_format(b'not audio') == (None, None)
+
+def test_adts_aac_is_reencoded():
+    plan = AudioFormatPolicy().decide(bytes([0xFF, 0xF1, 0x50, 0x80]) + bytes(100))
+    assert not plan.passthrough
+    assert plan.input_format == 'aac'
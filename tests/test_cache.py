@@ -0,0 +1,78 @@
+"""
+This file holds the tests of the response cache (TwoTierCache), and of the chat outputs going through it.
+"""
+import asyncio
+import time
+import openai
+from openai.openai_object import OpenAIObject
+import core
+from core import STREAM_DELTA, TwoTierCache
+
+def test_values_survive_in_the_sqlite_tier(tmp_path):
+    db_file = str(tmp_path / 'cache.sqlite3')
+    TwoTierCache(db_file).set('chat:a', 'value')
+    cache = TwoTierCache(db_file)
+    assert cache.get('chat:a') == 'value'
+    assert asyncio.run(cache.get_async('chat:a')) == 'value'
+    assert cache.stats()['chat'] == {'memory_hits': 1, 'disk_hits': 1, 'misses': 0}
+
+def test_async_access_does_not_block_the_event_loop_on_the_disk(tmp_path):
+    cache = TwoTierCache(str(tmp_path / 'cache.sqlite3'))
+    cache.set('chat:hot', 'in memory')
+
+    async def run():
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        ticker = asyncio.create_task(tick())
+        # A slow disk, or a large eviction in another thread.
+        with cache._db_lock:
+            lookup = asyncio.create_task(cache.get_async('chat:cold'))
+            write = asyncio.create_task(cache.set_async('chat:new', 'value'))
+            await asyncio.sleep(0.2)
+            assert not lookup.done() and not write.done()
+            # The memory tier is still served right away, including the value being written.
+            assert await cache.get_async('chat:hot') == 'in memory'
+            assert await cache.get_async('chat:new') == 'value'
+        assert await lookup is None
+        await write
+        ticker.cancel()
+        return ticks
+    assert asyncio.run(run()) >= 10
+    assert TwoTierCache(cache.db_file).get('chat:new') == 'value'
+
+def test_expired_values_are_misses(tmp_path):
+    cache = TwoTierCache(str(tmp_path / 'cache.sqlite3'), ttl_seconds=0.05)
+    cache.set('chat:a', 'value')
+    time.sleep(0.1)
+    assert cache.get('chat:a') is None
+
+def chunk(content=None, finish_reason=None) -> OpenAIObject:
+    delta = {'content': content} if content is not None else {}
+    return OpenAIObject.construct_from({'choices': [{'delta': delta, 'finish_reason': finish_reason}]})
+
+def test_cached_stream_replays_the_streamed_text(monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        async def generate():
+            for piece in ['\n', ' Hello', ' world', ' \n']:
+                yield chunk(piece)
+            yield chunk(finish_reason='stop')
+        return generate()
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', acreate)
+    monkeypatch.setattr(core, 'RESPONSE_CACHE', TwoTierCache(None))
+
+    async def stream() -> str:
+        text = ''.join([event.data async for event in core.gpt_process_text_async('text', 'prompt', 'gpt-3.5-turbo') if event.kind == STREAM_DELTA])
+        await core.close_http_clients()
+        return text
+    live = asyncio.run(stream())
+    cached = asyncio.run(stream())
+    assert len(calls) == 1
+    assert cached == live == '\n Hello world \n'
+    # The full completions share the cache entry, and still answer the stripped text.
+    assert asyncio.run(core.gpt_process_text_full_async('text', 'prompt', 'gpt-3.5-turbo')) == 'Hello world'
@@ -0,0 +1,44 @@
+"""
+This file holds the tests of the chunked transcription of long voice notes, with a fake decoder and a fake Whisper.
+"""
+import asyncio
+import numpy as np
+import core
+
+def test_chunks_are_transcribed_concurrently_and_yielded_in_order(monkeypatch):
+    pcm = (np.sin(np.arange(150 * core.PCM_SAMPLE_RATE) * 0.05) * 8000).astype(np.int16)
+    starts = [start for start, _ in core.find_chunk_boundaries(pcm)]
+    assert len(starts) > 2
+    running = 0
+    most = 0
+    prompts = []
+
+    async def decode(data):
+        return pcm
+
+    async def encode(chunk):
+        # The chunk is a view of the samples, so its offset tells which one it is.
+        return str((chunk.ctypes.data - pcm.ctypes.data) // pcm.itemsize).encode()
+
+    async def transcribe(data, audio_format, prompt='简体中文'):
+        nonlocal running, most
+        index = starts.index(int(data))
+        prompts.append(prompt)
+        running += 1
+        most = max(most, running)
+        # The first chunk is the slowest, and still comes out first.
+        await asyncio.sleep(0.1 if index == 0 else 0.01)
+        running -= 1
+        return f'part {index}'
+
+    monkeypatch.setattr(core, 'decode_audio_to_pcm_async', decode)
+    monkeypatch.setattr(core, 'encode_pcm_async', encode)
+    monkeypatch.setattr(core, 'transcribe_voice_data_async', transcribe)
+    monkeypatch.setattr(core, 'VAD_ENABLED', False)
+
+    async def run():
+        return [part async for part in core.transcribe_voice_data_chunked_async(b'audio', max_concurrency=2)]
+    assert asyncio.run(run()) == [f'part {index}' for index in range(len(starts))]
+    assert most == 2
+    # The chunks don't wait for each other's transcript, so they all get the language prompt.
+    assert prompts == ['简体中文'] * len(starts)
@@ -0,0 +1,28 @@
+"""
+This file holds the tests of the job queue behind the /jobs routes: the expiry of the finished jobs.
+"""
+import threading
+from job_queue import JobQueue
+
+def test_a_long_running_job_does_not_hold_back_the_expiry_of_the_next_ones():
+    jobs = JobQueue(workers=2, ttl=60)
+    release = threading.Event()
+    slow = jobs.submit('slow', lambda job: release.wait(5))
+    fast = [jobs.submit('fast', lambda job: 'done') for _ in range(2)]
+    for job in fast:
+        assert job.wait(2)
+    # All of them were created and the fast ones finished past the TTL, while the slow one is still running.
+    for job in [slow] + fast:
+        job.created -= 120
+    for job in fast:
+        job.finished -= 120
+    recent = jobs.submit('recent', lambda job: 'done')
+    assert jobs.get(slow.id) is slow
+    assert all(jobs.get(job.id) is None for job in fast)
+    assert jobs.get(recent.id) is recent
+    release.set()
+    assert slow.wait(2)
+    # Finished within the TTL, so it is kept even though it was created long ago.
+    jobs.submit('recent', lambda job: 'done')
+    assert jobs.get(slow.id) is slow
+    jobs.shutdown()
@@ -0,0 +1,38 @@
+"""
+This file holds the tests of the job routes of the web app, through the Flask test client.
+"""
+import threading
+import time
+import pytest
+import main
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+@pytest.fixture
+def pending_job():
+    release = threading.Event()
+    job = main.job_queue.submit('test', lambda job: release.wait(5) and 'done')
+    yield job
+    release.set()
+
+def test_invalid_wait_is_rejected(client, pending_job):
+    for wait in ('abc', 'nan', ''):
+        response = client.get(f'/jobs/{pending_job.id}?wait={wait}')
+        assert response.status_code == 400, wait
+
+def test_negative_wait_does_not_block(client, pending_job):
+    start = time.perf_counter()
+    response = client.get(f'/jobs/{pending_job.id}?wait=-5')
+    assert response.status_code == 200
+    assert time.perf_counter() - start < 1
+
+def test_wait_returns_the_finished_job(client):
+    job = main.job_queue.submit('test', lambda job: 'done')
+    response = client.get(f'/jobs/{job.id}?wait=5')
+    assert response.status_code == 200
+    assert response.get_json()['result'] == 'done'
+
+def test_unknown_job(client):
+    assert client.get('/jobs/unknown?wait=abc').status_code == 404
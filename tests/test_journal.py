@@ -0,0 +1,107 @@
+"""
+This file holds the tests of the journal: the rotation into gzip segments, the index and the reads of a date range.
+"""
+import gzip
+import json
+import os
+import datetime
+import threading
+import pytest
+from journal import Journal
+
+def record(day: str, number: int, text: str = 'note') -> dict:
+    return {'content': f'{text} {number}', 'date': f'{day} 12:00:{number % 60:02d}'}
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / 'log.jsonl'), rotate_bytes=1024, fsync_interval=0.01)
+    yield journal
+    journal.close()
+
+def load_index(journal: Journal) -> dict:
+    with open(journal.index_path, encoding='UTF-8') as f:
+        return json.load(f)
+
+def test_a_new_day_rotates_into_one_gzip_member_per_day(journal):
+    for number in range(3):
+        journal.write(record('2023-07-01', number))
+    journal.flush()
+    assert not os.path.exists(journal.index_path)
+    journal.write(record('2023-07-02', 3))
+    journal.flush()
+
+    segments = load_index(journal)['segments']
+    assert [(segment['number'], segment['file'], segment['records']) for segment in segments] == [(1, 'log.jsonl.000001.gz', 3)]
+    assert segments[0]['days'] == {'2023-07-01': 0}
+    # The segment is a valid gzip file, and the file being written only holds the new day.
+    with gzip.open(os.path.join(os.path.dirname(journal.path), 'log.jsonl.000001.gz')) as f:
+        assert [json.loads(line)['content'] for line in f] == ['note 0', 'note 1', 'note 2']
+    with open(journal.path, 'rb') as f:
+        assert [json.loads(line)['content'] for line in f] == ['note 3']
+
+def test_the_size_limit_rotates_and_the_index_points_at_each_member(journal):
+    # Each record is above a third of the limit, so a segment holds 2 of them.
+    for number in range(7):
+        journal.write(record('2023-07-01', number, 'x' * 400))
+        journal.flush()
+    segments = load_index(journal)['segments']
+    assert [segment['records'] for segment in segments] == [2, 2, 2]
+    assert [segment['file'] for segment in segments] == ['log.jsonl.000001.gz', 'log.jsonl.000002.gz', 'log.jsonl.000003.gz']
+    directory = os.path.dirname(journal.path)
+    for segment in segments:
+        assert list(segment['days']) == ['2023-07-01']
+        with open(os.path.join(directory, segment['file']), 'rb') as f:
+            f.seek(segment['days']['2023-07-01'])
+            with gzip.GzipFile(fileobj=f) as member:
+                assert len(member.readlines()) == 2
+    assert len(list(journal.read(datetime.date(2023, 7, 1)))) == 7
+
+def test_read_a_date_range_across_segments(journal):
+    days = [f'2023-07-{day:02d}' for day in range(1, 7)]
+    for day in days:
+        for number in range(3):
+            journal.write(record(day, number, day))
+        journal.flush()
+    assert len(load_index(journal)['segments']) == 5
+
+    records = list(journal.read(datetime.date(2023, 7, 2), datetime.date(2023, 7, 4)))
+    assert [item['content'] for item in records] == [f'{day} {number}' for day in days[1:4] for number in range(3)]
+    # Without an end, the records of the file being written come last.
+    records = list(journal.read(datetime.date(2023, 7, 5)))
+    assert [item['content'] for item in records] == [f'{day} {number}' for day in days[4:] for number in range(3)]
+    assert list(journal.read(datetime.date(2023, 8, 1))) == []
+
+def test_read_after_close_returns_right_away(journal):
+    journal.write(record('2023-07-01', 0))
+    journal.close()
+    reader = threading.Thread(target=lambda: list(journal.read(datetime.date(2023, 7, 1))))
+    reader.start()
+    reader.join(2)
+    assert not reader.is_alive()
+    assert journal.flush(timeout=1)
+    assert [item['content'] for item in journal.read(datetime.date(2023, 7, 1))] == ['note 0']
+
+def test_a_writer_stopping_while_flushing_releases_the_flush(journal):
+    journal.close()
+    # A writer that stops without seeing the event, as when the journal is closed right after the flush queued it.
+    stop = threading.Event()
+    journal._thread = threading.Thread(target=stop.wait)
+    journal._thread.start()
+    flushed = []
+    flusher = threading.Thread(target=lambda: flushed.append(journal.flush()))
+    flusher.start()
+    flusher.join(0.2)
+    assert flusher.is_alive()
+    stop.set()
+    flusher.join(2)
+    assert flushed == [True]
+
+def test_flush_times_out_while_the_writer_is_stuck(journal):
+    journal.close()
+    stop = threading.Event()
+    journal._thread = threading.Thread(target=stop.wait)
+    journal._thread.start()
+    try:
+        assert journal.flush(timeout=0.15) is False
+    finally:
+        stop.set()
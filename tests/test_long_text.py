@@ -0,0 +1,43 @@
+"""
+This file holds the tests of the blocking entry points of the long-text and long-audio paths, which run their coroutines on a private loop.
+"""
+import asyncio
+import threading
+import core
+
+def fake_long_text(monkeypatch):
+    loops = []
+
+    async def process_long_text(text, system_prompt, model):
+        loops.append((asyncio.get_running_loop(), threading.current_thread().name))
+        await asyncio.sleep(0)
+        return f'processed {text}'
+    monkeypatch.setattr(core, 'is_long_text', lambda text, model: True)
+    monkeypatch.setattr(core, 'process_long_text', process_long_text)
+    return loops
+
+def test_gpt_process_text_runs_the_long_path_from_synchronous_code(monkeypatch):
+    loops = fake_long_text(monkeypatch)
+    assert core.gpt_process_text('long note', 'prompt') == 'processed long note'
+    assert loops[0][1] == threading.current_thread().name
+
+def test_gpt_process_text_runs_the_long_path_inside_a_running_loop(monkeypatch):
+    loops = fake_long_text(monkeypatch)
+
+    async def handler():
+        # E.g. a blocking helper called from an async handler, where asyncio.run would raise a RuntimeError.
+        return core.gpt_process_text('long note', 'prompt'), asyncio.get_running_loop()
+    result, handler_loop = asyncio.run(handler())
+    assert result == 'processed long note'
+    assert loops[0][0] is not handler_loop
+    assert loops[0][1].startswith('private-loop')
+
+def test_transcribe_long_voice_data_inside_a_running_loop(monkeypatch):
+    async def chunked(data, max_concurrency):
+        yield 'first part,'
+        yield 'second part'
+    monkeypatch.setattr(core, 'transcribe_voice_data_chunked_async', chunked)
+
+    async def handler():
+        return core.transcribe_long_voice_data(b'audio')
+    assert asyncio.run(handler()) == 'first part, second part'
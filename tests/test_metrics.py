@@ -0,0 +1,31 @@
+"""
+This file holds the tests of the traces written to TRACE_LOG_FILE.
+"""
+import datetime
+import threading
+import metrics
+from journal import get_journal
+
+def test_finished_traces_are_written_by_the_journal_thread(tmp_path, monkeypatch):
+    path = str(tmp_path / 'traces.jsonl')
+    monkeypatch.setattr(metrics, 'TRACE_LOG_FILE', path)
+    writers = []
+    journal = get_journal(path)
+    append = journal._append
+
+    def recording_append(fd, records):
+        writers.append(threading.current_thread().name)
+        append(fd, records)
+    monkeypatch.setattr(journal, '_append', recording_append)
+
+    with metrics.start_trace('test.request', chat_id=1) as trace:
+        metrics.record_stage('whisper', 0.25)
+        # Not JSON serializable, so written as its str.
+        metrics.annotate(size=datetime.timedelta(seconds=3))
+    records = list(journal.read(datetime.date.today()))
+    assert writers == ['journal']
+    assert len(records) == 1
+    assert records[0]['trace'] == 'test.request'
+    assert records[0]['trace_id'] == trace.trace_id
+    assert records[0]['attrs'] == {'chat_id': 1, 'size': '0:00:03'}
+    assert [span['stage'] for span in records[0]['spans']] == ['whisper']
@@ -0,0 +1,74 @@
+"""
+This file holds the tests of the outline document: the clamping of the untrusted line numbers, and the pagination.
+"""
+import pickle
+import pytest
+from outline import OutlineDocument
+
+def texts(document: OutlineDocument):
+    return [node.text for node in document]
+
+def sample() -> OutlineDocument:
+    document = OutlineDocument.from_lines(['first', 'second', 'third'])
+    document.set_depth(document.node_at(1).id, 1)
+    return document
+
+@pytest.mark.parametrize('line, expected', [
+    (-1, ['first', 'second', 'third', 'new']),
+    (-5, ['first', 'second', 'third', 'new']),
+    (0, ['new', 'first', 'second', 'third']),
+    (1, ['first', 'new', 'second', 'third']),
+    (3, ['first', 'second', 'third', 'new']),
+    (99, ['first', 'second', 'third', 'new']),
+])
+def test_insert_after_line_clamps_the_line_number(line, expected):
+    document = sample()
+    node = document.insert_after_line(line, 'new')
+    assert texts(document) == expected
+    assert document.index_of(node.id) == expected.index('new')
+
+def test_insert_after_line_keeps_the_depth_of_the_line_before():
+    document = sample()
+    assert document.insert_after_line(2, 'nested').depth == 1
+    assert document.insert_after_line(0, 'top').depth == 0
+
+def test_insert_after_line_in_an_empty_document():
+    document = OutlineDocument()
+    document.insert_after_line(-1, 'only')
+    document.insert_after_line(7, 'last')
+    document.insert_after_line(0, 'first')
+    assert texts(document) == ['first', 'only', 'last']
+
+@pytest.mark.parametrize('line', [0, -1, 4, 100])
+def test_replace_line_rejects_a_missing_line(line):
+    document = sample()
+    assert document.replace_line(line, 'changed') is None
+    assert texts(document) == ['first', 'second', 'third']
+
+def test_replace_line_keeps_the_id_and_the_depth():
+    document = sample()
+    before = document.node_at(1)
+    node = document.replace_line(2, 'changed')
+    assert node is before
+    assert texts(document) == ['first', 'changed', 'third']
+    assert node.depth == 1
+
+def test_a_line_longer_than_a_page_fills_pages_of_its_own():
+    document = OutlineDocument.from_lines(['short', 'x' * 25, 'tail'])
+    pages = document.paginate(limit=10)
+    ids = [node.id for node in document]
+    assert [text for _, text in pages] == ['* short', '* xxxxxxxx', 'xxxxxxxxxx', 'xxxxxxx', '* tail']
+    assert [start for start, _ in pages] == [ids[0], ids[1], ids[1], ids[1], ids[2]]
+
+def test_the_page_breaks_are_kept_after_an_edit():
+    document = OutlineDocument.from_lines([f'line {number}' for number in range(6)])
+    pages = document.paginate(limit=30)
+    breaks = [start for start, _ in pages]
+    document.replace_line(1, 'edited')
+    assert [start for start, _ in document.paginate(limit=30, breaks=breaks)] == breaks
+
+def test_pickle_round_trip():
+    document = sample()
+    copy = pickle.loads(pickle.dumps(document))
+    assert [(node.id, node.text, node.depth) for node in copy] == [(node.id, node.text, node.depth) for node in document]
+    assert copy.append('more').id == document.append('more').id
@@ -0,0 +1,22 @@
+"""
+This file holds the tests of the local outline intent classifier.
+"""
+from core import OUTLINE_INTENT_CLASSIFIER, normalize_utterance
+
+def test_fillers_are_removed_after_the_spaces():
+    assert normalize_utterance("Let us enter outline mode, please!") == 'enteroutlinemode'
+    assert normalize_utterance('Lets enter outline mode') == 'enteroutlinemode'
+    assert normalize_utterance('请进入草稿模式吧。') == '进入草稿模式'
+
+def test_triggers_are_accepted_locally():
+    assert OUTLINE_INTENT_CLASSIFIER.classify('进入草稿模式。')[0] is True
+    assert OUTLINE_INTENT_CLASSIFIER.classify('Let us enter outline mode.')[0] is True
+    assert OUTLINE_INTENT_CLASSIFIER.classify('退出草稿模式。')[0] is False
+
+def test_a_negated_trigger_is_not_accepted():
+    assert OUTLINE_INTENT_CLASSIFIER.classify('不要进入草稿模式。')[0] is not True
+    assert OUTLINE_INTENT_CLASSIFIER.classify("Don't enter outline mode.")[0] is not True
+
+def test_one_edit_in_a_short_phrase_is_not_accepted():
+    assert OUTLINE_INTENT_CLASSIFIER.classify('草莓模式。')[0] is not True
+    assert OUTLINE_INTENT_CLASSIFIER.classify('大刚模式')[0] is not True
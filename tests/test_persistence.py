@@ -0,0 +1,70 @@
+"""
+This file holds the tests of SQLitePersistence, on a temporary database.
+"""
+import asyncio
+import datetime
+import sqlite3
+import pytest
+from history import HistoryEntry, PagedHistory
+from persistence import SQLitePersistence
+
+def make_entry(text: str) -> HistoryEntry:
+    entry = HistoryEntry(datetime.datetime(2023, 7, 1, 12, 0))
+    entry.add_revision('transcript', text)
+    return entry
+
+async def store_user(filepath: str, user_id: int, texts):
+    persistence = SQLitePersistence(filepath)
+    data = {}
+    await persistence.refresh_user_data(user_id, data)
+    data['history'] = PagedHistory([make_entry(text) for text in texts])
+    await persistence.update_user_data(user_id, data)
+    await persistence.flush()
+
+def stored_history_count(filepath: str, user_id: int) -> int:
+    with sqlite3.connect(filepath) as db:
+        return db.execute('SELECT COUNT(*) FROM history WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+def test_failed_load_does_not_overwrite_the_stored_history(tmp_path, monkeypatch):
+    filepath = str(tmp_path / 'bot.sqlite3')
+    asyncio.run(store_user(filepath, 1, ['a', 'b', 'c']))
+
+    async def run():
+        persistence = SQLitePersistence(filepath)
+        load_user = persistence._load_user
+        def failing_load(user_id):
+            raise sqlite3.OperationalError('database is locked')
+        monkeypatch.setattr(persistence, '_load_user', failing_load)
+        user_data = {}
+        with pytest.raises(sqlite3.OperationalError):
+            await persistence.refresh_user_data(1, user_data)
+        # What a handler would do on the empty user_data, and the flush after it.
+        user_data['history'] = PagedHistory()
+        await persistence.update_user_data(1, user_data)
+        assert stored_history_count(filepath, 1) == 3
+
+        # The next update loads the user again.
+        monkeypatch.setattr(persistence, '_load_user', load_user)
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        assert [entry.current_text for entry in user_data['history']] == ['a', 'b', 'c']
+        user_data['history'].append(make_entry('d'))
+        await persistence.update_user_data(1, user_data)
+        await persistence.flush()
+    asyncio.run(run())
+    assert stored_history_count(filepath, 1) == 4
+
+def test_user_is_loaded_once(tmp_path):
+    filepath = str(tmp_path / 'bot.sqlite3')
+    asyncio.run(store_user(filepath, 1, ['a']))
+
+    async def run():
+        persistence = SQLitePersistence(filepath)
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        user_data['history'].append(make_entry('b'))
+        # Later updates keep the data in memory rather than reading it again.
+        await persistence.refresh_user_data(1, user_data)
+        assert len(user_data['history']) == 2
+        await persistence.flush()
+    asyncio.run(run())
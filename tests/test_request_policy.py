@@ -0,0 +1,146 @@
+"""
+This file holds the tests of the request execution layer: the retryable errors, the retries, the deadline and the hedging,
+with fake attempts instead of API calls.
+"""
+import asyncio
+import time
+import openai
+import pytest
+import request_policy
+from request_policy import DeadlineExceeded, LatencyTracker, RequestExecutor, RequestPolicy, is_retryable, using_policy
+
+NO_HEDGE = RequestPolicy(deadline=5, max_retries=2, hedge=False)
+HEDGE = RequestPolicy(deadline=5, max_retries=0, hedge=True)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(request_policy, 'retry_delay', lambda error, retry: 0.0)
+    monkeypatch.setattr(request_policy, 'HEDGE_MIN_DELAY_SECONDS', 0.05)
+
+def fast_executor() -> RequestExecutor:
+    """An executor whose latencies are all 10 ms, so it hedges after HEDGE_MIN_DELAY_SECONDS."""
+    latencies = LatencyTracker()
+    for _ in range(request_policy.LATENCY_MIN_SAMPLES):
+        latencies.observe(request_policy.CHAT, 'gpt-4', 0.01)
+    return RequestExecutor(latencies, max_workers=4)
+
+def test_retryable_errors():
+    assert is_retryable(openai.error.RateLimitError('slow down'))
+    assert is_retryable(openai.error.APIError('bad gateway', http_status=502))
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(openai.error.APIError('bad request', http_status=400))
+    assert not is_retryable(openai.error.InvalidRequestError('too long', 'messages'))
+    # A TimeoutError too, but the time of the call is over.
+    assert not is_retryable(DeadlineExceeded())
+
+def failing_attempts(errors):
+    calls = []
+
+    def attempt(timeout: float):
+        calls.append(timeout)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'answer'
+    return attempt, calls
+
+def test_transient_errors_are_retried():
+    attempt, calls = failing_attempts([openai.error.RateLimitError('slow down'), openai.error.Timeout('timed out')])
+    with using_policy(NO_HEDGE):
+        assert RequestExecutor(LatencyTracker()).run(request_policy.CHAT, 'gpt-4', attempt) == 'answer'
+    assert len(calls) == 3
+
+def test_the_last_error_is_raised_when_the_retries_run_out():
+    attempt, calls = failing_attempts([openai.error.RateLimitError(str(n)) for n in range(5)])
+    with using_policy(NO_HEDGE), pytest.raises(openai.error.RateLimitError, match='2'):
+        RequestExecutor(LatencyTracker()).run(request_policy.CHAT, 'gpt-4', attempt)
+    assert len(calls) == 3
+
+@pytest.mark.parametrize('error', [openai.error.InvalidRequestError('too long', 'messages'), DeadlineExceeded('inner call')])
+def test_permanent_errors_are_not_retried(error):
+    attempt, calls = failing_attempts([error])
+    with using_policy(NO_HEDGE), pytest.raises(type(error)):
+        RequestExecutor(LatencyTracker()).run(request_policy.CHAT, 'gpt-4', attempt)
+    assert len(calls) == 1
+
+    attempt, calls = failing_attempts([error])
+
+    async def async_attempt(timeout: float):
+        return attempt(timeout)
+    with using_policy(NO_HEDGE), pytest.raises(type(error)):
+        asyncio.run(RequestExecutor(LatencyTracker()).run_async(request_policy.CHAT, 'gpt-4', async_attempt))
+    assert len(calls) == 1
+
+def test_the_deadline_covers_the_whole_call():
+    async def attempt(timeout: float):
+        await asyncio.sleep(timeout + 1)
+
+    with using_policy(RequestPolicy(deadline=0.1, max_retries=3, hedge=False)), pytest.raises(DeadlineExceeded):
+        asyncio.run(RequestExecutor(LatencyTracker()).run_async(request_policy.CHAT, 'gpt-4', attempt))
+    with using_policy(RequestPolicy(deadline=0.1, max_retries=3, hedge=False)), pytest.raises(DeadlineExceeded):
+        RequestExecutor(LatencyTracker()).run(request_policy.CHAT, 'gpt-4', lambda timeout: time.sleep(0.5))
+
+def test_a_slow_attempt_is_hedged_and_the_backup_wins():
+    calls = []
+
+    def attempt(timeout: float):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return 'slow'
+        return 'fast'
+    executor = fast_executor()
+    with using_policy(HEDGE):
+        start = time.monotonic()
+        assert executor.run(request_policy.CHAT, 'gpt-4', attempt) == 'fast'
+        assert time.monotonic() - start < 0.4
+    assert len(calls) == 2
+
+def test_the_hedge_of_an_async_call_cancels_and_discards_the_loser():
+    started, cancelled, discarded = [], [], []
+
+    async def attempt(timeout: float):
+        started.append(timeout)
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return 'slow'
+        return 'fast'
+
+    async def discard(result):
+        discarded.append(result)
+    with using_policy(HEDGE):
+        assert asyncio.run(fast_executor().run_async(request_policy.CHAT, 'gpt-4', attempt, discard)) == 'fast'
+    assert len(started) == 2
+    assert cancelled == [True]
+    assert discarded == []
+
+def test_hedges_are_limited_to_a_share_of_the_calls():
+    executor = fast_executor()
+    calls = []
+
+    async def attempt(timeout: float):
+        calls.append(timeout)
+        await asyncio.sleep(0.1)
+        return 'answer'
+
+    async def run():
+        for _ in range(3):
+            await executor.run_async(request_policy.CHAT, 'gpt-4', attempt)
+    with using_policy(HEDGE):
+        asyncio.run(run())
+    # The first call spends the only hedge token, and the next ones only earn HEDGE_MAX_RATIO of one each.
+    assert len(calls) == 4
+
+def test_no_hedge_without_enough_latency_samples():
+    calls = []
+
+    def attempt(timeout: float):
+        calls.append(timeout)
+        time.sleep(0.1)
+        return 'answer'
+    with using_policy(HEDGE):
+        assert RequestExecutor(LatencyTracker()).run(request_policy.CHAT, 'gpt-4', attempt) == 'answer'
+    assert len(calls) == 1
@@ -0,0 +1,94 @@
+"""
+This file holds the tests of the note search: the tokenizer, the ranking, and the index lifecycle of get_index.
+"""
+import asyncio
+import datetime
+import threading
+import pytest
+import search
+from history import HistoryEntry, PagedHistory
+from search import NoteIndex, get_index, tokenize
+
+def make_entry(text: str) -> HistoryEntry:
+    entry = HistoryEntry(datetime.datetime(2023, 7, 1, 12, 0))
+    entry.add_revision('transcript', text)
+    return entry
+
+@pytest.fixture(autouse=True)
+def no_snapshots(monkeypatch):
+    monkeypatch.setattr(search, 'SEARCH_INDEX_DIR', '')
+    monkeypatch.setattr(search, '_indexes', search.OrderedDict())
+    monkeypatch.setattr(search, '_builds', {})
+
+def test_tokenize_mixes_cjk_bigrams_and_words():
+    assert tokenize('今天天气 Good day') == ['今天', '天天', '天气', 'good', 'day']
+    assert tokenize('猫') == ['猫']
+
+def test_search_ranks_the_matching_notes():
+    index = NoteIndex()
+    for doc, text in enumerate(['今天天气很好', '明天开会', '天气预报说明天下雨']):
+        index.add(doc, text)
+    assert [doc for doc, _ in index.search('天气')] == [0, 2]
+    assert index.search('会议') == []
+
+def paged_history(texts, hot_entries: int, loads: list) -> PagedHistory:
+    """A history whose older entries are only readable through a slow loader, like the ones on disk."""
+    entries = [make_entry(text) for text in texts]
+    release = threading.Event()
+    def loader(start: int, stop: int):
+        loads.append((threading.current_thread().name, start, stop))
+        release.wait(5)
+        return entries[start:stop]
+    offset = len(entries) - hot_entries
+    history = PagedHistory(entries[offset:], offset=offset, hot_entries=hot_entries)
+    history.mark_persisted(len(entries), loader)
+    return history, release
+
+def test_concurrent_searches_wait_for_the_same_build(monkeypatch):
+    monkeypatch.setattr(search, 'HISTORY_PAGE_SIZE', 10)
+    loads = []
+    history, release = paged_history([f'note {i}' for i in range(50)], hot_entries=5, loads=loads)
+
+    async def run():
+        first = asyncio.create_task(get_index(1, history))
+        await asyncio.sleep(0.1)
+        # The event loop isn't blocked by the disk read in the meanwhile.
+        second = asyncio.create_task(get_index(1, history))
+        await asyncio.sleep(0.1)
+        assert not first.done() and not second.done()
+        release.set()
+        return await first, await second
+    first, second = asyncio.run(run())
+    assert first is second
+    assert len(first) == 50
+    # The pages on disk were read once, off the event loop.
+    assert [start for _, start, _ in loads] == [0, 10, 20, 30, 40]
+    assert all(name != threading.main_thread().name for name, _, _ in loads)
+
+def test_failed_build_is_not_served(monkeypatch):
+    history = PagedHistory([make_entry('a')], offset=1)
+    def loader(start: int, stop: int):
+        raise OSError('disk error')
+    history.mark_persisted(2, loader)
+
+    async def run():
+        with pytest.raises(OSError):
+            await get_index(1, history)
+        assert 1 not in search._indexes and 1 not in search._builds
+    asyncio.run(run())
+
+def test_entries_appended_during_the_build_are_indexed(monkeypatch):
+    monkeypatch.setattr(search, 'HISTORY_PAGE_SIZE', 10)
+    loads = []
+    history, release = paged_history([f'note {i}' for i in range(30)], hot_entries=5, loads=loads)
+
+    async def run():
+        build = asyncio.create_task(get_index(1, history))
+        await asyncio.sleep(0.05)
+        history.append(make_entry('late note'))
+        search.index_entry(1, len(history) - 1, history[-1])
+        release.set()
+        return await build
+    index = asyncio.run(run())
+    assert len(index) == 31
+    assert index.search('late')[0][0] == 30
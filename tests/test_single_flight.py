@@ -0,0 +1,127 @@
+"""
+This file holds the tests of SingleFlight: the deduplication of the requests and of the streams in flight, within an event loop and across loops.
+"""
+import asyncio
+import threading
+import time
+from typing import List
+from core import SingleFlight
+
+def make_stream(calls: List[str], gate: threading.Event, items: int = 3, delay: float = 0.01, finished: List[bool] = None):
+    """A fake stream, which counts its calls and waits for the gate before its first item."""
+    async def stream():
+        calls.append('stream')
+        try:
+            while not gate.is_set():
+                await asyncio.sleep(0.005)
+            for index in range(items):
+                await asyncio.sleep(delay)
+                yield ('delta', index)
+        finally:
+            if finished is not None:
+                finished.append(True)
+    return stream
+
+def consume_on_private_loop(agen, results: List, limit: int = None):
+    """Reads the stream like the web app does, on a private loop driven one item at a time, and closes the loop right after."""
+    loop = asyncio.new_event_loop()
+    try:
+        while limit is None or len(results) < limit:
+            try:
+                results.append(loop.run_until_complete(agen.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+def test_do_shares_the_result_of_the_flight_in_progress():
+    flights = SingleFlight()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'result'
+
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', slow))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['result'] * 5
+    assert len(calls) == 1
+    assert flights.stats() == {'in_flight': 0, 'deduplicated': 4}
+
+def test_a_stream_is_shared_within_a_loop():
+    flights = SingleFlight()
+    calls = []
+    gate = threading.Event()
+    gate.set()
+
+    async def read():
+        return [item async for item in flights.stream('key', make_stream(calls, gate))]
+
+    async def run():
+        return await asyncio.gather(read(), read())
+    first, second = asyncio.run(run())
+    assert first == second == [('delta', 0), ('delta', 1), ('delta', 2)]
+    assert calls == ['stream']
+    assert flights.stats() == {'in_flight': 0, 'deduplicated': 1}
+
+def test_a_stream_is_shared_across_the_private_loops_of_the_web_app():
+    flights = SingleFlight()
+    calls = []
+    gate = threading.Event()
+    results = [[], []]
+    readers = [threading.Thread(target=consume_on_private_loop, args=(flights.stream('key', make_stream(calls, gate)), result))
+               for result in results]
+    readers[0].start()
+    while not calls:
+        time.sleep(0.005)
+    readers[1].start()
+    time.sleep(0.05)
+    gate.set()
+    for reader in readers:
+        reader.join(2)
+    assert results[0] == results[1] == [('delta', 0), ('delta', 1), ('delta', 2)]
+    assert calls == ['stream']
+    assert flights.stats() == {'in_flight': 0, 'deduplicated': 1}
+
+def test_the_leader_leaving_early_drives_the_stream_for_the_other_loops():
+    flights = SingleFlight()
+    calls = []
+    gate = threading.Event()
+    leader, follower = [], []
+    # The leader stops after the first item, e.g. its client disconnected, and its loop is closed right after.
+    leading = threading.Thread(target=consume_on_private_loop, args=(flights.stream('key', make_stream(calls, gate, items=5)), leader, 1))
+    following = threading.Thread(target=consume_on_private_loop, args=(flights.stream('key', make_stream(calls, gate, items=5)), follower))
+    leading.start()
+    while not calls:
+        time.sleep(0.005)
+    following.start()
+    time.sleep(0.05)
+    gate.set()
+    leading.join(2)
+    following.join(2)
+    assert not following.is_alive()
+    assert leader == [('delta', 0)]
+    assert follower == [('delta', index) for index in range(5)]
+    assert calls == ['stream']
+
+def test_a_stream_left_by_all_its_subscribers_is_cancelled():
+    flights = SingleFlight()
+    calls = []
+    finished = []
+    gate = threading.Event()
+    gate.set()
+
+    async def run():
+        events = flights.stream('key', make_stream(calls, gate, items=100, finished=finished))
+        assert await events.__anext__() == ('delta', 0)
+        await events.aclose()
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+    assert finished == [True]
+    assert flights.stats() == {'in_flight': 0, 'deduplicated': 0}
@@ -0,0 +1,154 @@
+"""
+This file holds the tests of the daily summaries: the watermark, the weekly rollup, the deadline and the cursor of a run,
+with a fake Application and a fake GPT.
+"""
+import asyncio
+import datetime
+from typing import Dict, List
+import pytest
+import summaries
+from history import HistoryEntry, PagedHistory
+from summaries import SummaryRun
+
+MONDAY = datetime.date(2023, 7, 10)
+
+def make_entry(day: datetime.date, text: str) -> HistoryEntry:
+    entry = HistoryEntry(datetime.datetime.combine(day, datetime.time(12, 0)))
+    entry.add_revision('transcript', text)
+    return entry
+
+class FakePersistence:
+    def __init__(self, users: Dict[int, Dict]):
+        self.users = users
+
+    async def get_user_ids(self) -> List[int]:
+        return list(self.users)
+
+    async def load_user_data(self, user_id: int) -> Dict:
+        return self.users[user_id]
+
+    async def update_user_data(self, user_id: int, data: Dict):
+        self.users[user_id] = data
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id: int, text: str):
+        self.sent.append((chat_id, text))
+
+class FakeApplication:
+    def __init__(self, users: Dict[int, Dict]):
+        self.persistence = FakePersistence(users)
+        self.user_data: Dict[int, Dict] = {}
+        self.bot_data: Dict = {}
+        self.bot = FakeBot()
+
+    def mark_data_for_update_persistence(self, user_ids=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def fast_summaries(monkeypatch):
+    prompts = []
+    async def summarize(text: str, system_prompt: str, model: str) -> str:
+        prompts.append(text)
+        return f'{len(text.splitlines())} lines'
+    monkeypatch.setattr(summaries, 'gpt_process_text_full_async', summarize)
+    monkeypatch.setattr(summaries, 'SUMMARY_REQUESTS_PER_MINUTE', 1e9)
+    monkeypatch.setattr(summaries, 'TELEGRAM_MESSAGES_PER_MINUTE', 1e9)
+    return prompts
+
+def history_of(days_and_texts) -> PagedHistory:
+    return PagedHistory([make_entry(day, text) for day, text in days_and_texts])
+
+def test_watermark_summarizes_each_day_once():
+    today = datetime.date(2023, 7, 5)
+    yesterday = today - datetime.timedelta(days=1)
+    history = history_of([(today - datetime.timedelta(days=3), 'too old'), (yesterday, 'a'), (yesterday, 'b'), (today, 'c')])
+    application = FakeApplication({1: {'history': history}})
+
+    stats = asyncio.run(SummaryRun(application, today).run())
+    user = application.persistence.users[1]
+    # The first run only goes back SUMMARY_BACKFILL_DAYS, and leaves today for the next run.
+    assert stats['daily'] == 1
+    assert user['daily_summaries'] == {yesterday.isoformat(): '2 lines'}
+    assert user['summary_watermark'] == 3
+
+    stats = asyncio.run(SummaryRun(application, today).run())
+    assert stats['daily'] == 0
+    stats = asyncio.run(SummaryRun(application, today + datetime.timedelta(days=1)).run())
+    assert stats['daily'] == 1
+    assert user['summary_watermark'] == 4
+    assert [text for _, text in application.bot.sent] == [f'Summary of {yesterday}:\n\n2 lines', f'Summary of {today}:\n\n1 lines']
+
+def test_watermark_reads_the_older_notes_off_the_event_loop():
+    today = datetime.date(2023, 7, 5)
+    entries = [make_entry(today - datetime.timedelta(days=2), f'note {i}') for i in range(20)]
+    entries += [make_entry(today - datetime.timedelta(days=1), 'yesterday')]
+    loads = []
+    def loader(start: int, stop: int):
+        loads.append(start)
+        return entries[start:stop]
+    history = PagedHistory(entries[-2:], offset=len(entries) - 2, hot_entries=2)
+    history.mark_persisted(len(entries), loader)
+    application = FakeApplication({1: {'history': history}})
+    asyncio.run(SummaryRun(application, today).run())
+    # The binary search probed a few entries on disk, through the executor.
+    assert 0 < len(loads) < 10
+    assert application.persistence.users[1]['daily_summaries'] == {(today - datetime.timedelta(days=1)).isoformat(): '1 lines'}
+
+def test_monday_rolls_up_the_week_once(fast_summaries):
+    week_start = MONDAY - datetime.timedelta(days=7)
+    daily = {(week_start + datetime.timedelta(days=offset)).isoformat(): f'day {offset}' for offset in (0, 2, 6)}
+    user = {'history': history_of([(week_start, 'old note')]), 'summary_watermark': 1, 'daily_summaries': dict(daily)}
+    application = FakeApplication({1: user})
+
+    stats = asyncio.run(SummaryRun(application, MONDAY).run())
+    assert stats['weekly'] == 1
+    assert user['weekly_summaries'] == {week_start.isoformat(): '8 lines'}
+    assert fast_summaries[-1].count('day ') == 3
+
+    stats = asyncio.run(SummaryRun(application, MONDAY).run())
+    assert stats['weekly'] == 0
+    stats = asyncio.run(SummaryRun(application, MONDAY + datetime.timedelta(days=1)).run())
+    assert stats['weekly'] == 0
+
+class SlowRun(SummaryRun):
+    """Takes the given time to summarize each user, and records the order they are started in."""
+    def __init__(self, application, today, seconds: Dict[int, float]):
+        super().__init__(application, today)
+        self.seconds = seconds
+        self.started: List[int] = []
+
+    async def summarize_user(self, user_id: int):
+        self.started.append(user_id)
+        await asyncio.sleep(self.seconds.get(user_id, 0))
+
+def test_cursor_is_the_last_user_finished_in_order(monkeypatch):
+    monkeypatch.setattr(summaries, 'SUMMARY_MAX_CONCURRENCY', 2)
+    application = FakeApplication({user_id: {} for user_id in (1, 2, 3, 4)})
+    # User 1 finishes last, after the other worker did 2, 3 and 4.
+    run = SlowRun(application, MONDAY, {1: 0.1})
+    stats = asyncio.run(run.run())
+    assert stats['users'] == 4
+    assert application.bot_data['summary_cursor'] == 4
+
+def test_deadline_leaves_users_over_for_the_next_run(monkeypatch):
+    monkeypatch.setattr(summaries, 'SUMMARY_MAX_CONCURRENCY', 2)
+    application = FakeApplication({user_id: {} for user_id in (1, 2, 3, 4, 5)})
+    # Users 1 and 2 run past the deadline, so 3, 4 and 5 are left over.
+    run = SlowRun(application, MONDAY, {1: 0.1, 2: 0.05})
+    stats = asyncio.run(run.run(max_seconds=0.02))
+    assert stats['users'] == 2 and stats['left_over'] == 3
+    assert application.bot_data['summary_cursor'] == 2
+
+    run = SlowRun(application, MONDAY, {})
+    asyncio.run(run.run())
+    assert run.started == [3, 4, 5, 1, 2]
+    assert application.bot_data['summary_cursor'] == 2
+
+def test_cursor_stops_before_a_user_left_over(monkeypatch):
+    monkeypatch.setattr(summaries, 'SUMMARY_MAX_CONCURRENCY', 1)
+    application = FakeApplication({user_id: {} for user_id in (1, 2, 3)})
+    asyncio.run(SlowRun(application, MONDAY, {1: 0.05}).run(max_seconds=0.01))
+    assert application.bot_data['summary_cursor'] == 1
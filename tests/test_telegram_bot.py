@@ -0,0 +1,58 @@
+"""
+This file holds the tests of the Telegram bot helpers that don't need the Telegram API, with fake messages.
+"""
+import asyncio
+import pytest
+import telegram_bot
+
+class FakeMessage:
+    count = 0
+
+    def __init__(self):
+        FakeMessage.count += 1
+        self.chat_id = 1
+        self.message_id = FakeMessage.count
+        self.deleted = False
+
+    async def delete(self):
+        self.deleted = True
+
+def test_cancel_paraphrase_cancels_the_task_and_deletes_its_messages():
+    async def run():
+        paraphrase = asyncio.create_task(asyncio.sleep(10))
+        messages = [FakeMessage(), FakeMessage()]
+        await asyncio.sleep(0)
+        await telegram_bot.cancel_paraphrase(paraphrase, messages)
+        assert paraphrase.cancelled()
+        assert all(message.deleted for message in messages)
+    asyncio.run(run())
+
+def test_cancel_paraphrase_ignores_the_failure_of_the_task():
+    async def fail():
+        raise RuntimeError('API error')
+
+    async def run():
+        paraphrase = asyncio.create_task(fail())
+        await asyncio.sleep(0)
+        messages = [FakeMessage()]
+        await telegram_bot.cancel_paraphrase(paraphrase, messages)
+        assert messages[0].deleted
+    asyncio.run(run())
+
+def test_cancelling_the_handler_is_not_swallowed():
+    async def run():
+        async def stubborn():
+            # A paraphrase that takes a while to wind down after being cancelled.
+            try:
+                await asyncio.sleep(10)
+            finally:
+                await asyncio.sleep(0.2)
+        paraphrase = asyncio.create_task(stubborn())
+        await asyncio.sleep(0)
+        handler = asyncio.create_task(telegram_bot.cancel_paraphrase(paraphrase, []))
+        await asyncio.sleep(0.05)
+        handler.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await handler
+        await asyncio.wait([paraphrase])
+    asyncio.run(run())
@@ -0,0 +1,149 @@
+"""
+This file holds the tests of the update processor: the order within a chat, the concurrency across chats, the global cap and the dropped updates,
+with fake updates.
+"""
+import asyncio
+from typing import List
+import update_processor
+from update_processor import ChatOrderedUpdateProcessor
+
+class FakeMessage:
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.replies: List[str] = []
+
+    async def reply_text(self, text: str):
+        self.replies.append(text)
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+class FakeUpdate:
+    count = 0
+
+    def __init__(self, chat_id: int):
+        FakeUpdate.count += 1
+        self.update_id = FakeUpdate.count
+        self.effective_chat = FakeChat(chat_id)
+        self.effective_user = None
+        self.effective_message = FakeMessage(chat_id)
+
+async def make_processor(**kwargs) -> ChatOrderedUpdateProcessor:
+    processor = ChatOrderedUpdateProcessor(**kwargs)
+    await processor.initialize()
+    return processor
+
+def test_the_updates_of_a_chat_are_processed_in_order():
+    done = []
+
+    async def handle(name: str, seconds: float):
+        await asyncio.sleep(seconds)
+        done.append(name)
+
+    async def run():
+        processor = await make_processor()
+        # The first update is the slowest, and still the next ones wait for it.
+        await asyncio.gather(*(processor.process_update(FakeUpdate(1), handle(name, seconds))
+                               for name, seconds in (('a', 0.05), ('b', 0.0), ('c', 0.01))))
+        assert processor.busy_chats == 0
+    asyncio.run(run())
+    assert done == ['a', 'b', 'c']
+
+def test_a_busy_chat_does_not_hold_up_the_others():
+    async def run():
+        processor = await make_processor()
+        blocked = asyncio.Event()
+        done = []
+
+        async def handle(name: str):
+            if name == 'slow':
+                await blocked.wait()
+            done.append(name)
+
+        slow = asyncio.create_task(processor.process_update(FakeUpdate(1), handle('slow')))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(asyncio.gather(processor.process_update(FakeUpdate(2), handle('other chat')),
+                                              processor.process_update(FakeUpdate(3), handle('third chat'))), 1)
+        assert done == ['other chat', 'third chat']
+        assert processor.busy_chats == 1
+        blocked.set()
+        await slow
+        assert done[-1] == 'slow'
+    asyncio.run(run())
+
+def test_at_most_max_concurrent_updates_run_at_once():
+    running = 0
+    most = 0
+
+    async def handle():
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        processor = await make_processor(max_concurrent_updates=2)
+        await asyncio.gather(*(processor.process_update(FakeUpdate(chat_id), handle()) for chat_id in range(6)))
+    asyncio.run(run())
+    assert most == 2
+
+def test_a_flooding_chat_has_its_extra_updates_dropped_and_answered_once():
+    dropped = update_processor.DROPPED_UPDATES._values.get((), 0)
+
+    async def run():
+        processor = await make_processor(max_queued_per_chat=1)
+        blocked = asyncio.Event()
+        done = []
+
+        async def handle(name: str):
+            if name == 'first':
+                await blocked.wait()
+            done.append(name)
+
+        updates = [FakeUpdate(1) for _ in range(4)]
+        handlers = [handle(name) for name in ('first', 'waiting', 'dropped', 'also dropped')]
+        tasks = [asyncio.create_task(processor.process_update(update, handler)) for update, handler in zip(updates, handlers)]
+        await asyncio.wait(tasks[2:])
+        await asyncio.sleep(0)
+        # Only the first dropped update of the flood is answered.
+        assert updates[2].effective_message.replies == [update_processor.DROPPED_UPDATE_REPLY]
+        assert updates[3].effective_message.replies == []
+        blocked.set()
+        await asyncio.gather(*tasks[:2])
+        assert done == ['first', 'waiting']
+        # Once the chat is idle, a new flood is answered again.
+        later = [FakeUpdate(1) for _ in range(3)]
+        blocked.clear()
+        handlers = [handle('first'), handle('waiting'), handle('dropped')]
+        tasks = [asyncio.create_task(processor.process_update(update, handler)) for update, handler in zip(later, handlers)]
+        await asyncio.wait(tasks[2:])
+        await asyncio.sleep(0)
+        assert later[2].effective_message.replies == [update_processor.DROPPED_UPDATE_REPLY]
+        blocked.set()
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+    assert update_processor.DROPPED_UPDATES._values.get((), 0) - dropped == 3
+
+def test_an_update_cancelled_while_waiting_passes_the_turn_on():
+    async def run():
+        processor = await make_processor()
+        blocked = asyncio.Event()
+        done = []
+
+        async def handle(name: str):
+            if name == 'first':
+                await blocked.wait()
+            done.append(name)
+
+        first = asyncio.create_task(processor.process_update(FakeUpdate(1), handle('first')))
+        second = asyncio.create_task(processor.process_update(FakeUpdate(1), handle('cancelled')))
+        third = asyncio.create_task(processor.process_update(FakeUpdate(1), handle('third')))
+        await asyncio.sleep(0)
+        second.cancel()
+        blocked.set()
+        await asyncio.wait_for(asyncio.gather(first, third), 1)
+        assert done == ['first', 'third']
+        assert processor.busy_chats == 0
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+"""
+This file holds the tests of the voice activity detection (trim_silence), on synthetic 16 kHz PCM.
+"""
+import numpy as np
+import pytest
+from core import PCM_SAMPLE_RATE, VAD_MIN_SPEECH_SECONDS, detect_speech_frames, trim_silence
+
+def tone(seconds: float, amplitude: float, frequency: float = 150.0) -> np.ndarray:
+    """A voiced-like signal: a harmonic tone at the given peak amplitude, in int16 units."""
+    t = np.arange(int(seconds * PCM_SAMPLE_RATE)) / PCM_SAMPLE_RATE
+    signal = np.sin(2 * np.pi * frequency * t) + 0.5 * np.sin(2 * np.pi * 2 * frequency * t) + 0.25 * np.sin(2 * np.pi * 3 * frequency * t)
+    return amplitude * signal / np.abs(signal).max()
+
+def noise(seconds: float, rms: float, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(0, rms, int(seconds * PCM_SAMPLE_RATE))
+
+def to_pcm(signal: np.ndarray) -> np.ndarray:
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+def test_true_silence_is_silent():
+    trim = trim_silence(to_pcm(noise(3, 5)))
+    assert trim.silent
+    assert trim.speech_seconds == 0
+
+def test_digital_silence_is_silent():
+    assert trim_silence(np.zeros(2 * PCM_SAMPLE_RATE, dtype=np.int16)).silent
+
+def test_continuous_speech_without_pauses_is_kept():
+    # About -20 dBFS, voiced from start to end: the 10th percentile of the energy is speech itself.
+    pcm = to_pcm(tone(3, 0.1 * 32767))
+    trim = trim_silence(pcm)
+    assert not trim.silent
+    assert trim.speech_seconds == pytest.approx(3, abs=0.05)
+    assert len(trim.pcm) == len(pcm)
+
+def test_syllables_without_pauses_are_kept():
+    # The loudness only dips to 30-40% between syllables, 4 syllables per second.
+    t = np.arange(2 * PCM_SAMPLE_RATE) / PCM_SAMPLE_RATE
+    envelope = 0.35 + 0.65 * (0.5 + 0.5 * np.cos(2 * np.pi * 4 * t))
+    pcm = to_pcm(tone(2, 8000) * envelope + noise(2, 20))
+    trim = trim_silence(pcm)
+    assert not trim.silent
+    assert trim.speech_seconds > 1
+    # The dips are shorter than the padding around the speech, so nothing is cut.
+    assert len(trim.pcm) == len(pcm)
+
+def test_noisy_speech_is_not_dropped():
+    # About 2.4 s of speech at 4-5 dB SNR, between two pauses of noise.
+    speech = tone(2.4, 1500)
+    signal = np.concatenate((np.zeros(PCM_SAMPLE_RATE // 2), speech, np.zeros(PCM_SAMPLE_RATE // 2)))
+    pcm = to_pcm(signal + noise(len(signal) / PCM_SAMPLE_RATE, 600))
+    trim = trim_silence(pcm)
+    assert not trim.silent
+    # Either the speech is found, or the note is kept untrimmed, but it's never cut below the speech.
+    assert len(trim.pcm) >= len(speech)
+
+def test_pauses_are_trimmed_around_speech():
+    quiet = noise(1.5, 10)
+    pcm = to_pcm(np.concatenate((quiet, tone(1, 8000) + noise(1, 10, seed=1), quiet, tone(1, 8000) + noise(1, 10, seed=2), quiet)))
+    trim = trim_silence(pcm, max_pause_seconds=0.6, padding_seconds=0.2)
+    assert not trim.silent
+    assert trim.speech_seconds == pytest.approx(2, abs=0.1)
+    # The 1.5 s of leading and trailing silence are cut and the middle pause is shortened.
+    assert trim.trimmed_seconds > 3
+
+def test_short_sound_in_silence_is_kept_untrimmed():
+    pcm = to_pcm(np.concatenate((noise(1, 5), tone(VAD_MIN_SPEECH_SECONDS / 3, 8000), noise(1, 5, seed=1))))
+    trim = trim_silence(pcm)
+    assert not trim.silent
+    assert len(trim.pcm) == len(pcm)
+
+def test_detect_speech_frames_of_empty_audio():
+    assert len(detect_speech_frames(np.zeros(10, dtype=np.int16))) == 0
@@ -0,0 +1,142 @@
+"""
+This file holds the update processor of the Telegram bot, replacing the default sequential processing of the Application.
+* The updates of different chats are processed concurrently, so a long voice note only holds up its own chat.
+* The updates of the same chat are processed one at a time, in the order they arrived, because the handlers rely on it:
+  the ConversationHandler states (REGULAR/OUTLINE), the outline edits, and a text followed by a style button.
+* At most UPDATE_MAX_CONCURRENCY updates are processed at the same time. The updates waiting for their chat don't count.
+* At most UPDATE_MAX_QUEUED_PER_CHAT updates wait behind the one being processed in a chat. Beyond it, e.g. when a chat floods the bot,
+  the new updates are dropped. The first one dropped is answered, so the user knows to send it again, and the following ones
+  of the same flood are only logged.
+
+Usage:
+    Application.builder().concurrent_updates(ChatOrderedUpdateProcessor())
+"""
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Hashable, Optional, Set
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+# Number of updates processed at the same time, across all the chats.
+UPDATE_MAX_CONCURRENCY = int(os.environ.get('UPDATE_MAX_CONCURRENCY', 32))
+# Number of updates of a chat waiting for the one being processed.
+UPDATE_MAX_QUEUED_PER_CHAT = int(os.environ.get('UPDATE_MAX_QUEUED_PER_CHAT', 16))
+# Number of updates accepted by the processor, processed or waiting. The Application waits beyond it before handing over more.
+UPDATE_MAX_PENDING = 1024
+
+DROPPED_UPDATE_REPLY = 'Too many of your messages are waiting, so this one was skipped. Please send it again once I have answered the previous ones.'
+
+DROPPED_UPDATES = metrics.Counter('voicenote_dropped_updates_total', 'Telegram updates dropped because their chat had too many waiting.')
+
+def _chat_key(update: object) -> Optional[Hashable]:
+    """The key the updates are serialized by: the chat, or the user for the updates without a chat (e.g. inline queries).
+    None for the updates of neither, which are not serialized.
+    """
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return ('user', user.id)
+    return None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes the updates of different chats concurrently, and the updates of a chat in order, see the module docstring.
+
+    Args:
+        max_concurrent_updates (int): number of updates processed at the same time.
+        max_queued_per_chat (int): number of updates of a chat allowed to wait.
+        max_pending_updates (int): number of updates accepted, processed or waiting.
+    """
+    def __init__(self, max_concurrent_updates: int = UPDATE_MAX_CONCURRENCY, max_queued_per_chat: int = UPDATE_MAX_QUEUED_PER_CHAT,
+                 max_pending_updates: int = UPDATE_MAX_PENDING):
+        # The semaphore of BaseUpdateProcessor is taken before do_process_update, i.e. before an update knows whether its chat is busy.
+        # Set to the global cap, the updates waiting for their chat would hold its slots, so it only bounds the accepted updates,
+        # and the global cap is enforced by _running, once it's the update's turn in its chat.
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.max_running = max_concurrent_updates
+        self.max_queued_per_chat = max_queued_per_chat
+        self._running: Optional[asyncio.Semaphore] = None
+        # The turns of the updates of each busy chat, in order of arrival. The first one is being processed.
+        self._chats: Dict[Hashable, Deque[asyncio.Future]] = {}
+        # The busy chats already told about a dropped update, and the replies being sent.
+        self._warned: Set[Hashable] = set()
+        self._replies: Set[asyncio.Task] = set()
+
+    async def initialize(self) -> None:
+        # Created here rather than in __init__, so it belongs to the event loop of the Application on Python < 3.10.
+        self._running = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._warned.clear()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        # Everything up to the first await runs in the order the Application handed the updates over, which is the order of arrival.
+        turns = self._chats.setdefault(key, deque())
+        if len(turns) > self.max_queued_per_chat:
+            coroutine.close()
+            DROPPED_UPDATES.inc()
+            print(f'Dropped the update {getattr(update, "update_id", None)} of {key}, which has {len(turns) - 1} updates waiting.')
+            if key not in self._warned:
+                self._warned.add(key)
+                self._reply_dropped(update)
+            return
+        turn = asyncio.get_running_loop().create_future()
+        turns.append(turn)
+        if len(turns) == 1:
+            turn.set_result(None)
+        queued = time.perf_counter()
+        started = False
+        try:
+            await turn
+            async with self._running:
+                metrics.record_stage('update_queued', time.perf_counter() - queued, queued, traced=False)
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                # Cancelled before its turn, e.g. on shutdown.
+                coroutine.close()
+            self._next_turn(key, turns, turn)
+
+    def _next_turn(self, key: Hashable, turns: Deque[asyncio.Future], turn: asyncio.Future):
+        if turns[0] is turn:
+            turns.popleft()
+            # The next turn may have been cancelled already, and then it passes the turn on itself once it runs this.
+            if turns and not turns[0].done():
+                turns[0].set_result(None)
+        else:
+            # Cancelled while waiting for its turn.
+            turns.remove(turn)
+        if not turns and self._chats.get(key) is turns:
+            del self._chats[key]
+            self._warned.discard(key)
+
+    def _reply_dropped(self, update: object):
+        """Tells the chat its update was dropped, in the background so the next updates are not held up."""
+        message = getattr(update, 'effective_message', None)
+        if message is None:
+            return
+        task = asyncio.create_task(self._send_dropped_reply(message))
+        self._replies.add(task)
+        task.add_done_callback(self._replies.discard)
+
+    @staticmethod
+    async def _send_dropped_reply(message: Any):
+        try:
+            await message.reply_text(DROPPED_UPDATE_REPLY)
+        except Exception as e:
+            print(f'Could not tell the chat {getattr(message, "chat_id", None)} its update was dropped: {e}')
+
+    @property
+    def busy_chats(self) -> int:
+        """The number of chats with an update being processed or waiting."""
+        return len(self._chats)